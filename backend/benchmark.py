@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the virtual try-on pipeline.
+
+Runs the example person/garment pairs through every quality tier and reports
+latency side by side, so quality can be traded for speed knowingly.
+
+Usage:
+    python benchmark.py [--iterations N] [--tiers fast,balanced,best] [--engine legacy]
+    python benchmark.py --kernels [--iterations N]
+    python benchmark.py --soak N [--concurrency C] [--engine gemini]
+    python benchmark.py --assets [--iterations N]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Add the current directory to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from utils.asset_format import load_asset, save_asset
+from utils.buffer_pool import current_rss_mb, get_buffer_pool
+from utils.cache import clear_processor_caches
+from utils.engines import ENGINES, create_processor
+from utils.enhanced_tryon import EnhancedVirtualTryOnProcessor
+from utils.garment_kernels import enhance_garment_inplace
+from utils.mipmap import build_pyramid, resize_from_pyramid
+from utils.quality import QUALITY_PROFILES, get_quality_profile
+
+EXAMPLES_DIR = Path(__file__).resolve().parent.parent / "examples"
+
+# (person image, garment image, garment type) pairs from the examples folder
+EXAMPLE_PAIRS = [
+    ("women-1.jpg", "srk-1.png", "shirt"),
+    ("srk-t-shirt-try-on.jpg", "women-top-try-on.jpg", "top"),
+]
+
+# Typical catalog garment image sizes (width, height)
+CATALOG_SIZES = [(600, 800), (1000, 1500), (1500, 2000), (2000, 3000)]
+
+# Garment region on a typical phone photo at the default working size
+REGION_SIZE = (384, 616)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def load_pairs():
+    """Read the example image pairs as bytes"""
+    pairs = []
+    for person_name, cloth_name, garment_type in EXAMPLE_PAIRS:
+        person_path = EXAMPLES_DIR / person_name
+        cloth_path = EXAMPLES_DIR / cloth_name
+        if person_path.exists() and cloth_path.exists():
+            pairs.append((person_path.read_bytes(), cloth_path.read_bytes(), garment_type))
+    if not pairs:
+        raise SystemExit(f"No example images found in {EXAMPLES_DIR}")
+    return pairs
+
+
+def run_tier(processor, profile, pairs, iterations):
+    """Run every pair through one quality tier and collect latency and stage timings.
+
+    Each pair runs cold (caches emptied first) and then warm (the same request again), so
+    tiers are compared on full work and the cache benefit is reported on its own.
+    """
+    latencies = []
+    warm_latencies = []
+    output_sizes = []
+    stage_totals = {}
+
+    def run(person_bytes, cloth_bytes, garment_type, timings=None):
+        start = time.perf_counter()
+        result, _ = processor.process_virtual_tryon(
+            person_bytes, cloth_bytes, garment_type, "", timings=timings, quality=profile
+        )
+        encoded = processor.encode_image(result, profile.output_format, profile.output_quality)
+        return (time.perf_counter() - start) * 1000, encoded
+
+    for _ in range(iterations):
+        for person_bytes, cloth_bytes, garment_type in pairs:
+            clear_processor_caches(processor)
+            timings = {}
+            elapsed_ms, encoded = run(person_bytes, cloth_bytes, garment_type, timings)
+            latencies.append(elapsed_ms)
+            output_sizes.append(len(encoded) / 1024)
+            for stage, stage_ms in timings.items():
+                stage_totals.setdefault(stage, []).append(stage_ms)
+            warm_latencies.append(run(person_bytes, cloth_bytes, garment_type)[0])
+
+    return {
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "warm_mean": statistics.mean(warm_latencies),
+        "output_kb": statistics.mean(output_sizes),
+        "stages": {stage: statistics.mean(values) for stage, values in stage_totals.items()},
+    }
+
+
+def print_tier_table(results):
+    """Print per-tier latency and per-stage timings side by side"""
+    tiers = list(results)
+    header = f"{'':<20}" + "".join(f"{tier:>12}" for tier in tiers)
+    print(header)
+    print("-" * len(header))
+    for metric, label in (("mean", "cold mean ms"), ("p50", "cold p50 ms"), ("p95", "cold p95 ms"),
+                          ("warm_mean", "warm mean ms"), ("output_kb", "output KB")):
+        print(f"{label:<20}" + "".join(f"{results[tier][metric]:>12.1f}" for tier in tiers))
+
+    stages = []
+    for tier in tiers:
+        stages.extend(stage for stage in results[tier]["stages"] if stage not in stages)
+    for stage in stages:
+        row = "".join(f"{results[tier]['stages'].get(stage, 0.0):>12.1f}" for tier in tiers)
+        print(f"{stage + ' ms':<20}" + row)
+
+
+def time_call(func, iterations):
+    """Mean wall time of ``func()`` in milliseconds"""
+    elapsed = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        elapsed.append((time.perf_counter() - start) * 1000)
+    return statistics.mean(elapsed)
+
+
+def benchmark_kernels(processor, iterations):
+    """Compare the PIL garment enhancement path with the fused in-place kernel, and full vs pyramid resizes"""
+    garment = cv2.imread(str(EXAMPLES_DIR / EXAMPLE_PAIRS[0][1]), cv2.IMREAD_COLOR)
+    garment = cv2.cvtColor(garment, cv2.COLOR_BGR2RGB)
+
+    print(f"Garment enhancement over {iterations} iterations")
+    print(f"{'size':<12}{'PIL ms':>10}{'fused ms':>10}{'speedup':>10}{'mean diff':>12}{'max diff':>10}")
+    for width, height in CATALOG_SIZES:
+        rgba = processor._fallback_background_removal(
+            cv2.resize(garment, (width, height), interpolation=cv2.INTER_CUBIC)
+        )
+
+        legacy_ms = time_call(lambda: processor.detect_and_preserve_patterns(
+            processor.enhance_texture_preservation(rgba.copy())), iterations)
+        fused_ms = time_call(lambda: enhance_garment_inplace(rgba.copy()), iterations)
+
+        reference = processor.detect_and_preserve_patterns(processor.enhance_texture_preservation(rgba.copy()))
+        diff = np.abs(reference.astype(np.int16) - enhance_garment_inplace(rgba.copy()))
+        print(f"{f'{width}x{height}':<12}{legacy_ms:>10.1f}{fused_ms:>10.1f}{legacy_ms / fused_ms:>9.1f}x"
+              f"{diff.mean():>12.3f}{int(diff.max()):>10}")
+
+    print()
+    print(f"Garment resize to {REGION_SIZE[0]}x{REGION_SIZE[1]} (Lanczos) over {iterations} iterations")
+    print(f"{'size':<12}{'full ms':>10}{'pyramid ms':>12}{'build ms':>10}")
+    for width, height in CATALOG_SIZES:
+        rgba = processor._fallback_background_removal(
+            cv2.resize(garment, (width, height), interpolation=cv2.INTER_CUBIC)
+        )
+        full_ms = time_call(lambda: cv2.resize(rgba, REGION_SIZE, interpolation=cv2.INTER_LANCZOS4), iterations)
+        build_ms = time_call(lambda: build_pyramid(rgba), iterations)
+        pyramid = build_pyramid(rgba)
+        pyramid_ms = time_call(lambda: resize_from_pyramid(pyramid, *REGION_SIZE), iterations)
+        print(f"{f'{width}x{height}':<12}{full_ms:>10.1f}{pyramid_ms:>12.1f}{build_ms:>10.1f}")
+
+
+def benchmark_assets(processor, iterations):
+    """Compare PNG decoding of extracted garments and masks with memory-mapped asset loading"""
+    garment = cv2.imread(str(EXAMPLES_DIR / EXAMPLE_PAIRS[0][1]), cv2.IMREAD_COLOR)
+    garment = cv2.cvtColor(garment, cv2.COLOR_BGR2RGB)
+    person = processor.decode_image((EXAMPLES_DIR / EXAMPLE_PAIRS[0][0]).read_bytes())
+    mask = processor.get_person_segmentation(person)
+
+    print(f"Asset loading over {iterations} iterations")
+    print(f"{'asset':<16}{'PNG KB':>10}{'asset KB':>10}{'PNG ms':>10}{'mmap ms':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        items = [(f"mask {mask.shape[1]}x{mask.shape[0]}", mask)]
+        for width, height in CATALOG_SIZES:
+            rgba = processor._fallback_background_removal(
+                cv2.resize(garment, (width, height), interpolation=cv2.INTER_CUBIC)
+            )
+            items.append((f"garment {width}x{height}", rgba))
+
+        for label, image in items:
+            png = cv2.imencode(".png", image)[1]
+            path = os.path.join(directory, "asset.trya")
+            save_asset(path, image)
+            png_ms = time_call(lambda: cv2.imdecode(png, cv2.IMREAD_UNCHANGED), iterations)
+            # Touch every page so the lazy map is not flattered
+            asset_ms = time_call(lambda: int(load_asset(path).image[::64, ::64].sum()), iterations)
+            print(f"{label:<16}{len(png) / 1024:>10.0f}{os.path.getsize(path) / 1024:>10.0f}"
+                  f"{png_ms:>10.1f}{asset_ms:>10.2f}")
+
+
+def resized_upload(image_bytes, scale):
+    """Re-encode an example image at ``scale`` to vary request sizes"""
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    h, w = image.shape[:2]
+    image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def soak(processor, requests, concurrency, report_every=25):
+    """Run mixed-size requests concurrently and print RSS as they complete, to spot memory creep"""
+    rng = random.Random(0)
+    pairs = load_pairs()
+    uploads = [
+        (resized_upload(person, scale), resized_upload(cloth, scale), garment_type)
+        for person, cloth, garment_type in pairs
+        for scale in (0.5, 1.0, 2.0)
+    ]
+    profiles = list(QUALITY_PROFILES.values())
+
+    def one_request(_):
+        person_bytes, cloth_bytes, garment_type = rng.choice(uploads)
+        result, _ = processor.process_virtual_tryon(person_bytes, cloth_bytes, garment_type, "",
+                                                    quality=rng.choice(profiles))
+        return result.shape
+
+    stdout = sys.stdout
+    samples = []
+    with open(os.devnull, "w") as devnull, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        sys.stdout = devnull
+        try:
+            for done, _ in enumerate(pool.map(one_request, range(requests)), start=1):
+                if done % report_every == 0 or done == requests:
+                    samples.append((done, current_rss_mb()))
+                    print(f"{done:>6} requests  rss {samples[-1][1]} MB", file=stdout)
+        finally:
+            sys.stdout = stdout
+
+    print(f"Buffer pool: {get_buffer_pool().stats()}")
+    generative = processor.cache_stats().get("generative")
+    if generative:
+        print(f"Generative backend: {generative}")
+    if len(samples) >= 2 and samples[0][1] is not None:
+        # Compare against the first sample so warm-up allocations are not counted as growth
+        print(f"RSS growth after warm-up: {samples[-1][1] - samples[0][1]:+.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the virtual try-on pipeline")
+    parser.add_argument("--iterations", type=int, default=3, help="Runs per example pair")
+    parser.add_argument("--tiers", default=",".join(QUALITY_PROFILES),
+                        help="Comma-separated quality tiers to compare")
+    parser.add_argument("--engine", choices=ENGINES, default=None,
+                        help="Try-on engine for the tier comparison and --soak (default: TRYON_ENGINE or enhanced)")
+    parser.add_argument("--kernels", action="store_true",
+                        help="Benchmark garment enhancement kernels at catalog image sizes")
+    parser.add_argument("--soak", type=int, default=0, metavar="N",
+                        help="Run N mixed-size requests and track resident memory")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent requests during --soak")
+    parser.add_argument("--assets", action="store_true",
+                        help="Compare PNG decoding with memory-mapped garment/mask assets")
+    args = parser.parse_args()
+
+    if args.assets:
+        benchmark_assets(EnhancedVirtualTryOnProcessor(), args.iterations)
+        return
+
+    if args.soak:
+        soak(create_processor(args.engine), args.soak, args.concurrency)
+        return
+
+    if args.kernels:
+        benchmark_kernels(EnhancedVirtualTryOnProcessor(), args.iterations)
+        return
+
+    # Keep the per-request debug output out of the report
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+
+    pairs = load_pairs()
+    processor = create_processor(args.engine)
+    profiles = [get_quality_profile(name) for name in args.tiers.split(",")]
+
+    results = {}
+    for profile in profiles:
+        sys.stdout = devnull
+        try:
+            # Warm-up run so model loading is not counted
+            run_tier(processor, profile, pairs[:1], 1)
+            results[profile.name] = run_tier(processor, profile, pairs, args.iterations)
+        finally:
+            sys.stdout = stdout
+
+    print(f"Quality tiers over {len(pairs)} example pairs x {args.iterations} iterations")
+    print_tier_table(results)
+
+
+if __name__ == "__main__":
+    main()
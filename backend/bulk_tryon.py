@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Offline bulk virtual try-on.
+
+Runs every person x garment pair from a manifest (CSV or JSONL) or from two
+directories through the try-on pipeline in a pool of worker processes, each
+with its models loaded once. Results are written to disk and progress is
+checkpointed, so an interrupted run picks up where it stopped.
+
+Usage:
+    python bulk_tryon.py --manifest jobs.csv --output-dir out/
+    python bulk_tryon.py --persons people/ --garments garments/ --garment-type shirt --output-dir out/
+
+Manifest columns: person, garment, and optionally garment_type, quality and output.
+Relative paths are resolved against the manifest's folder.
+"""
+import argparse
+import contextlib
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from utils.engines import ENGINES, engine_from_env
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+OUTPUT_FORMATS = {"png": ("PNG", ".png"), "jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+CHECKPOINT_NAME = ".bulk_tryon_checkpoint.jsonl"
+
+# Set in each worker process by init_worker
+_processor = None
+_worker_options = None
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def job_id(job, image_format, engine):
+    """Stable identifier of a job and the settings it is rendered with, used as its checkpoint key"""
+    fields = [str(job[field]) for field in ("person", "garment", "garment_type", "quality", "output")]
+    text = "|".join(fields + [image_format, engine])
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+
+def list_images(directory):
+    return sorted(path for path in Path(directory).iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def read_manifest(path, default_garment_type, default_quality):
+    """Jobs from a CSV (with header) or JSONL manifest"""
+    path = Path(path)
+    if path.suffix.lower() == ".jsonl":
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for row in rows:
+        jobs.append({
+            "person": str((path.parent / row["person"]).resolve()),
+            "garment": str((path.parent / row["garment"]).resolve()),
+            "garment_type": row.get("garment_type") or default_garment_type,
+            "quality": row.get("quality") or default_quality,
+            "output": row.get("output") or None,
+        })
+    return jobs
+
+
+def directory_jobs(persons_dir, garments_dir, garment_type, quality):
+    """Every person image combined with every garment image"""
+    return [
+        {
+            "person": str(person.resolve()),
+            "garment": str(garment.resolve()),
+            "garment_type": garment_type,
+            "quality": quality,
+            "output": None,
+        }
+        for person in list_images(persons_dir)
+        for garment in list_images(garments_dir)
+    ]
+
+
+def output_path(job, output_dir, extension, identifier):
+    """Explicit output name, or one built from the inputs that no other job can produce.
+
+    File stems alone collide across folders (``a/shirt.jpg`` and ``b/shirt.jpg``), so the
+    generated name ends with the start of the job id.
+    """
+    if job["output"]:
+        return str(Path(output_dir) / job["output"])
+    name = f"{Path(job['person']).stem}__{Path(job['garment']).stem}"
+    for field in ("garment_type", "quality"):
+        if job[field]:
+            name += f"__{job[field]}"
+    return str(Path(output_dir) / f"{name}__{identifier[:8]}{extension}")
+
+
+def load_checkpoint(path):
+    """Ids of jobs that finished successfully in earlier runs"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of a run that was killed mid-write
+                continue
+            if record.get("status") == "ok" and os.path.exists(record.get("output", "")):
+                done.add(record["id"])
+    return done
+
+
+def init_worker(cpu_share, verbose, engine):
+    """Load the models once per worker process, with its share of the CPU budget"""
+    global _processor, _worker_options
+    os.environ["TRYON_CPU_BUDGET"] = str(cpu_share)
+    os.environ["TRYON_REQUEST_WORKERS"] = "1"
+    # Where the pipeline's logs go; opened once and kept for the worker's lifetime
+    log = sys.stdout if verbose else open(os.devnull, "w")
+
+    with contextlib.redirect_stdout(log):
+        from utils.engines import create_processor
+        from utils.thread_budget import apply_thread_budget
+
+        apply_thread_budget()
+        _processor = create_processor(engine)
+    _worker_options = {"log": log}
+
+
+def run_job(task):
+    """Process one pair in a worker and write the result; returns a checkpoint record"""
+    from utils.quality import get_quality_profile
+
+    job, identifier, destination, image_format = task
+    record = {"id": identifier, "output": destination, "person": job["person"], "garment": job["garment"]}
+    timings = {}
+    start = time.perf_counter()
+    try:
+        profile = get_quality_profile(job["quality"])
+        person_bytes = Path(job["person"]).read_bytes()
+        cloth_bytes = Path(job["garment"]).read_bytes()
+
+        with contextlib.redirect_stdout(_worker_options["log"]):
+            result, _ = _processor.process_virtual_tryon(
+                person_bytes, cloth_bytes, job["garment_type"], "", timings=timings, quality=profile
+            )
+
+        encode_start = time.perf_counter()
+        encoded = _processor.encode_image(result, image_format, profile.output_quality)
+        os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+        temp_path = destination + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(encoded)
+        os.replace(temp_path, destination)
+        timings["encode_write"] = (time.perf_counter() - encode_start) * 1000
+
+        record["status"] = "ok"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = str(e)
+
+    record["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    record["stages"] = {stage: round(ms, 2) for stage, ms in timings.items()}
+    return record
+
+
+def print_report(records, wall_seconds, skipped):
+    """Throughput and per-stage timing summary"""
+    completed = [record for record in records if record["status"] == "ok"]
+    failed = [record for record in records if record["status"] != "ok"]
+
+    print()
+    print(f"Processed {len(completed)} images in {wall_seconds:.1f}s "
+          f"({len(completed) / wall_seconds if wall_seconds else 0.0:.2f} images/s), "
+          f"{len(failed)} failed, {skipped} skipped from checkpoint")
+    if not completed:
+        return
+
+    latencies = [record["ms"] for record in completed]
+    print(f"{'':<20}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    print(f"{'per image':<20}{statistics.mean(latencies):>10.1f}{percentile(latencies, 50):>10.1f}"
+          f"{percentile(latencies, 95):>10.1f}")
+
+    stages = {}
+    for record in completed:
+        for stage, elapsed_ms in record["stages"].items():
+            stages.setdefault(stage, []).append(elapsed_ms)
+    for stage, values in stages.items():
+        print(f"{stage + ' ms':<20}{statistics.mean(values):>10.1f}{percentile(values, 50):>10.1f}"
+              f"{percentile(values, 95):>10.1f}")
+
+    for record in failed[:10]:
+        print(f"❌ {Path(record['person']).name} x {Path(record['garment']).name}: {record['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run virtual try-on over many person/garment pairs")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="CSV or JSONL file with person, garment[, garment_type, quality, output]")
+    source.add_argument("--persons", help="Directory of person images (combined with --garments)")
+    parser.add_argument("--garments", help="Directory of garment images")
+    parser.add_argument("--garment-type", default="", help="Garment type for jobs that do not set one")
+    parser.add_argument("--quality", default="best", help="Quality tier for jobs that do not set one")
+    parser.add_argument("--output-dir", required=True, help="Where results and the checkpoint are written")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="png", help="Output image format")
+    parser.add_argument("--engine", choices=ENGINES, default=None,
+                        help="Try-on engine (default: TRYON_ENGINE or enhanced)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore the checkpoint and redo every job")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's per-image logs")
+    args = parser.parse_args()
+
+    if args.persons and not args.garments:
+        parser.error("--persons needs --garments")
+
+    if args.manifest:
+        jobs = read_manifest(args.manifest, args.garment_type, args.quality)
+    else:
+        jobs = directory_jobs(args.persons, args.garments, args.garment_type, args.quality)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(args.output_dir, CHECKPOINT_NAME)
+    if args.no_resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    done = load_checkpoint(checkpoint_path)
+
+    image_format, extension = OUTPUT_FORMATS[args.format]
+    engine = args.engine or engine_from_env()
+    tasks = []
+    for job in jobs:
+        identifier = job_id(job, image_format, engine)
+        if identifier not in done:
+            tasks.append((job, identifier, output_path(job, args.output_dir, extension, identifier), image_format))
+    skipped = len(jobs) - len(tasks)
+
+    workers = max(1, min(args.workers, len(tasks) or 1))
+    cpu_share = max(1, (os.cpu_count() or 1) // workers)
+    print(f"🧺 {len(jobs)} jobs, {skipped} already done, {len(tasks)} to run on {workers} workers "
+          f"({cpu_share} threads each)")
+    if not tasks:
+        return
+
+    records = []
+    start = time.perf_counter()
+    # Spawned workers start clean instead of inheriting the parent's library thread pools
+    context = multiprocessing.get_context("spawn")
+    with open(checkpoint_path, "a") as checkpoint, \
+            context.Pool(workers, initializer=init_worker, initargs=(cpu_share, args.verbose, engine)) as pool:
+        for count, record in enumerate(pool.imap_unordered(run_job, tasks), start=1):
+            checkpoint.write(json.dumps({key: record[key] for key in ("id", "status", "output", "ms")}) + "\n")
+            checkpoint.flush()
+            records.append(record)
+            if count % 25 == 0 or count == len(tasks):
+                elapsed = time.perf_counter() - start
+                print(f"  {count}/{len(tasks)} done, {count / elapsed:.2f} images/s")
+
+    print_report(records, time.perf_counter() - start, skipped)
+    if any(record["status"] != "ok" for record in records):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Speed-vs-fidelity regression harness.
+
+Runs the try-on pipeline over a fixed corpus (the example pairs plus seeded
+synthetic people and garments) under one or more candidate configurations
+and compares every output with stored golden outputs. Each configuration
+reports PSNR/SSIM against the goldens next to latency and peak memory, and
+the run fails when any output falls below the fidelity thresholds.
+
+Usage:
+    python fidelity_harness.py --update-goldens           # record goldens with the reference config
+    python fidelity_harness.py                             # every preset against the goldens
+    python fidelity_harness.py --configs reference,fallback-512 --tiers best
+    python fidelity_harness.py --config "mine:TRYON_FALLBACK_MAX_SIDE=384,TRYON_LIGHTING_TILES=8"
+
+A configuration is a set of environment variables (any TRYON_* setting,
+TRYON_ENGINE included). Each one runs in a fresh process, so settings read at
+start-up take effect and configurations cannot share caches. Caches are
+cleared before every run, so latencies are for uncached requests.
+"""
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Add the current directory to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from utils.cache import clear_processor_caches
+from utils.quality import QUALITY_PROFILES
+
+EXAMPLES_DIR = Path(__file__).resolve().parent.parent / "examples"
+DEFAULT_GOLDENS_DIR = Path(__file__).resolve().parent / "fidelity_goldens"
+
+# (name, person image, garment image, garment type) from the examples folder
+EXAMPLE_CASES = [
+    ("women-1__srk-1", "women-1.jpg", "srk-1.png", "shirt"),
+    ("srk-t-shirt__women-top", "srk-t-shirt-try-on.jpg", "women-top-try-on.jpg", "top"),
+]
+
+# Candidate configurations: environment overrides on top of the defaults
+CANDIDATES = {
+    "reference": {},
+    "fallback-512": {"TRYON_FALLBACK_MAX_SIDE": "512"},
+    "lut-6bit": {"TRYON_COLOR_LUT_BITS": "6"},
+    "bucket-16": {"TRYON_RESIZE_BUCKET_PX": "16"},
+    "lighting-tiles-8": {"TRYON_LIGHTING_TILES": "8"},
+    "lite": {"TRYON_ENGINE": "lite"},
+}
+
+# Settings that would let configurations or runs share state
+ISOLATION_ENV = {"TRYON_SHARED_CACHE": ""}
+
+# Set in the configuration's worker process by init_config
+_processor = None
+_verbose = False
+
+# Shared sink for the pipeline's debug output when not verbose
+_DEVNULL = open(os.devnull, "w")
+
+
+def encode(image_rgb, extension, quality=95):
+    flags = [cv2.IMWRITE_JPEG_QUALITY, quality] if extension == ".jpg" else []
+    return cv2.imencode(extension, cv2.cvtColor(image_rgb, cv2.COLOR_RGBA2BGRA if image_rgb.shape[2] == 4
+                                                 else cv2.COLOR_RGB2BGR), flags)[1].tobytes()
+
+
+def synthetic_person(width, height, rng, background, clothing_rgb, legs=True):
+    """A plain figure (head, torso, arms, legs) on a noisy vertical gradient"""
+    top, bottom = np.array(background[0], np.float32), np.array(background[1], np.float32)
+    ramp = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    image = np.broadcast_to(top + (bottom - top) * ramp, (height, width, 3)).copy()
+    image += rng.normal(0, 4, image.shape).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    cx, unit = width // 2, height / 16
+    skin = (205, 160, 130)
+    cv2.ellipse(image, (cx, int(2.2 * unit)), (int(1.1 * unit), int(1.4 * unit)), 0, 0, 360, skin, -1)
+    cv2.rectangle(image, (cx - int(0.4 * unit), int(3.4 * unit)), (cx + int(0.4 * unit), int(4.2 * unit)), skin, -1)
+    torso = np.array([[cx - 2.2 * unit, 4 * unit], [cx + 2.2 * unit, 4 * unit],
+                      [cx + 1.8 * unit, 9.5 * unit], [cx - 1.8 * unit, 9.5 * unit]], np.int32)
+    cv2.fillPoly(image, [torso], clothing_rgb)
+    for side in (-1, 1):
+        arm = np.array([[cx + side * 2.1 * unit, 4.2 * unit], [cx + side * 3.2 * unit, 8.8 * unit],
+                        [cx + side * 2.6 * unit, 9 * unit], [cx + side * 1.7 * unit, 5.5 * unit]], np.int32)
+        cv2.fillPoly(image, [arm], skin)
+        if legs:
+            inner, outer = cx + side * int(0.2 * unit), cx + side * int(1.7 * unit)
+            cv2.rectangle(image, (min(inner, outer), int(9.5 * unit)), (max(inner, outer), int(15.5 * unit)),
+                          (60, 70, 110), -1)
+    return image
+
+
+def synthetic_garment(width, height, pattern, transparent=False, pants=False):
+    """A shirt or trouser silhouette filled with stripes, plaid or checks"""
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    if pattern == "stripes":
+        texture = np.where((ys // 12) % 2 == 0, 1.0, 0.0)[:, :, None] * np.array([180, 30, 40]) + \
+            np.where((ys // 12) % 2 == 0, 0.0, 1.0)[:, :, None] * np.array([240, 230, 210])
+    elif pattern == "plaid":
+        wave = (np.sin(xs / 7) + np.sin(ys / 7)) * 0.5
+        texture = np.stack([60 + 80 * wave, 110 + 60 * np.sin(xs / 19), 90 + 70 * np.sin(ys / 23)], axis=2) + 60
+    else:
+        checks = ((xs // 16 + ys // 16) % 2)[:, :, None]
+        texture = checks * np.array([30, 90, 200]) + (1 - checks) * np.array([250, 210, 60])
+    texture = np.clip(texture, 0, 255).astype(np.uint8)
+
+    mask = np.zeros((height, width), np.uint8)
+    w, h = width, height
+    if pants:
+        shape = [[0.25, 0.05], [0.75, 0.05], [0.85, 0.95], [0.56, 0.95], [0.5, 0.35], [0.44, 0.95], [0.15, 0.95]]
+    else:
+        shape = [[0.3, 0.05], [0.7, 0.05], [0.95, 0.25], [0.82, 0.4], [0.75, 0.32], [0.75, 0.95],
+                 [0.25, 0.95], [0.25, 0.32], [0.18, 0.4], [0.05, 0.25]]
+    cv2.fillPoly(mask, [(np.array(shape) * [w, h]).astype(np.int32)], 255)
+
+    if transparent:
+        garment = np.zeros((height, width, 4), np.uint8)
+        garment[:, :, :3] = texture
+        garment[:, :, 3] = mask
+        return garment
+    garment = np.full((height, width, 3), 255, np.uint8)
+    np.copyto(garment, texture, where=(mask > 0)[:, :, None])
+    return garment
+
+
+def synthetic_cases(seed=0):
+    """Seeded synthetic (name, person bytes, garment bytes, garment type) cases covering
+    orientations, sizes, backgrounds, patterns and garment formats"""
+    rng = np.random.default_rng(seed)
+    return [
+        ("synth-portrait-stripes",
+         encode(synthetic_person(768, 1024, rng, ((235, 235, 240), (200, 205, 215)), (70, 120, 60)), ".jpg"),
+         encode(synthetic_garment(600, 700, "stripes"), ".png"), "shirt"),
+        ("synth-landscape-plaid",
+         encode(synthetic_person(1600, 1200, rng, ((40, 45, 60), (15, 15, 20)), (200, 190, 170)), ".jpg"),
+         encode(synthetic_garment(900, 1000, "plaid"), ".jpg"), "top"),
+        ("synth-small-checks-alpha",
+         encode(synthetic_person(360, 480, rng, ((250, 250, 250), (230, 230, 230)), (90, 40, 120)), ".png"),
+         encode(synthetic_garment(400, 460, "checks", transparent=True), ".png"), "shirt"),
+        ("synth-pants",
+         encode(synthetic_person(900, 1200, rng, ((180, 200, 220), (120, 140, 160)), (150, 60, 50)), ".jpg"),
+         encode(synthetic_garment(500, 900, "plaid", pants=True), ".png"), "pants"),
+    ]
+
+
+def corpus():
+    """Every corpus pair as (name, person bytes, garment bytes, garment type)"""
+    cases = []
+    for name, person_name, cloth_name, garment_type in EXAMPLE_CASES:
+        person_path, cloth_path = EXAMPLES_DIR / person_name, EXAMPLES_DIR / cloth_name
+        if person_path.exists() and cloth_path.exists():
+            cases.append((name, person_path.read_bytes(), cloth_path.read_bytes(), garment_type))
+    return cases + synthetic_cases()
+
+
+def psnr(reference, candidate):
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+    return math.inf if mse == 0 else 10 * math.log10(255.0 ** 2 / mse)
+
+
+def ssim(reference, candidate):
+    from skimage.metrics import structural_similarity
+    return float(structural_similarity(reference, candidate, channel_axis=2, data_range=255))
+
+
+def environment_info():
+    """What the goldens depend on besides the code: models and library versions"""
+    from utils.enhanced_tryon import MEDIAPIPE_AVAILABLE
+    from utils.inference import REMBG_AVAILABLE
+    return {
+        "mediapipe": MEDIAPIPE_AVAILABLE,
+        "rembg": REMBG_AVAILABLE,
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+    }
+
+
+def quiet():
+    return contextlib.redirect_stdout(sys.stdout if _verbose else _DEVNULL)
+
+
+def init_config(env, verbose):
+    """Apply a configuration's environment and build its processor, once per worker process"""
+    global _processor, _verbose
+    os.environ.update(ISOLATION_ENV)
+    os.environ.update(env)
+    _verbose = verbose
+    with quiet():
+        from utils.engines import create_processor
+        from utils.thread_budget import apply_thread_budget
+
+        apply_thread_budget()
+        _processor = create_processor()
+
+
+def run_case(name, person_bytes, cloth_bytes, garment_type, profile, repeat):
+    """Output, per-run latencies and peak traced memory of one case"""
+    latencies = []
+    result = None
+    with quiet():
+        # One untimed run first so lazily built state (models per complexity, tables) is not counted
+        clear_processor_caches(_processor)
+        _processor.process_virtual_tryon(person_bytes, cloth_bytes, garment_type, "", quality=profile)
+        for _ in range(repeat):
+            clear_processor_caches(_processor)
+            start = time.perf_counter()
+            result, _ = _processor.process_virtual_tryon(person_bytes, cloth_bytes, garment_type, "",
+                                                         quality=profile)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        # Memory is measured on a separate run, since tracing slows allocation down
+        clear_processor_caches(_processor)
+        tracemalloc.start()
+        try:
+            _processor.process_virtual_tryon(person_bytes, cloth_bytes, garment_type, "", quality=profile)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, latencies, peak
+
+
+def run_config(task):
+    """Run every case under the worker's configuration; compare with or write the goldens"""
+    tiers, repeat, goldens_dir, update = task
+    goldens_dir = Path(goldens_dir)
+    manifest = {}
+    if not update:
+        manifest = json.loads((goldens_dir / "manifest.json").read_text())["cases"]
+
+    records = []
+    for name, person_bytes, cloth_bytes, garment_type in corpus():
+        for tier in tiers:
+            case_id = f"{name}__{tier}"
+            record = {"case": case_id}
+            try:
+                result, latencies, peak = run_case(name, person_bytes, cloth_bytes, garment_type,
+                                                   QUALITY_PROFILES[tier], repeat)
+                record.update(latency_ms=statistics.median(latencies), peak_traced_mb=peak / 2 ** 20)
+                result = np.ascontiguousarray(result[:, :, :3])
+
+                if update:
+                    cv2.imwrite(str(goldens_dir / f"{case_id}.png"), cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+                    record["shape"] = list(result.shape)
+                elif case_id not in manifest:
+                    record["error"] = "no golden (run with --update-goldens)"
+                else:
+                    golden = cv2.cvtColor(cv2.imread(str(goldens_dir / manifest[case_id]["file"])), cv2.COLOR_BGR2RGB)
+                    if golden.shape != result.shape:
+                        # e.g. a configuration that changes the working size
+                        result = cv2.resize(result, (golden.shape[1], golden.shape[0]), interpolation=cv2.INTER_AREA)
+                        record["resized"] = True
+                    record.update(psnr=psnr(golden, result), ssim=ssim(golden, result))
+            except Exception as e:
+                record["error"] = str(e)
+            records.append(record)
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return records, max_rss_mb, environment_info()
+
+
+def run_in_process(env, task, verbose):
+    """Run a configuration in its own spawned process"""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, initializer=init_config, initargs=(env, verbose)) as pool:
+        return pool.apply(run_config, (task,))
+
+
+def parse_config(spec):
+    """``name:KEY=VALUE,KEY=VALUE`` into (name, env)"""
+    name, _, assignments = spec.partition(":")
+    env = {}
+    for assignment in filter(None, assignments.split(",")):
+        key, sep, value = assignment.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"Expected KEY=VALUE in '{assignment}'")
+        env[key.strip()] = value.strip()
+    return name.strip(), env
+
+
+def fmt(value, spec):
+    if value is None:
+        return "-"
+    if value == math.inf:
+        return "inf"
+    return format(value, spec)
+
+
+def json_safe(value):
+    """Copy of a report with non-finite numbers (PSNR of identical outputs) as None"""
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def print_report(results, reference_latency, min_psnr, min_ssim):
+    print()
+    header = (f"{'config':<20}{'cases':>6}{'min PSNR':>10}{'mean PSNR':>11}{'min SSIM':>10}"
+              f"{'mean ms':>10}{'vs ref':>8}{'peak MB':>9}{'max RSS':>9}  status")
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        scored = [record for record in result["records"] if "psnr" in record]
+        psnrs = [record["psnr"] for record in scored]
+        finite = [value for value in psnrs if value != math.inf]
+        latencies = [record["latency_ms"] for record in result["records"] if "latency_ms" in record]
+        mean_ms = statistics.mean(latencies) if latencies else None
+        speedup = reference_latency / mean_ms if reference_latency and mean_ms else None
+        peaks = [record["peak_traced_mb"] for record in result["records"] if "peak_traced_mb" in record]
+        print(f"{name:<20}{len(result['records']):>6}"
+              f"{fmt(min(psnrs) if psnrs else None, '.1f'):>10}"
+              f"{fmt(statistics.mean(finite) if finite else (math.inf if psnrs else None), '.1f'):>11}"
+              f"{fmt(min(record['ssim'] for record in scored) if scored else None, '.4f'):>10}"
+              f"{fmt(mean_ms, '.1f'):>10}{fmt(speedup, '.2f') + 'x' if speedup else '-':>8}"
+              f"{fmt(max(peaks) if peaks else None, '.1f'):>9}{result['max_rss_mb']:>9.0f}"
+              f"  {'PASS' if not result['failures'] else 'FAIL'}")
+
+    for name, result in results.items():
+        for record, reason in result["failures"]:
+            print(f"❌ {name} {record['case']}: {reason}")
+    print(f"\nThresholds: PSNR >= {min_psnr:g} dB, SSIM >= {min_ssim:g}. Latency is the mean over cases "
+          "of each case's median uncached run; peak MB is traced Python/numpy allocations.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare try-on configurations on fidelity and speed")
+    parser.add_argument("--goldens", default=str(DEFAULT_GOLDENS_DIR), help="Golden output directory")
+    parser.add_argument("--update-goldens", action="store_true",
+                        help="Record golden outputs with the reference configuration")
+    parser.add_argument("--configs", default=",".join(CANDIDATES),
+                        help=f"Comma-separated presets to evaluate ({', '.join(CANDIDATES)})")
+    parser.add_argument("--config", action="append", default=[], type=parse_config, metavar="NAME:KEY=VALUE,...",
+                        help="Extra configuration as environment overrides (repeatable)")
+    parser.add_argument("--tiers", default=",".join(QUALITY_PROFILES), help="Comma-separated quality tiers")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case")
+    parser.add_argument("--min-psnr", type=float, default=40.0, help="Fail below this PSNR (dB)")
+    parser.add_argument("--min-ssim", type=float, default=0.99, help="Fail below this SSIM")
+    parser.add_argument("--json", help="Also write the full report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's per-image logs")
+    args = parser.parse_args()
+
+    tiers = [tier.strip() for tier in args.tiers.split(",") if tier.strip()]
+    unknown = [tier for tier in tiers if tier not in QUALITY_PROFILES]
+    if unknown:
+        parser.error(f"Unknown tiers {unknown}; expected some of {list(QUALITY_PROFILES)}")
+    goldens_dir = Path(args.goldens)
+
+    if args.update_goldens:
+        goldens_dir.mkdir(parents=True, exist_ok=True)
+        print(f"📸 Recording goldens for {len(corpus())} pairs x {len(tiers)} tiers in {goldens_dir}")
+        records, max_rss_mb, environment = run_in_process(CANDIDATES["reference"],
+                                                          (tiers, 1, str(goldens_dir), True), args.verbose)
+        failed = [record for record in records if "error" in record]
+        for record in failed:
+            print(f"❌ {record['case']}: {record['error']}")
+        manifest = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": environment,
+            "cases": {record["case"]: {"file": f"{record['case']}.png", "shape": record["shape"],
+                                       "latency_ms": round(record["latency_ms"], 1)}
+                      for record in records if "error" not in record},
+        }
+        (goldens_dir / "manifest.json").write_text(json.dumps(manifest, indent=2) + "\n")
+        print(f"✅ {len(manifest['cases'])} goldens written")
+        sys.exit(1 if failed else 0)
+
+    manifest_path = goldens_dir / "manifest.json"
+    if not manifest_path.exists():
+        raise SystemExit(f"No goldens in {goldens_dir}; record them first with --update-goldens")
+    golden_environment = json.loads(manifest_path.read_text())["environment"]
+
+    configs = {}
+    for name in filter(None, (name.strip() for name in args.configs.split(","))):
+        if name not in CANDIDATES:
+            parser.error(f"Unknown preset '{name}'; expected some of {list(CANDIDATES)}")
+        configs[name] = CANDIDATES[name]
+    configs.update(args.config)
+    # The reference run gives the latency baseline and checks the goldens still reproduce
+    configs = {"reference": CANDIDATES["reference"], **configs}
+
+    results = {}
+    for name, env in configs.items():
+        print(f"⏱️  {name} {env or ''}")
+        records, max_rss_mb, environment = run_in_process(env, (tiers, args.repeat, str(goldens_dir), False),
+                                                          args.verbose)
+        if environment != golden_environment:
+            print(f"⚠️ Goldens were recorded with {golden_environment}, this run has {environment}")
+        failures = []
+        for record in records:
+            if "error" in record:
+                failures.append((record, record["error"]))
+            elif record["psnr"] < args.min_psnr or record["ssim"] < args.min_ssim:
+                failures.append((record, f"PSNR {fmt(record['psnr'], '.1f')} dB, SSIM {record['ssim']:.4f}"))
+        results[name] = {"env": env, "records": records, "max_rss_mb": max_rss_mb, "failures": failures}
+
+    reference = [record["latency_ms"] for record in results["reference"]["records"] if "latency_ms" in record]
+    print_report(results, statistics.mean(reference) if reference else None, args.min_psnr, args.min_ssim)
+
+    if args.json:
+        report = {name: {"env": result["env"], "max_rss_mb": result["max_rss_mb"],
+                         "records": result["records"], "passed": not result["failures"]}
+                  for name, result in results.items()}
+        # JSON has no infinity; identical outputs are reported as null PSNR
+        Path(args.json).write_text(json.dumps(json_safe(report), indent=2, default=str, allow_nan=False) + "\n")
+    sys.exit(1 if any(result["failures"] for result in results.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,13 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from pathlib import Path
 import sys
 import threading
 import time
+from typing import Optional
 
 # Add detailed logging for debugging
 print("🚀 Starting Virtual Try-On API initialization...")
@@ -95,9 +96,23 @@ def startup_check():
 
 @app.get("/health")
 def health_check():
+    try:
+        from routers import tryon
+        from utils.thread_budget import thread_layout
+        degradation = tryon.load_controller.snapshot()
+        admission = tryon.admission.snapshot()
+        threads = thread_layout()
+    except Exception:
+        degradation = None
+        admission = None
+        threads = None
+    
     return {
         "status": "healthy", 
         "mediapipe": "ready" if mediapipe_ready else "initializing" if mediapipe_initializing else "not_ready",
+        "degradation": degradation,
+        "admission": admission,
+        "threads": threads,
         "frontend_built": frontend_build_path.exists(),
         "frontend_path": str(frontend_build_path),
         "port": os.environ.get("PORT", "Not set"),
@@ -112,33 +127,36 @@ def health_check():
 def test_endpoint():
     return {"message": "Test endpoint working", "timestamp": "2024-01-16"}
 
-# Catch-all route to serve frontend routes
-@app.get("/{full_path:path}")
-def serve_frontend(full_path: str, request: Request):
-    # Skip API routes
-    if full_path.startswith("api/"):
-        return {"error": "API endpoint not found"}
-    
-    # Try to serve static files first
-    static_file_path = frontend_build_path / full_path
-    if static_file_path.exists() and static_file_path.is_file():
-        return FileResponse(str(static_file_path))
-    
-    # For SPA routing, serve index.html for all other routes
-    index_path = frontend_build_path / "index.html"
-    if index_path.exists():
-        return FileResponse(str(index_path))
-    
-    # Fallback for when frontend is not built
-    return {
-        "error": "Frontend not available",
-        "message": "Please ensure the frontend is built and available",
-        "path_requested": full_path,
-        "debug_info": {
-            "frontend_build_path": str(frontend_build_path),
-            "frontend_exists": frontend_build_path.exists()
-        }
-    }
+def require_admin(token):
+    """Admin endpoints exist only when TRYON_ADMIN_TOKEN is set, and need it in X-Admin-Token"""
+    from utils.profiling import get_profile_store
+    store = get_profile_store()
+    if not store.settings.admin_token:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if not store.authorized(token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    return store
+
+@app.get("/admin/profiles")
+def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Stored request profiles, newest first"""
+    store = require_admin(x_admin_token)
+    return {"profiling": store.stats(), "profiles": store.list()}
+
+@app.get("/admin/profiles/{profile_id}")
+def get_profile(profile_id: str, format: str = "speedscope", x_admin_token: Optional[str] = Header(None)):
+    """One profile as speedscope JSON or collapsed stacks (format=collapsed) for flamegraph tools"""
+    from utils.profiling import collapsed_stacks, speedscope
+    store = require_admin(x_admin_token)
+    profile = store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No stored profile {profile_id}")
+    if format == "collapsed":
+        return PlainTextResponse(collapsed_stacks(profile))
+    if format != "speedscope":
+        raise HTTPException(status_code=400, detail="format must be 'speedscope' or 'collapsed'")
+    return JSONResponse(speedscope(profile), headers={
+        "Content-Disposition": f'attachment; filename="tryon-{profile_id}.speedscope.json"'})
 
 # Allow frontend to connect
 app.add_middleware(
@@ -177,6 +195,34 @@ except Exception as e:
     import traceback
     traceback.print_exc()
 
+# Catch-all route to serve frontend routes (after the API router so it does not shadow GET /api/*)
+@app.get("/{full_path:path}")
+def serve_frontend(full_path: str, request: Request):
+    # Skip API routes
+    if full_path.startswith("api/"):
+        return {"error": "API endpoint not found"}
+    
+    # Try to serve static files first
+    static_file_path = frontend_build_path / full_path
+    if static_file_path.exists() and static_file_path.is_file():
+        return FileResponse(str(static_file_path))
+    
+    # For SPA routing, serve index.html for all other routes
+    index_path = frontend_build_path / "index.html"
+    if index_path.exists():
+        return FileResponse(str(index_path))
+    
+    # Fallback for when frontend is not built
+    return {
+        "error": "Frontend not available",
+        "message": "Please ensure the frontend is built and available",
+        "path_requested": full_path,
+        "debug_info": {
+            "frontend_build_path": str(frontend_build_path),
+            "frontend_exists": frontend_build_path.exists()
+        }
+    }
+
 # Server configuration for deployment
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Gemini generateContent endpoint.
+
+Answers image-generation requests by echoing the first input image back as a
+PNG, after a configurable latency and with a configurable share of 429/503
+errors, so the generative engine's pooling, retries, deduplication and budget
+fallback can be exercised without network access or API quota.
+
+Usage:
+    python mock_gemini_server.py --port 8765 --latency-ms 800 --jitter-ms 200 --error-rate 0.1
+    TRYON_ENGINE=gemini TRYON_GEMINI_BASE_URL=http://127.0.0.1:8765 python main.py
+"""
+import argparse
+import asyncio
+import base64
+import random
+from collections import Counter
+
+import cv2
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+               seed: int = 0) -> FastAPI:
+    app = FastAPI(title="Mock Gemini API")
+    rng = random.Random(seed)
+    counts = Counter()
+
+    @app.post("/v1beta/models/{model_action}")
+    async def generate_content(model_action: str, request: Request):
+        counts["requests"] += 1
+        await asyncio.sleep(max(0.0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000)
+
+        if rng.random() < error_rate:
+            counts["errors"] += 1
+            status = rng.choice((429, 503))
+            return JSONResponse({"error": {"code": status, "message": "Mock failure"}}, status_code=status,
+                                headers={"Retry-After": "0"} if status == 429 else None)
+
+        body = await request.json()
+        parts = body["contents"][0]["parts"]
+        images = [part["inline_data"]["data"] for part in parts if "inline_data" in part]
+        if not images:
+            return JSONResponse({"error": {"code": 400, "message": "No input image"}}, status_code=400)
+
+        # Echo the person image, re-encoded as PNG the way the real API returns images
+        person = cv2.imdecode(np.frombuffer(base64.b64decode(images[0]), np.uint8), cv2.IMREAD_COLOR)
+        data = base64.b64encode(cv2.imencode(".png", person)[1].tobytes()).decode("ascii")
+        counts["generated"] += 1
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": [
+                    {"text": f"Mock try-on from {model_action.split(':')[0]}."},
+                    {"inlineData": {"mimeType": "image/png", "data": data}},
+                ]},
+                "finishReason": "STOP",
+            }]
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return dict(counts)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Gemini generateContent server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="Mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform jitter around the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 429/503")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latency jitter and errors")
+    args = parser.parse_args()
+
+    app = create_app(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
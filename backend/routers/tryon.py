@@ -1,9 +1,30 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, File, Form, Header, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.websockets import WebSocketState
+from functools import partial
 from utils.base64_helpers import array_buffer_to_base64
 from utils.enhanced_tryon import EnhancedVirtualTryOnProcessor
+from utils.engines import create_processor
+from utils.quality import get_quality_profile
+from utils.output_size import parse_output_spec
+from utils.load_control import controller_from_env
+from utils.admission import AdmissionRejected, admission_from_env, sniff_dimensions, working_pixels
+from utils.scheduler import PREMIUM_CLASS, STANDARD_CLASS, JobTicket, job_cost, premium_keys_from_env, scheduler_from_env
+from utils.cache import image_digest
+from utils.live_session import LatestFrame, LiveTryOnSession, live_settings_from_env
+from utils.profiling import get_profile_store, run_profiled
+from utils.broker import LocalBroker, broker_from_env, broker_settings_from_env
+from utils.worker import TryOnWorker, submit_tryon, tryon_payload
+from typing import Optional
+from utils.inference import inference_stats
+from utils.buffer_pool import current_rss_mb, get_buffer_pool
+from utils.thread_budget import apply_thread_budget, get_live_executor, get_request_executor
 from dotenv import load_dotenv
+import asyncio
+import json
 import os
+import threading
+import time
 import traceback
 
 try:
@@ -13,6 +34,9 @@ except Exception as e:
 
 router = APIRouter()
 
+# Split the core budget between request workers and library thread pools before any model loads
+thread_budget = apply_thread_budget()
+
 @router.get("/try-on")
 async def try_on_test():
     """Test endpoint to verify router is working"""
@@ -25,9 +49,70 @@ def get_try_on_processor():
     """Get the try-on processor, initializing it if needed"""
     global try_on_processor
     if try_on_processor is None:
-        try_on_processor = EnhancedVirtualTryOnProcessor()
+        # TRYON_ENGINE picks the processor ("enhanced" by default, "lite" or "legacy")
+        try_on_processor = create_processor()
     return try_on_processor
 
+# With TRYON_BROKER set the API only enqueues jobs and collects results; compute workers
+# (tryon_worker.py, or threads in this process for the local broker) do the processing
+job_broker = broker_from_env()
+broker_settings = broker_settings_from_env()
+broker_stop = threading.Event()
+local_workers = []
+request_slots = thread_budget.request_workers if job_broker is None else \
+    int(os.getenv("TRYON_BROKER_MAX_INFLIGHT", str(4 * thread_budget.request_workers)))
+
+def ensure_local_workers():
+    """Start the in-process workers of the local broker on first use"""
+    if isinstance(job_broker, LocalBroker) and not local_workers:
+        processor = get_try_on_processor()
+        for _ in range(thread_budget.request_workers):
+            worker = TryOnWorker(job_broker, processor, broker_settings)
+            worker.start(broker_stop)
+            local_workers.append(worker)
+
+# Steps requests down to cheaper settings when the latency SLO is at risk
+load_controller = controller_from_env(request_slots)
+
+# Caps the estimated memory of in-flight requests; the rest queue in arrival order
+admission = admission_from_env()
+
+# Orders queued requests by estimated cost so small uploads are not stuck behind huge ones
+scheduler = scheduler_from_env(request_slots)
+premium_keys = premium_keys_from_env()
+
+# Live streams each keep a core busy, so only a few run at once
+live_settings = live_settings_from_env()
+# Each stream keeps about one live worker busy; streams never borrow request workers
+max_live_streams = int(os.getenv("TRYON_LIVE_MAX_STREAMS", str(thread_budget.live_workers)))
+live_streams = 0
+
+# JPEG quality of progressive previews
+preview_quality = int(os.getenv("TRYON_PREVIEW_QUALITY", "70"))
+
+def sse_event(event: str, data: dict) -> str:
+    """One server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Opt-in request profiles (admin header or random sampling), served from /admin/profiles
+profile_store = get_profile_store()
+
+@router.get("/metrics")
+async def try_on_metrics():
+    """Load-adaptive degradation state, batching and memory counters"""
+    return {
+        "degradation": load_controller.snapshot(),
+        "admission": admission.snapshot(),
+        "scheduler": scheduler.snapshot(),
+        "inference": inference_stats(),
+        "caches": try_on_processor.cache_stats() if try_on_processor is not None else None,
+        "buffer_pool": get_buffer_pool().stats(),
+        "live": {"streams": live_streams, "max_streams": max_live_streams},
+        "profiling": profile_store.stats(),
+        "broker": job_broker.stats() if job_broker is not None else None,
+        "rss_mb": current_rss_mb(),
+    }
+
 @router.post("/try-on")
 async def try_on(
     person_image: UploadFile = File(...),
@@ -37,11 +122,32 @@ async def try_on(
     gender: str = Form(""),
     garment_type: str = Form(""),
     style: str = Form(""),
+    quality: str = Form("best"),
+    width: int = Form(0),
+    height: int = Form(0),
+    fit: str = Form("contain"),
+    crop_to_person: bool = Form(False),
+    x_api_key: Optional[str] = Header(None),
+    x_tryon_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
 ):
-    print(f"Received try-on request with garment_type: {garment_type}, instructions: {instructions}")
+    print(f"Received try-on request with garment_type: {garment_type}, instructions: {instructions}, quality: {quality}")
     print(f"Person image: {person_image.filename}, size: {person_image.size if hasattr(person_image, 'size') else 'unknown'}")
     print(f"Cloth image: {cloth_image.filename}, size: {cloth_image.size if hasattr(cloth_image, 'size') else 'unknown'}")
     try:
+        # Resolve the quality/latency tier
+        try:
+            profile = get_quality_profile(quality)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Size the result is composited and encoded at (the display size), instead of the full frame
+        try:
+            output = parse_output_spec(width, height, fit, crop_to_person)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         # Validate file types and sizes
         MAX_IMAGE_SIZE_MB = 10
         ALLOWED_MIME_TYPES = {
@@ -72,37 +178,311 @@ async def try_on(
         if size_in_mb_for_cloth_image > MAX_IMAGE_SIZE_MB:
             raise HTTPException(status_code=400, detail="Image exceeds 10MB size limit for cloth_image")
 
-        # Get the try-on processor
-        processor = get_try_on_processor()
+        # Get the try-on processor (none in the API when a broker hands the work to workers)
+        processor = get_try_on_processor() if job_broker is None else None
         
-        # Process virtual try-on using the enhanced processor
-        print("Starting virtual try-on processing...")
-        print(f"Person image size: {len(person_bytes)} bytes")
-        print(f"Cloth image size: {len(cloth_bytes)} bytes")
-        print(f"Garment type: {garment_type}")
-        print(f"Instructions: {instructions}")
+        # Pick cheaper settings if the latency SLO is at risk. The request counts towards the
+        # queue depth from here, including while it waits for memory below
+        decision = load_controller.begin()
+        ticket = None
+        loop = asyncio.get_running_loop()
+        try:
+            effective_profile = load_controller.apply(profile, decision)
+            
+            # Wait until the decoded images fit the memory budget at the working size this request runs at
+            # (degradation included); the upload size says little about it
+            sizes = [sniff_dimensions(person_bytes), sniff_dimensions(cloth_bytes)]
+            try:
+                ticket = await admission.acquire(
+                    admission.estimate([person_bytes, cloth_bytes], effective_profile.max_side, sizes))
+            except AdmissionRejected as e:
+                raise HTTPException(status_code=e.status_code, detail=str(e))
+            
+            # Job cost for shortest-job-first scheduling: working pixels, discounted for cached analyses.
+            # Both follow the settings the pipeline will actually run with, degradation included.
+            # Hashing the uploads and asking the shared cache tier block, so they run off the event loop
+            person_cached, garment_cached = (False, False)
+            if processor is not None:
+                person_cached, garment_cached = await loop.run_in_executor(
+                    None, lambda: processor.cached_analyses(image_digest(person_bytes), image_digest(cloth_bytes),
+                                                            effective_profile))
+            cost = job_cost(working_pixels(sizes[0], len(person_bytes), effective_profile.max_side),
+                            working_pixels(sizes[1], len(cloth_bytes), effective_profile.max_side),
+                            person_cached, garment_cached)
+            job_class = PREMIUM_CLASS if x_api_key and x_api_key in premium_keys else STANDARD_CLASS
+            
+            headers = load_controller.headers(decision)
+            headers.update(admission.headers(ticket))
+            headers["X-TryOn-Quality"] = profile.name
+        except BaseException:
+            # render() releases the request's slots once it runs; until then they are released here
+            load_controller.finish()
+            if ticket is not None:
+                admission.release(ticket)
+            raise
         
-        result_image, description = processor.process_virtual_tryon(
-            person_bytes, 
-            cloth_bytes, 
-            garment_type, 
-            instructions
-        )
+        timings = {}
+        request_profile = None
         
-        print(f"Processing completed. Result image shape: {result_image.shape}")
-        print(f"Description: {description}")
+        async def render(on_preview=None):
+            """Run the try-on and encode the result; releases the request's slots when done"""
+            nonlocal request_profile
+            total_ms = None
+            job = None
+            # Network-bound engines take no scheduler slot: they would hold it through the remote
+            # call. Their local fallback and the encoding still run on the bounded request executor
+            remote = hasattr(processor, "process_virtual_tryon_async")
+            try:
+                if remote:
+                    scheduled = JobTicket(job_class, cost, 0.0)
+                else:
+                    job = scheduled = await scheduler.acquire(cost, job_class)
+                start = time.perf_counter()
+                # Profiles cover the work done on this process's threads, so not generative engines
+                if processor is not None and not remote:
+                    request_profile = profile_store.begin(x_tryon_profile, x_admin_token, {
+                        "garment_type": garment_type,
+                        "quality": effective_profile.name,
+                        "degradation": decision.level_name,
+                        "person_size": sizes[0],
+                        "garment_size": sizes[1],
+                    })
+                
+                # Process virtual try-on using the enhanced processor
+                print("Starting virtual try-on processing...")
+                print(f"Person image size: {len(person_bytes)} bytes")
+                print(f"Cloth image size: {len(cloth_bytes)} bytes")
+                print(f"Garment type: {garment_type}")
+                print(f"Instructions: {instructions}")
+                print(f"Degradation level: {decision.level_name}")
+                print(f"Memory estimate: {ticket.cost / 2 ** 20:.1f} MB (waited {ticket.wait_ms:.0f} ms)")
+                print(f"Job cost: {cost:.2f} MP ({scheduled.job_class}, cached person={person_cached} "
+                      f"garment={garment_cached}, queued {scheduled.wait_ms:.0f} ms)")
+                
+                if job_broker is not None:
+                    # A worker runs the job and returns the encoded result; previews are not relayed
+                    ensure_local_workers()
+                    try:
+                        outcome = await submit_tryon(job_broker, tryon_payload(
+                            person_bytes, cloth_bytes, garment_type, instructions, effective_profile, output),
+                            broker_settings)
+                    except asyncio.TimeoutError as e:
+                        raise HTTPException(status_code=504, detail=str(e))
+                    timings.update(outcome["timings"])
+                    print(f"Processed by worker {outcome['worker']}")
+                    total_ms = (time.perf_counter() - start) * 1000
+                    return outcome["image"], outcome["text"], scheduler.headers(scheduled)
+                
+                if remote:
+                    # Network-bound engines wait on their own loop instead of holding a worker thread
+                    result_image, description = await processor.process_virtual_tryon_async(
+                        person_bytes, cloth_bytes, garment_type, instructions,
+                        timings=timings, quality=effective_profile, output=output)
+                else:
+                    # Only the enhanced pipeline renders previews
+                    extra = {"on_preview": on_preview} if on_preview and isinstance(
+                        processor, EnhancedVirtualTryOnProcessor) else {}
+                    result_image, description = await loop.run_in_executor(
+                        get_request_executor(),
+                        partial(
+                            run_profiled,
+                            request_profile,
+                            processor.process_virtual_tryon,
+                            person_bytes, 
+                            cloth_bytes, 
+                            garment_type, 
+                            instructions,
+                            timings=timings,
+                            quality=effective_profile,
+                            output=output,
+                            **extra,
+                        ),
+                    )
+                
+                print(f"Processing completed. Result image shape: {result_image.shape}")
+                print(f"Description: {description}")
+                
+                # Convert result to base64
+                image_url = await loop.run_in_executor(
+                    get_request_executor(),
+                    partial(run_profiled, request_profile, processor.numpy_to_base64, result_image,
+                            effective_profile.output_format, effective_profile.output_quality),
+                )
+                total_ms = (time.perf_counter() - start) * 1000
+                return image_url, description, scheduler.headers(scheduled)
+            finally:
+                if job is not None:
+                    scheduler.release(job)
+                    if request_profile is not None and \
+                            not profile_store.finish(request_profile, (time.perf_counter() - start) * 1000):
+                        request_profile = None
+                load_controller.finish(total_ms, timings)
+                admission.release(ticket)
         
-        # Convert result to base64
-        image_url = processor.numpy_to_base64(result_image)
+        if "text/event-stream" in (accept or ""):
+            # Progressive delivery: a preview event as soon as the analysis is done, then the result.
+            # The render runs as its own task so the request's slots are released even if the
+            # client goes away mid-stream.
+            previews = asyncio.Queue()
+            
+            def on_preview(image):
+                preview_url = processor.numpy_to_base64(image, "JPEG", preview_quality)
+                loop.call_soon_threadsafe(previews.put_nowait, {
+                    "image": preview_url,
+                    "width": image.shape[1],
+                    "height": image.shape[0],
+                })
+            
+            task = asyncio.ensure_future(render(on_preview))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            
+            async def events():
+                waiter = asyncio.ensure_future(previews.get())
+                try:
+                    while True:
+                        done, _ = await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                        if waiter not in done:
+                            break
+                        yield sse_event("preview", waiter.result())
+                        waiter = asyncio.ensure_future(previews.get())
+                    image_url, description, _ = await task
+                    result = {
+                        "image": image_url,
+                        "text": description,
+                        "quality": profile.name,
+                        "degradation": decision.level_name,
+                    }
+                    if request_profile is not None:
+                        result["profile_id"] = request_profile.id
+                    yield sse_event("result", result)
+                except Exception as e:
+                    print(f"Error in /api/try-on stream: {e}")
+                    yield sse_event("error", {"detail": f"Internal Server Error: {str(e)}"})
+                finally:
+                    waiter.cancel()
+            
+            headers["Cache-Control"] = "no-cache"
+            return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
         
+        image_url, description, scheduler_headers = await render()
+        headers.update(scheduler_headers)
+        if request_profile is not None:
+            headers["X-TryOn-Profile-Id"] = request_profile.id
         return JSONResponse(
             content={
                 "image": image_url,
                 "text": description,
-            }
+                "quality": profile.name,
+                "degradation": decision.level_name,
+            },
+            headers=headers,
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in /api/try-on endpoint: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+@router.websocket("/try-on/stream")
+async def try_on_stream(
+    websocket: WebSocket,
+    garment_type: str = "",
+    quality: str = "fast",
+    target_fps: Optional[float] = None,
+):
+    """Live try-on over a WebSocket.
+    
+    The first binary message is the garment image; every later one is a video frame
+    (JPEG/PNG/WEBP). Each processed frame is answered with a JSON text message holding
+    its stats, followed by the composited frame as JPEG bytes. Frames that arrive while
+    one is being processed are dropped in favour of the newest, and the stream is paced
+    to ``target_fps``.
+    """
+    global live_streams
+    await websocket.accept()
+    try:
+        profile = get_quality_profile(quality)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    if job_broker is not None and not isinstance(job_broker, LocalBroker):
+        # The API tier loads no models with a shared broker, and frames are too latency-bound to queue
+        await websocket.close(code=1008, reason="Live try-on is not available with a job broker")
+        return
+    # Generative engines are far too slow per frame; stream with their local fallback
+    processor = getattr(get_try_on_processor(), "fallback", get_try_on_processor())
+    if not isinstance(processor, EnhancedVirtualTryOnProcessor):
+        await websocket.close(code=1008, reason="Live try-on needs the enhanced engine")
+        return
+    if live_streams >= max_live_streams:
+        # 1013: try again later
+        await websocket.close(code=1013, reason="Too many live streams")
+        return
+    
+    live_streams += 1
+    session = None
+    frames = LatestFrame()
+    loop = asyncio.get_running_loop()
+    
+    async def receive_frames():
+        try:
+            while True:
+                frames.put(await websocket.receive_bytes())
+        except (WebSocketDisconnect, RuntimeError, KeyError):
+            pass
+        finally:
+            frames.close()
+    
+    receiver = None
+    try:
+        garment_bytes = await websocket.receive_bytes()
+        settings = dict(live_settings)
+        if target_fps:
+            settings["target_fps"] = target_fps
+        session = await loop.run_in_executor(
+            get_live_executor(),
+            partial(LiveTryOnSession, processor, garment_bytes, garment_type, profile, **settings),
+        )
+        print(f"🎥 Live stream started: {garment_type or 'garment'}, {profile.name}, "
+              f"{session.target_fps:g} fps target")
+        await websocket.send_json({"type": "ready", "target_fps": session.target_fps, "max_side": session.max_side})
+        
+        receiver = asyncio.create_task(receive_frames())
+        interval = 1.0 / session.target_fps
+        next_frame_at = time.perf_counter()
+        while True:
+            # Wait out the rest of the frame interval; frames arriving meanwhile replace each other
+            delay = next_frame_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            frame_bytes = await frames.get()
+            if frame_bytes is None:
+                break
+            next_frame_at = time.perf_counter() + interval
+            
+            try:
+                encoded, stats = await loop.run_in_executor(
+                    get_live_executor(), partial(session.process_frame, frame_bytes))
+            except ValueError as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                continue
+            stats.update(type="frame", received=frames.received, dropped=frames.dropped)
+            await websocket.send_json(stats)
+            await websocket.send_bytes(encoded)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Error in /api/try-on/stream: {e}")
+        traceback.print_exc()
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close(code=1011, reason="Internal Server Error")
+    finally:
+        if receiver is not None:
+            receiver.cancel()
+        if session is not None:
+            print(f"🎥 Live stream ended: {session.frames} frames, {frames.dropped} dropped, "
+                  f"{session.achieved_fps()} fps")
+            session.close()
+        live_streams -= 1
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Try-on compute worker.
+
+Pulls try-on jobs from the job broker that the API enqueues into, runs them on
+a local processor and posts the encoded results back. Run as many of these as
+the hardware allows; the API process then only handles HTTP.
+
+Usage:
+    TRYON_BROKER=sqlite TRYON_BROKER_PATH=/var/tmp/tryon-broker.sqlite python main.py
+    python tryon_worker.py --path /var/tmp/tryon-broker.sqlite --threads 2
+
+Leases are kept alive by heartbeats; a worker that dies mid-job stops
+heartbeating, and after TRYON_BROKER_VISIBILITY_SECONDS the job is handed to
+another worker (up to TRYON_BROKER_MAX_ATTEMPTS attempts). SIGTERM/SIGINT
+finish the jobs in hand and exit.
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+from pathlib import Path
+
+# Add the current directory to Python path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from utils.engines import ENGINES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run try-on jobs from the job broker")
+    parser.add_argument("--path", default=None,
+                        help="SQLite broker database (default: TRYON_BROKER_PATH)")
+    parser.add_argument("--engine", choices=ENGINES, default=None,
+                        help="Try-on engine (default: TRYON_ENGINE or enhanced)")
+    parser.add_argument("--threads", type=int, default=1, help="Jobs run concurrently by this process")
+    parser.add_argument("--name", default=None, help="Worker name recorded on leased jobs")
+    args = parser.parse_args()
+
+    threads = max(1, args.threads)
+    os.environ.setdefault("TRYON_REQUEST_WORKERS", str(threads))
+
+    from utils.broker import broker_settings_from_env, create_broker
+    from utils.engines import create_processor
+    from utils.thread_budget import apply_thread_budget
+    from utils.worker import TryOnWorker
+
+    apply_thread_budget()
+    broker = create_broker("sqlite", args.path)
+    settings = broker_settings_from_env()
+    processor = create_processor(args.engine)
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print("🛑 Stopping after the jobs in hand...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    workers = [
+        TryOnWorker(broker, processor, settings, f"{args.name}-{i}" if args.name else None)
+        for i in range(threads)
+    ]
+    print(f"👷 {threads} worker thread(s) on {broker.path} (visibility {settings.visibility_timeout:g}s, "
+          f"heartbeat {settings.heartbeat_interval:g}s, {settings.max_attempts} attempts)")
+    running = [worker.start(stop) for worker in workers]
+    while any(thread.is_alive() for thread in running):
+        for thread in running:
+            thread.join(timeout=0.5)
+
+    completed = sum(worker.counts["completed"] for worker in workers)
+    failed = sum(worker.counts["failed"] for worker in workers)
+    print(f"👋 Worker stopped: {completed} jobs completed, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import asyncio
+import io
+import os
+import struct
+import time
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+# Measured peak of the try-on pipeline per decoded working pixel (person + garment),
+# covering the RGB/RGBA frames, masks, blend buffers and the encoded output
+DEFAULT_BYTES_PER_PIXEL = 12
+# A full-resolution BGR decode that is downscaled to the working size straight away
+DECODE_BYTES_PER_PIXEL = 3
+# Pixels assumed per upload byte when the header cannot be read
+UNKNOWN_PIXELS_PER_BYTE = 4
+
+# JPEG start-of-frame markers carry the image size (C4, C8 and CC are other segments)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+def _jpeg_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Walk JPEG segments up to the first start-of-frame"""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+def _webp_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read the canvas size from a VP8, VP8L or VP8X chunk"""
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = struct.unpack("<I", data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def sniff_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) of an encoded image from its header, without decoding pixels"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:2] == b"\xff\xd8":
+        size = _jpeg_dimensions(data)
+        if size:
+            return size
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        size = _webp_dimensions(data)
+        if size:
+            return size
+
+    # Other formats: PIL only parses the header on open
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def working_pixels(size: Optional[Tuple[int, int]], nbytes: int, max_side: Optional[int] = None) -> float:
+    """Pixels the pipeline works on for one upload, after the working-size cap"""
+    if size is None:
+        return nbytes * UNKNOWN_PIXELS_PER_BYTE
+    width, height = size
+    scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+    return width * height * scale * scale
+
+
+class AdmissionRejected(Exception):
+    """A request that cannot be admitted, with the HTTP status to answer it with"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AdmissionTicket(NamedTuple):
+    """Memory reserved for one admitted request"""
+    cost: int
+    wait_ms: float
+
+
+class MemoryAdmission:
+    """Admits try-on requests while their estimated memory fits a budget.
+
+    Each request's cost comes from the header-sniffed pixel counts of its uploads.
+    Requests that do not fit wait in a FIFO queue, so a large request is never
+    starved by smaller ones behind it. A request larger than the whole budget is
+    rejected outright. Must be used from the event loop that serves the requests.
+    """
+
+    def __init__(self, budget_bytes: int, timeout_seconds: float = 30.0,
+                 bytes_per_pixel: float = DEFAULT_BYTES_PER_PIXEL):
+        self.budget_bytes = budget_bytes
+        self.timeout_seconds = timeout_seconds
+        self.bytes_per_pixel = bytes_per_pixel
+        self.in_use = 0
+        self.peak_in_use = 0
+        self._waiters: Deque[List] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Requests admitted after queueing, and their total wait
+        self.waited = 0
+        self.total_wait_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def estimate(self, images: List[bytes], max_side: Optional[int] = None,
+                 sizes: Optional[List[Optional[Tuple[int, int]]]] = None) -> int:
+        """Estimated peak bytes for processing ``images`` at the given working size.
+
+        ``sizes`` are the images' already-sniffed dimensions, if the caller has them.
+        """
+        if sizes is None:
+            sizes = [sniff_dimensions(data) for data in images]
+        total = 0.0
+        for data, size in zip(images, sizes):
+            if size is None:
+                print("⚠️ Could not read image dimensions, estimating from upload size")
+            pixels = working_pixels(size, len(data), max_side)
+            total += pixels * self.bytes_per_pixel
+            if size is not None and pixels < size[0] * size[1]:
+                # The full-size decode exists briefly before the downscale
+                total += size[0] * size[1] * DECODE_BYTES_PER_PIXEL
+        return int(total)
+
+    async def acquire(self, cost: int) -> AdmissionTicket:
+        """Reserve ``cost`` bytes, waiting in line until they fit the budget"""
+        if not self.enabled:
+            return AdmissionTicket(0, 0.0)
+        if cost > self.budget_bytes:
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"Images too large to process: needs ~{cost / 2 ** 20:.0f} MB, "
+                f"budget is {self.budget_bytes / 2 ** 20:.0f} MB", 413)
+
+        if not self._waiters and self.in_use + cost <= self.budget_bytes:
+            self._admit(cost)
+            return AdmissionTicket(cost, 0.0)
+
+        start = time.perf_counter()
+        waiter = [cost, asyncio.get_running_loop().create_future()]
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter[1], self.timeout_seconds)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # Admitted at the same moment; give the reservation back
+                self.release(AdmissionTicket(cost, 0.0))
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                # Requests queued behind this one may fit now
+                self._wake()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise AdmissionRejected("Server is at its memory budget, try again shortly", 503)
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.waited += 1
+        self.total_wait_ms += wait_ms
+        return AdmissionTicket(cost, wait_ms)
+
+    def release(self, ticket: AdmissionTicket):
+        """Return a request's reservation and admit whoever now fits"""
+        self.in_use -= ticket.cost
+        self._wake()
+
+    def _admit(self, cost: int):
+        self.in_use += cost
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.admitted += 1
+
+    def _wake(self):
+        """Admit queued requests in arrival order while the head of the line fits"""
+        while self._waiters:
+            cost, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.in_use + cost > self.budget_bytes:
+                break
+            self._waiters.popleft()
+            self._admit(cost)
+            future.set_result(None)
+
+    def headers(self, ticket: AdmissionTicket) -> dict:
+        """Response headers describing the request's reservation"""
+        return {
+            "X-TryOn-Memory-Estimate-MB": f"{ticket.cost / 2 ** 20:.1f}",
+            "X-TryOn-Admission-Wait-Ms": f"{ticket.wait_ms:.0f}",
+        }
+
+    def snapshot(self) -> dict:
+        """Budget usage and counters for /health and /api/metrics"""
+        return {
+            "enabled": self.enabled,
+            "budget_mb": round(self.budget_bytes / 2 ** 20, 1),
+            "in_use_mb": round(self.in_use / 2 ** 20, 1),
+            "peak_in_use_mb": round(self.peak_in_use / 2 ** 20, 1),
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "mean_queue_wait_ms": round(self.total_wait_ms / self.waited, 1) if self.waited else 0.0,
+        }
+
+
+def admission_from_env() -> MemoryAdmission:
+    """Build the admission controller from TRYON_MEMORY_BUDGET_MB and friends"""
+    budget_mb = float(os.getenv("TRYON_MEMORY_BUDGET_MB", "1024"))
+    return MemoryAdmission(
+        budget_bytes=int(budget_mb * 2 ** 20),
+        timeout_seconds=float(os.getenv("TRYON_ADMISSION_TIMEOUT_SECONDS", "30")),
+        bytes_per_pixel=float(os.getenv("TRYON_ADMISSION_BYTES_PER_PIXEL", str(DEFAULT_BYTES_PER_PIXEL))),
+    )
@@ -0,0 +1,210 @@
+import os
+import struct
+import tempfile
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+# File layout (little-endian):
+#   header   magic "TRYA", version u16, section count u16
+#   sections one 32-byte entry per stored plane group (see SECTION)
+#   data     each section's bytes, starting on a 64-byte boundary so memmapped views are aligned
+MAGIC = b"TRYA"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+# level, role, encoding, channels, on value, 3 pad bytes, width, height, offset, nbytes
+SECTION = struct.Struct("<BBBBB3xIIQQ")
+ALIGNMENT = 64
+
+ROLE_COLOR = 0
+ROLE_ALPHA = 1
+
+ENCODING_RAW = 0
+ENCODING_BITS = 1
+ENCODING_RLE = 2
+ENCODINGS = {"raw": ENCODING_RAW, "bits": ENCODING_BITS, "rle": ENCODING_RLE}
+
+
+class AssetSection(NamedTuple):
+    """One stored plane group of one pyramid level"""
+    level: int
+    role: int
+    encoding: int
+    channels: int
+    on_value: int
+    width: int
+    height: int
+    offset: int
+    nbytes: int
+
+
+class Asset(NamedTuple):
+    """A loaded garment or mask; ``levels[0]`` is the full-size image"""
+    levels: List[np.ndarray]
+    sections: List[AssetSection]
+
+    @property
+    def image(self) -> np.ndarray:
+        return self.levels[0]
+
+
+def _is_binary(plane: np.ndarray) -> bool:
+    """Whether a plane only holds 0 and one other value, as masks do"""
+    top = plane.max() if plane.size else 0
+    return top == 0 or np.count_nonzero(plane) == np.count_nonzero(plane == top)
+
+
+def _rle_encode(plane: np.ndarray) -> np.ndarray:
+    """Run lengths of a binary plane, starting with a (possibly empty) run of zeros"""
+    flat = plane.reshape(-1) != 0
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds).astype(np.uint32)
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs)).astype(np.uint32)
+    return runs
+
+
+def _rle_decode(runs: np.ndarray, size: int, on_value: int) -> np.ndarray:
+    values = np.zeros(len(runs), dtype=np.uint8)
+    values[1::2] = on_value
+    return np.repeat(values, runs)[:size]
+
+
+def _encode_plane(plane: np.ndarray, encoding: str) -> bytes:
+    """Bytes of one single-channel plane in the chosen encoding"""
+    if encoding == "bits":
+        return np.packbits(plane.reshape(-1) != 0).tobytes()
+    if encoding == "rle":
+        return _rle_encode(plane).tobytes()
+    return np.ascontiguousarray(plane).tobytes()
+
+
+def _choose_encoding(plane: np.ndarray, channels: int, encoding: str) -> str:
+    """Resolve "auto": binary masks get the smaller of bit-packing and RLE, everything else
+    stays raw (an RGBA level with split alpha would need a copy to load)"""
+    if encoding != "auto":
+        return encoding
+    if channels != 1 or not _is_binary(plane):
+        return "raw"
+    rle_bytes = len(_rle_encode(plane)) * 4
+    return "rle" if rle_bytes < (plane.size + 7) // 8 else "bits"
+
+
+def save_asset(path: str, image: np.ndarray, alpha_encoding: str = "auto",
+               pyramid: Optional[Sequence[np.ndarray]] = None):
+    """Write a uint8 image (HxW mask, HxWx3 or HxWx4) to ``path``, with the pyramid levels
+    below it (``build_pyramid(image)[1:]``) if given.
+
+    With ``alpha_encoding`` "raw" the image is stored interleaved and loads without a copy.
+    "bits" and "rle" store the alpha channel (or the whole mask) separately, for binary
+    planes only; "auto" compresses binary masks and keeps RGB(A) levels raw. The file is written to a temporary name and
+    renamed, so readers never see a partial asset.
+    """
+    levels = [image] + list(pyramid or [])
+    sections = []
+    payloads = []
+    for level_index, level in enumerate(levels):
+        if level.dtype != np.uint8:
+            raise ValueError(f"Assets hold uint8 images, got {level.dtype}")
+        height, width = level.shape[:2]
+        channels = 1 if level.ndim == 2 else level.shape[2]
+        has_alpha = channels in (1, 4)
+        alpha = (level if channels == 1 else level[:, :, 3]) if has_alpha else None
+
+        encoding = _choose_encoding(alpha, channels, alpha_encoding) if has_alpha else "raw"
+        if encoding != "raw" and not _is_binary(alpha):
+            raise ValueError(f"'{encoding}' encoding needs a binary alpha/mask plane")
+
+        if encoding == "raw":
+            sections.append([level_index, ROLE_COLOR, ENCODING_RAW, channels, 0, width, height])
+            payloads.append(np.ascontiguousarray(level).tobytes())
+            continue
+
+        if channels == 4:
+            sections.append([level_index, ROLE_COLOR, ENCODING_RAW, 3, 0, width, height])
+            payloads.append(np.ascontiguousarray(level[:, :, :3]).tobytes())
+        on_value = int(alpha.max()) if alpha.size else 255
+        sections.append([level_index, ROLE_ALPHA, ENCODINGS[encoding], 1, on_value, width, height])
+        payloads.append(_encode_plane(alpha, encoding))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    entries = []
+    for section, payload in zip(sections, payloads):
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries.append(AssetSection(*section, offset, len(payload)))
+        offset += len(payload)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+            for entry in entries:
+                f.write(SECTION.pack(*entry))
+            for entry, payload in zip(entries, payloads):
+                f.write(b"\0" * (entry.offset - f.tell()))
+                f.write(payload)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_sections(buffer: np.ndarray) -> List[AssetSection]:
+    """Parse the header and section table of an asset held in a uint8 buffer"""
+    magic, version, count = HEADER.unpack(buffer[:HEADER.size].tobytes())
+    if magic != MAGIC:
+        raise ValueError("Not a try-on asset file")
+    if version != VERSION:
+        raise ValueError(f"Unsupported asset version {version}")
+    table = buffer[HEADER.size:HEADER.size + SECTION.size * count].tobytes()
+    return [AssetSection(*SECTION.unpack_from(table, i * SECTION.size)) for i in range(count)]
+
+
+def _section_array(buffer: np.ndarray, section: AssetSection) -> np.ndarray:
+    """A raw section as a view of the buffer, or a decoded copy for bits/RLE"""
+    data = buffer[section.offset:section.offset + section.nbytes]
+    if section.encoding != ENCODING_RAW:
+        # Decoded planes are new arrays, not parts of the map
+        data = np.asarray(data)
+    size = section.width * section.height
+    if section.encoding == ENCODING_RAW:
+        shape = (section.height, section.width) + ((section.channels,) if section.channels > 1 else ())
+        return data.reshape(shape)
+    if section.encoding == ENCODING_BITS:
+        plane = np.unpackbits(data, count=size)
+        plane *= np.uint8(section.on_value)
+    else:
+        plane = _rle_decode(data.view(np.uint32), size, section.on_value)
+    return plane.reshape(section.height, section.width)
+
+
+def load_asset(path: str, mmap: bool = True) -> Asset:
+    """Load an asset; raw sections are read-only views of a memory map shared through the page cache.
+
+    Levels with a separately encoded alpha are assembled into a new array.
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode="r") if mmap else np.fromfile(path, dtype=np.uint8)
+    sections = read_sections(buffer)
+
+    by_level = {}
+    for section in sections:
+        by_level.setdefault(section.level, {})[section.role] = section
+
+    levels = []
+    for level_index in sorted(by_level):
+        parts = by_level[level_index]
+        color = _section_array(buffer, parts[ROLE_COLOR]) if ROLE_COLOR in parts else None
+        alpha = _section_array(buffer, parts[ROLE_ALPHA]) if ROLE_ALPHA in parts else None
+        if alpha is None:
+            levels.append(color)
+        elif color is None:
+            levels.append(alpha)
+        else:
+            rgba = np.empty(color.shape[:2] + (4,), dtype=np.uint8)
+            rgba[:, :, :3] = color
+            rgba[:, :, 3] = alpha
+            levels.append(rgba)
+    return Asset(levels, sections)
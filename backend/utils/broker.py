@@ -0,0 +1,424 @@
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+from typing import NamedTuple, Optional
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    payload BLOB,
+    result BLOB,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    lease TEXT,
+    worker TEXT,
+    visible_at REAL NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, visible_at, created);
+"""
+
+
+def pack(value) -> bytes:
+    """Serialise JSON data whose values may include bytes, without pickle.
+
+    A length-prefixed JSON header holds the structure, with each bytes value replaced
+    by a reference; the raw bytes follow the header, so uploads are not base64-inflated.
+    """
+    blobs = []
+
+    def encode(item):
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            blobs.append(bytes(item))
+            return {"__blob__": len(blobs) - 1}
+        if isinstance(item, dict):
+            if not all(isinstance(name, str) for name in item):
+                raise TypeError("Only str dictionary keys can be stored in the broker")
+            return {name: encode(value) for name, value in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [encode(value) for value in item]
+        return item
+
+    header = json.dumps({"value": encode(value), "sizes": [len(blob) for blob in blobs]}).encode()
+    return struct.pack("<I", len(header)) + header + b"".join(blobs)
+
+
+def unpack(data: bytes):
+    """Inverse of ``pack``; ValueError when ``data`` is not a packed value"""
+    try:
+        (length,) = struct.unpack_from("<I", data)
+    except struct.error as e:
+        raise ValueError(f"Not a packed value: {e}")
+    header = json.loads(bytes(data[4:4 + length]))
+
+    def decode(item):
+        if isinstance(item, dict):
+            if set(item) == {"__blob__"}:
+                return blobs[item["__blob__"]]
+            return {name: decode(value) for name, value in item.items()}
+        if isinstance(item, list):
+            return [decode(value) for value in item]
+        return item
+
+    # A header of the wrong shape fails like any other unreadable value
+    try:
+        blobs, offset = [], 4 + length
+        for size in header["sizes"]:
+            blobs.append(bytes(data[offset:offset + size]))
+            offset += size
+        if offset != len(data):
+            raise ValueError("Packed value has the wrong length")
+        return decode(header["value"])
+    except (KeyError, TypeError, IndexError) as e:
+        raise ValueError(f"Malformed packed value: {e!r}")
+
+
+class Job(NamedTuple):
+    """A leased job: the worker must quote ``lease`` when heartbeating or finishing it"""
+    id: str
+    payload: dict
+    attempts: int
+    lease: str
+
+
+class JobStatus(NamedTuple):
+    state: str
+    result: Optional[dict]
+    error: Optional[str]
+    attempts: int
+
+
+class LocalBroker:
+    """In-process job broker for single-node runs and tests.
+
+    Same semantics as ``SqliteBroker``: a leased job stays invisible to other workers
+    until its visibility timeout passes, heartbeats push that timeout out, and a job
+    whose worker disappears is leased again until it runs out of attempts.
+    """
+
+    def __init__(self, result_ttl: float = 300.0):
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._queue = deque()
+        self._changed = threading.Condition()
+        self.counts = {"enqueued": 0, "completed": 0, "failed": 0, "retried": 0, "expired_leases": 0}
+
+    def enqueue(self, payload: dict, max_attempts: int = 3) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._changed:
+            self._jobs[job_id] = {"state": QUEUED, "payload": payload, "result": None, "error": None,
+                                  "attempts": 0, "max_attempts": max_attempts, "lease": None,
+                                  "visible_at": now, "updated": now}
+            self._queue.append(job_id)
+            self.counts["enqueued"] += 1
+            self._expire_results(now)
+            self._changed.notify()
+        return job_id
+
+    def lease(self, worker: str, visibility_timeout: float, wait: float = 0.0) -> Optional[Job]:
+        """Claim the oldest visible job, waiting up to ``wait`` seconds for one"""
+        deadline = time.monotonic() + wait
+        with self._changed:
+            while True:
+                now = time.time()
+                self._reclaim(now)
+                for job_id in self._queue:
+                    job = self._jobs[job_id]
+                    if job["visible_at"] <= now:
+                        self._queue.remove(job_id)
+                        job.update(state=LEASED, lease=uuid.uuid4().hex, worker=worker,
+                                   attempts=job["attempts"] + 1, visible_at=now + visibility_timeout, updated=now)
+                        return Job(job_id, job["payload"], job["attempts"], job["lease"])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(min(remaining, 0.5))
+
+    def _reclaim(self, now: float):
+        """Requeue (or fail) jobs whose worker stopped heartbeating"""
+        for job_id, job in self._jobs.items():
+            if job["state"] == LEASED and job["visible_at"] <= now:
+                self.counts["expired_leases"] += 1
+                if job["attempts"] >= job["max_attempts"]:
+                    job.update(state=FAILED, error="Worker lost the job too many times", lease=None,
+                               payload=None, updated=now)
+                    self.counts["failed"] += 1
+                else:
+                    job.update(state=QUEUED, lease=None, updated=now)
+                    self._queue.append(job_id)
+                    self.counts["retried"] += 1
+
+    def _owned(self, job_id: str, lease: str):
+        job = self._jobs.get(job_id)
+        if job is None or job["state"] != LEASED or job["lease"] != lease:
+            return None
+        return job
+
+    def heartbeat(self, job_id: str, lease: str, visibility_timeout: float) -> bool:
+        """Keep a lease alive; False if it expired and the job went to someone else"""
+        with self._changed:
+            job = self._owned(job_id, lease)
+            if job is None:
+                return False
+            job["visible_at"] = time.time() + visibility_timeout
+            return True
+
+    def complete(self, job_id: str, lease: str, result: dict) -> bool:
+        with self._changed:
+            job = self._owned(job_id, lease)
+            if job is None:
+                return False
+            job.update(state=DONE, result=result, payload=None, lease=None, updated=time.time())
+            self.counts["completed"] += 1
+            self._changed.notify_all()
+            return True
+
+    def fail(self, job_id: str, lease: str, error: str, retry: bool = False, delay: float = 0.0) -> bool:
+        """Give a job up: back to the queue after ``delay`` if ``retry`` and attempts remain,
+        else failed for good"""
+        now = time.time()
+        with self._changed:
+            job = self._owned(job_id, lease)
+            if job is None:
+                return False
+            if retry and job["attempts"] < job["max_attempts"]:
+                job.update(state=QUEUED, lease=None, error=error, visible_at=now + delay, updated=now)
+                self._queue.append(job_id)
+                self.counts["retried"] += 1
+            else:
+                job.update(state=FAILED, lease=None, error=error, payload=None, updated=now)
+                self.counts["failed"] += 1
+            self._changed.notify_all()
+            return True
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return JobStatus(job["state"], job["result"], job["error"], job["attempts"])
+
+    def delete(self, job_id: str):
+        with self._changed:
+            self._jobs.pop(job_id, None)
+            if job_id in self._queue:
+                self._queue.remove(job_id)
+
+    def _expire_results(self, now: float):
+        """Drop finished jobs nobody collected"""
+        stale = [job_id for job_id, job in self._jobs.items()
+                 if job["state"] in (DONE, FAILED) and job["updated"] < now - self.result_ttl]
+        for job_id in stale:
+            del self._jobs[job_id]
+
+    def stats(self) -> dict:
+        with self._changed:
+            states = {}
+            for job in self._jobs.values():
+                states[job["state"]] = states.get(job["state"], 0) + 1
+            return {"backend": "local", "jobs": states, **self.counts}
+
+
+class SqliteBroker:
+    """Job broker in a SQLite database, shared by every API and worker process on a host
+    (or on a shared filesystem that supports SQLite locking).
+
+    Leasing runs in an ``IMMEDIATE`` transaction, so two workers never claim the same
+    job. Payloads and results are stored with ``pack`` (JSON plus raw bytes, never
+    pickle) and dropped once a job finishes or is collected. The database file is
+    created readable by its owner only.
+    """
+
+    def __init__(self, path: str, result_ttl: float = 300.0, poll_interval: float = 0.05):
+        self.path = path
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        # Jobs carry shoppers' photos: keep the database (and its WAL files, which SQLite
+        # creates with the same mode) private to this user
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+        self.counts = {"enqueued": 0, "completed": 0, "failed": 0, "retried": 0, "expired_leases": 0}
+
+    def _transaction(self, statements):
+        """Run ``statements(db)`` in a write transaction and return its result"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._db)
+                self._db.execute("COMMIT")
+                return result
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, payload: dict, max_attempts: int = 3) -> str:
+        job_id = uuid.uuid4().hex
+        blob = pack(payload)
+        now = time.time()
+
+        def insert(db):
+            db.execute("INSERT INTO jobs (id, state, payload, max_attempts, visible_at, created, updated) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)", (job_id, QUEUED, blob, max_attempts, now, now, now))
+            db.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?", (DONE, FAILED, now - self.result_ttl))
+
+        self._transaction(insert)
+        self.counts["enqueued"] += 1
+        return job_id
+
+    def lease(self, worker: str, visibility_timeout: float, wait: float = 0.0) -> Optional[Job]:
+        """Claim the oldest visible job, polling up to ``wait`` seconds for one"""
+        deadline = time.monotonic() + wait
+
+        def claim(db):
+            now = time.time()
+            # Leases whose worker stopped heartbeating: requeue, or fail when out of attempts
+            expired = db.execute("UPDATE jobs SET state = ?, error = 'Worker lost the job too many times', "
+                                 "payload = NULL, lease = NULL, updated = ? "
+                                 "WHERE state = ? AND visible_at <= ? AND attempts >= max_attempts",
+                                 (FAILED, now, LEASED, now)).rowcount
+            requeued = db.execute("UPDATE jobs SET state = ?, lease = NULL, updated = ? "
+                                  "WHERE state = ? AND visible_at <= ?", (QUEUED, now, LEASED, now)).rowcount
+            self.counts["failed"] += expired
+            self.counts["expired_leases"] += expired + requeued
+            self.counts["retried"] += requeued
+
+            row = db.execute("SELECT id, payload, attempts FROM jobs WHERE state = ? AND visible_at <= ? "
+                             "ORDER BY created LIMIT 1", (QUEUED, now)).fetchone()
+            if row is None:
+                return None
+            job_id, blob, attempts = row
+            try:
+                payload = unpack(blob)
+            except ValueError:
+                # Written by another version; it cannot run here, so fail it rather than stall the queue
+                db.execute("UPDATE jobs SET state = ?, error = 'Unreadable job payload', payload = NULL, "
+                           "updated = ? WHERE id = ?", (FAILED, now, job_id))
+                self.counts["failed"] += 1
+                return None
+            lease = uuid.uuid4().hex
+            db.execute("UPDATE jobs SET state = ?, lease = ?, worker = ?, attempts = ?, visible_at = ?, "
+                       "updated = ? WHERE id = ?",
+                       (LEASED, lease, worker, attempts + 1, now + visibility_timeout, now, job_id))
+            return Job(job_id, payload, attempts + 1, lease)
+
+        while True:
+            job = self._transaction(claim)
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def heartbeat(self, job_id: str, lease: str, visibility_timeout: float) -> bool:
+        """Keep a lease alive; False if it expired and the job went to someone else"""
+        with self._lock:
+            return self._db.execute("UPDATE jobs SET visible_at = ? WHERE id = ? AND state = ? AND lease = ?",
+                                    (time.time() + visibility_timeout, job_id, LEASED, lease)).rowcount == 1
+
+    def complete(self, job_id: str, lease: str, result: dict) -> bool:
+        blob = pack(result)
+        with self._lock:
+            done = self._db.execute("UPDATE jobs SET state = ?, result = ?, payload = NULL, lease = NULL, "
+                                    "updated = ? WHERE id = ? AND state = ? AND lease = ?",
+                                    (DONE, blob, time.time(), job_id, LEASED, lease)).rowcount == 1
+        if done:
+            self.counts["completed"] += 1
+        return done
+
+    def fail(self, job_id: str, lease: str, error: str, retry: bool = False, delay: float = 0.0) -> bool:
+        """Give a job up: back to the queue after ``delay`` if ``retry`` and attempts remain,
+        else failed for good"""
+        def give_up(db):
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND state = ? AND lease = ?",
+                             (job_id, LEASED, lease)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if retry and row[0] < row[1]:
+                db.execute("UPDATE jobs SET state = ?, lease = NULL, error = ?, visible_at = ?, updated = ? "
+                           "WHERE id = ?", (QUEUED, error, now + delay, now, job_id))
+                return "retried"
+            db.execute("UPDATE jobs SET state = ?, lease = NULL, error = ?, payload = NULL, updated = ? "
+                       "WHERE id = ?", (FAILED, error, now, job_id))
+            return "failed"
+
+        outcome = self._transaction(give_up)
+        if outcome is not None:
+            self.counts[outcome] += 1
+        return outcome is not None
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self._lock:
+            row = self._db.execute("SELECT state, result, error, attempts FROM jobs WHERE id = ?",
+                                   (job_id,)).fetchone()
+        if row is None:
+            return None
+        state, blob, error, attempts = row
+        return JobStatus(state, unpack(blob) if blob is not None else None, error, attempts)
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        # Jobs counted across every process; the event counters are this process's own
+        return {"backend": "sqlite", "path": self.path, "jobs": states, **self.counts}
+
+
+class BrokerSettings(NamedTuple):
+    max_attempts: int
+    visibility_timeout: float
+    heartbeat_interval: float
+    result_timeout: float
+
+
+def broker_settings_from_env() -> BrokerSettings:
+    """Job settings from the TRYON_BROKER_* variables"""
+    visibility_timeout = float(os.getenv("TRYON_BROKER_VISIBILITY_SECONDS", "30"))
+    return BrokerSettings(
+        max_attempts=max(1, int(os.getenv("TRYON_BROKER_MAX_ATTEMPTS", "3"))),
+        visibility_timeout=visibility_timeout,
+        heartbeat_interval=float(os.getenv("TRYON_BROKER_HEARTBEAT_SECONDS", str(visibility_timeout / 3))),
+        result_timeout=float(os.getenv("TRYON_BROKER_RESULT_TIMEOUT_SECONDS", "120")),
+    )
+
+
+def create_broker(kind: str, path: Optional[str] = None):
+    """A broker by name: "local" (this process only) or "sqlite" (at ``path``)"""
+    result_ttl = float(os.getenv("TRYON_BROKER_RESULT_TTL_SECONDS", "300"))
+    if kind == "local":
+        return LocalBroker(result_ttl)
+    if kind == "sqlite":
+        # No default: a database in the shared temp directory could be read or fed by any local user
+        path = path or os.getenv("TRYON_BROKER_PATH", "").strip()
+        if not path:
+            raise ValueError("The sqlite broker needs TRYON_BROKER_PATH (or --path): "
+                             "a database in a directory only this service can write to")
+        return SqliteBroker(path, result_ttl, float(os.getenv("TRYON_BROKER_POLL_MS", "50")) / 1000)
+    raise ValueError(f"Unknown broker '{kind}'. Expected 'local' or 'sqlite'")
+
+
+def broker_from_env():
+    """The broker selected by TRYON_BROKER ("local", "sqlite" or unset to process in the API)"""
+    kind = os.getenv("TRYON_BROKER", "").strip().lower()
+    return create_broker(kind) if kind else None
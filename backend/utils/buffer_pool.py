@@ -0,0 +1,178 @@
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Smallest bucket handed out; tiny arrays are cheaper to allocate than to pool
+MIN_BUCKET_BYTES = 64 * 1024
+# Buckets step by quarter powers of two, so a borrowed buffer wastes at most ~19%
+BUCKET_STEPS = (1.0, 1.1892, 1.4142, 1.6818)
+
+
+def bucket_size(nbytes: int) -> int:
+    """Round a byte count up to its pool bucket"""
+    nbytes = max(nbytes, MIN_BUCKET_BYTES)
+    power = 1 << (int(nbytes - 1).bit_length() - 1)
+    for step in BUCKET_STEPS:
+        size = int(power * step)
+        if size >= nbytes:
+            return size
+    return power * 2
+
+
+class BufferPool:
+    """Size-bucketed pool of reusable scratch buffers shared by all requests.
+
+    Buffers are flat uint8 arrays; ``borrow`` returns a typed, shaped view over one.
+    At most ``max_bytes`` of idle buffers are kept, beyond that released buffers are
+    left to the garbage collector.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._free: Dict[int, List[np.ndarray]] = defaultdict(list)
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        # Per-request totals, recorded when each scope closes
+        self.scopes = 0
+        self.scope_borrowed = 0
+        self.scope_allocated = 0
+
+    def acquire(self, nbytes: int) -> Tuple[np.ndarray, bool]:
+        """Take a raw buffer of at least ``nbytes``; the flag says whether it was reused"""
+        size = bucket_size(nbytes)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                self._idle_bytes -= size
+                self.hits += 1
+                return free.pop(), True
+            self.misses += 1
+        return np.empty(size, dtype=np.uint8), False
+
+    def give_back(self, buffer: np.ndarray):
+        """Return a raw buffer to its bucket, or drop it if the pool is full"""
+        with self._lock:
+            if self._idle_bytes + buffer.nbytes > self.max_bytes:
+                self.dropped += 1
+                return
+            self._free[buffer.nbytes].append(buffer)
+            self._idle_bytes += buffer.nbytes
+
+    def record_scope(self, scope: "ScratchScope"):
+        """Add a closed scope's counters to the per-request totals"""
+        with self._lock:
+            self.scopes += 1
+            self.scope_borrowed += scope.borrowed
+            self.scope_allocated += scope.allocated
+
+    def scope(self) -> "ScratchScope":
+        """Per-request scope that returns every borrowed buffer when it closes"""
+        return ScratchScope(self)
+
+    def stats(self) -> dict:
+        """Pool counters for metrics endpoints"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "idle_mb": round(self._idle_bytes / 2 ** 20, 1),
+                "max_mb": round(self.max_bytes / 2 ** 20, 1),
+                "buckets": {size: len(buffers) for size, buffers in sorted(self._free.items()) if buffers},
+                "hits": self.hits,
+                "misses": self.misses,
+                "dropped": self.dropped,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "requests": self.scopes,
+                "borrowed_per_request": round(self.scope_borrowed / self.scopes, 1) if self.scopes else 0.0,
+                "allocated_per_request": round(self.scope_allocated / self.scopes, 2) if self.scopes else 0.0,
+            }
+
+
+class ScratchScope:
+    """Buffers borrowed by one request, plus its allocation counters"""
+
+    def __init__(self, pool: BufferPool):
+        self.pool = pool
+        self._buffers: List[np.ndarray] = []
+        self._lock = threading.Lock()
+        self.borrowed = 0
+        self.allocated = 0
+        self.borrowed_bytes = 0
+
+    def borrow(self, shape, dtype=np.uint8) -> np.ndarray:
+        """Uninitialised array of ``shape``/``dtype`` backed by a pooled buffer"""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        buffer, reused = self.pool.acquire(nbytes)
+        with self._lock:
+            self._buffers.append(buffer)
+            self.borrowed += 1
+            self.borrowed_bytes += nbytes
+            if not reused:
+                self.allocated += 1
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+    def close(self):
+        """Hand every borrowed buffer back to the pool"""
+        with self._lock:
+            buffers, self._buffers = self._buffers, []
+        for buffer in buffers:
+            self.pool.give_back(buffer)
+        if buffers:
+            self.pool.record_scope(self)
+
+    def stats(self) -> dict:
+        """Buffers borrowed by this request and how many needed a fresh allocation"""
+        return {
+            "borrowed": self.borrowed,
+            "allocated": self.allocated,
+            "borrowed_mb": round(self.borrowed_bytes / 2 ** 20, 2),
+        }
+
+    def __enter__(self) -> "ScratchScope":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def scratch_array(scratch: Optional[ScratchScope], shape, dtype=np.uint8) -> np.ndarray:
+    """Borrow from the request's scope when there is one, otherwise allocate"""
+    if scratch is None:
+        return np.empty(shape, dtype=dtype)
+    return scratch.borrow(shape, dtype)
+
+
+_pool: Optional[BufferPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_buffer_pool() -> BufferPool:
+    """Process-wide scratch buffer pool, sized by TRYON_BUFFER_POOL_MB"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BufferPool(int(os.getenv("TRYON_BUFFER_POOL_MB", "256")) * 1024 * 1024)
+    return _pool
+
+
+def current_rss_mb() -> Optional[float]:
+    """Resident set size of this process in MB, where the platform exposes it"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except ImportError:
+        return None
@@ -0,0 +1,144 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+# Lookups counted locally before they are added to the shared tier's node-wide counters
+RECORD_EVERY = 32
+
+
+def image_digest(image_bytes: bytes) -> str:
+    """Stable key for an uploaded image"""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with hit/miss counters.
+
+    With a ``shared`` backend (see ``utils.shared_cache``) local misses fall through to
+    the node-wide tier and new entries are written to it, so worker processes reuse
+    each other's work. Locally the cache then holds only what the shared tier serves
+    (memory-mapped views for the shm tier), never a private heap copy.
+    """
+
+    def __init__(self, max_entries: int = 64, name: str = "cache", shared=None):
+        self.max_entries = max(1, max_entries)
+        self.name = name
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._unrecorded = [0, 0]
+
+    def _store(self, key: Hashable, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _count(self, hit: bool):
+        """Count a lookup, passing batches of counts on to the shared tier"""
+        if self.shared is None:
+            return
+        with self._lock:
+            self._unrecorded[0 if hit else 1] += 1
+            if sum(self._unrecorded) < RECORD_EVERY:
+                return
+        self.record_counts()
+
+    def record_counts(self):
+        """Add this worker's not yet recorded lookups to the shared tier's counters"""
+        if self.shared is None:
+            return
+        with self._lock:
+            hits, misses = self._unrecorded
+            self._unrecorded = [0, 0]
+        if hits or misses:
+            self.shared.record(self.name, hits, misses)
+
+    def get(self, key: Hashable):
+        """Return the cached value or None, marking it as recently used"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                value = self._entries[key]
+            else:
+                value = None
+        if value is not None:
+            self._count(True)
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(self.name, key)
+            if value is not None:
+                with self._lock:
+                    self._store(key, value)
+                    self.hits += 1
+                    self.shared_hits += 1
+                self._count(True)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        self._count(False)
+        return None
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.shared is not None and self.shared.contains(self.name, key)
+
+    def put(self, key: Hashable, value):
+        """Store a value, evicting the least recently used entries over capacity.
+
+        Returns the value as cached: with a shared tier, its view of the value.
+        """
+        if self.shared is not None:
+            try:
+                value = self.shared.put(self.name, key, value)
+            except Exception as e:
+                # The heap value still serves this worker
+                print(f"⚠️ Shared cache write failed for {self.name}: {e}")
+        with self._lock:
+            self._store(key, value)
+        return value
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], object]):
+        """Return the cached value, computing and storing it on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, factory())
+        return value
+
+    def clear(self):
+        """Drop every local entry (the shared tier is left alone)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Size and hit rate for metrics endpoints"""
+        self.record_counts()
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+        if self.shared is not None:
+            stats["shared_hits"] = self.shared_hits
+        return stats
+
+
+def clear_processor_caches(processor):
+    """Empty a processor's caches (and its fallback's) so the next run does all the work"""
+    for owner in (processor, getattr(processor, "fallback", None), getattr(processor, "client", None)):
+        if owner is not None:
+            for value in vars(owner).values():
+                if isinstance(value, LRUCache):
+                    value.clear()
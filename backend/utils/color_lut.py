@@ -0,0 +1,131 @@
+import os
+import threading
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# Class bits stored in each table entry
+PERSON = 1
+BACKGROUND = 2
+
+
+def _person_rule(colors: np.ndarray) -> np.ndarray:
+    """Skin or clothing colours, as in the person-segmentation fallback.
+
+    That fallback converts its RGB frame with COLOR_BGR2HSV, so the rule is evaluated
+    the same way here to classify every colour exactly as before.
+    """
+    hsv = cv2.cvtColor(colors, cv2.COLOR_BGR2HSV)
+    skin = cv2.inRange(hsv, np.array([0, 20, 70]), np.array([20, 255, 255]))
+    clothing = cv2.inRange(hsv, np.array([0, 0, 30]), np.array([180, 255, 220]))
+    return cv2.bitwise_or(skin, clothing)
+
+
+def _background_rule(colors: np.ndarray) -> np.ndarray:
+    """White/light or black/dark backdrop colours, as in the background-removal fallback"""
+    hsv = cv2.cvtColor(colors, cv2.COLOR_RGB2HSV)
+    white = cv2.inRange(hsv, np.array([0, 0, 200]), np.array([180, 30, 255]))
+    black = cv2.inRange(hsv, np.array([0, 0, 0]), np.array([180, 255, 50]))
+    return cv2.bitwise_or(white, black)
+
+
+class ColorClassLUT:
+    """The fallback colour rules compiled into one RGB -> class-bits lookup table.
+
+    Every (quantized) colour is classified once, so per-request classification is one
+    gather instead of an HSV conversion, several ``inRange`` passes and bitwise
+    combining. With 8 bits per channel the table (16 MB) reproduces the rules exactly
+    and is indexed by the pixel's packed RGB value directly; fewer bits give a smaller
+    table whose bins are classified by their centre colour.
+    """
+
+    def __init__(self, bits: int = 8):
+        if not 1 <= bits <= 8:
+            raise ValueError("Colour LUT bits must be between 1 and 8")
+        self.bits = bits
+        self.shift = 8 - bits
+
+        levels = np.arange(1 << bits, dtype=np.uint16) << self.shift
+        if self.shift:
+            levels += 1 << (self.shift - 1)
+        levels = levels.astype(np.uint8)
+        c1, c2 = np.meshgrid(levels, levels, indexing="ij")
+        plane = np.empty((c1.size, 1, 3), dtype=np.uint8)
+        plane[:, 0, 1] = c1.reshape(-1)
+        plane[:, 0, 2] = c2.reshape(-1)
+
+        # One slice of the colour cube per first-channel value keeps the build's memory small
+        table = np.empty((1 << bits, c1.size), dtype=np.uint8)
+        for i, level in enumerate(levels):
+            plane[:, 0, 0] = level
+            person = _person_rule(plane).reshape(-1) != 0
+            background = _background_rule(plane).reshape(-1) != 0
+            table[i] = person * np.uint8(PERSON) | background * np.uint8(BACKGROUND)
+
+        if bits == 8:
+            # Indexed by the little-endian packed value r | g << 8 | b << 16
+            table = table.reshape(256, 256, 256).transpose(2, 1, 0)
+        self.table = np.ascontiguousarray(table).reshape(-1)
+
+    def index(self, image: np.ndarray) -> np.ndarray:
+        """Table index of every pixel of an HxWx3 uint8 image"""
+        if self.bits == 8:
+            # Pad to 4 bytes per pixel and read each pixel as one uint32
+            rgba = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
+            packed = rgba.view(np.uint32)[:, :, 0]
+            np.bitwise_and(packed, 0xFFFFFF, out=packed)
+            return packed
+        quantized = image >> self.shift
+        idx = quantized[:, :, 0].astype(np.uint32)
+        idx <<= self.bits
+        idx |= quantized[:, :, 1]
+        idx <<= self.bits
+        idx |= quantized[:, :, 2]
+        return idx
+
+    def classify(self, image: np.ndarray) -> np.ndarray:
+        """Class bits of every pixel"""
+        return np.take(self.table, self.index(image))
+
+    def mask(self, image: np.ndarray, cls: int, invert: bool = False) -> np.ndarray:
+        """0/255 mask of the pixels in (or, with ``invert``, not in) a class"""
+        classes = self.classify(image)
+        cv2.bitwise_and(classes, cls, dst=classes)
+        return cv2.compare(classes, 0, cv2.CMP_EQ if invert else cv2.CMP_NE)
+
+
+def classify_downscaled(image: np.ndarray, max_side: Optional[int], compute) -> np.ndarray:
+    """Run a mask computation on a copy capped at ``max_side`` and scale the mask back up.
+
+    Used to run the colour fallbacks at reduced resolution; ``compute`` maps an image
+    to a 0/255 mask. With no cap, or a smaller image, it runs at full size.
+    """
+    h, w = image.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return compute(image)
+    scale = max_side / max(h, w)
+    # Nearest-neighbour sampling keeps real colours; averaging would invent edge colours to classify
+    small = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_NEAREST)
+    mask = cv2.resize(compute(small), (w, h), interpolation=cv2.INTER_LINEAR)
+    _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+    return mask
+
+
+_lut = None
+_lut_lock = threading.Lock()
+
+
+def get_color_lut() -> ColorClassLUT:
+    """Process-wide table, built on first use with TRYON_COLOR_LUT_BITS bits per channel (default 8)"""
+    global _lut
+    if _lut is None:
+        with _lut_lock:
+            if _lut is None:
+                _lut = ColorClassLUT(int(os.getenv("TRYON_COLOR_LUT_BITS", "8")))
+    return _lut
+
+
+def fallback_max_side() -> Optional[int]:
+    """TRYON_FALLBACK_MAX_SIDE: longest side the colour fallbacks run at (unset or 0 for full size)"""
+    return int(os.getenv("TRYON_FALLBACK_MAX_SIDE", "0")) or None
@@ -0,0 +1,37 @@
+import os
+from typing import Optional
+
+# Selectable try-on processors; all take the same process_virtual_tryon arguments
+ENGINES = ("enhanced", "lite", "legacy", "gemini")
+DEFAULT_ENGINE = "enhanced"
+
+
+def engine_from_env() -> str:
+    """Engine named by TRYON_ENGINE, defaulting to the enhanced processor"""
+    engine = os.getenv("TRYON_ENGINE", DEFAULT_ENGINE).strip().lower() or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown TRYON_ENGINE '{engine}'. Expected one of: {', '.join(ENGINES)}")
+    return engine
+
+
+def create_processor(engine: Optional[str] = None):
+    """Build the try-on processor for an engine.
+
+    "enhanced" is the MediaPipe/rembg pipeline; "lite" is the same pipeline on its
+    colour-table and heuristic fallbacks, loading no models; "legacy" is the HOG-box
+    processor. The last two suit small CPU-only deployments. "gemini" renders through
+    the Gemini image model, falling back to the enhanced pipeline.
+    """
+    engine = engine or engine_from_env()
+    if engine == "legacy":
+        from utils.virtual_tryon import VirtualTryOnProcessor
+        print("🪶 Using the legacy HOG try-on engine")
+        return VirtualTryOnProcessor()
+    from utils.enhanced_tryon import EnhancedVirtualTryOnProcessor
+    if engine == "gemini":
+        from utils.generative import GenerativeTryOnEngine
+        return GenerativeTryOnEngine(fallback=EnhancedVirtualTryOnProcessor())
+    if engine == "lite":
+        print("🪶 Using the lite try-on engine (colour-table fallbacks, no models)")
+        return EnhancedVirtualTryOnProcessor(use_models=False)
+    return EnhancedVirtualTryOnProcessor()
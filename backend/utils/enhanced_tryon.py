@@ -1,10 +1,9 @@
 import cv2
 import numpy as np
 from PIL import Image, ImageEnhance
-import io
-import base64
 import os
-from typing import Tuple, Optional, List
+import threading
+from typing import Callable, Tuple, Optional, List, Dict, NamedTuple
 from scipy import ndimage
 from skimage import filters, feature
 
@@ -16,44 +15,188 @@ except ImportError:
     MEDIAPIPE_AVAILABLE = False
     print("Warning: mediapipe not available. Using fallback pose detection and segmentation methods.")
 
-# Try to import rembg, but provide fallback if not available
-try:
-    from rembg import remove
-    REMBG_AVAILABLE = True
-except ImportError:
-    REMBG_AVAILABLE = False
+from utils.inference import (
+    REMBG_AVAILABLE, MicroBatcher, batch_settings, get_background_removal_batcher, register_batcher
+)
+if not REMBG_AVAILABLE:
     print("Warning: rembg not available. Using fallback background removal method.")
 
+from utils.buffer_pool import ScratchScope, get_buffer_pool, scratch_array
+from utils.cache import LRUCache, image_digest
+from utils.color_lut import BACKGROUND, PERSON, classify_downscaled, fallback_max_side, get_color_lut
+from utils.garment_kernels import enhance_garment_inplace
+from utils.image_encoding import encode_image, image_to_data_url
+from utils.mipmap import build_pyramid, resize_from_pyramid, size_bucket
+from utils.output_size import FramePlan, OutputSpec, plan_frame, reframe, reframe_points
+from utils.pipeline import Stage, StageGraph, get_pipeline_executor
+from utils.quality import QualityProfile, get_quality_profile
+from utils.shared_cache import get_shared_cache, register_record_type
+
+class CompositeRegion(NamedTuple):
+    """Rectangle the garment was composited into and its per-pixel blend weight"""
+    x: int
+    y: int
+    w: int
+    h: int
+    alpha: np.ndarray
+
+
+@register_record_type
+class LuminanceStats(NamedTuple):
+    """Per-person lighting statistics, computed once and cached"""
+    l_plane: np.ndarray
+    tile: int
+    mean: float
+    # Sum of all RGB values, so the result mean can be updated from the region alone
+    pixel_sum: float
+
+
+class TrackingModels(NamedTuple):
+    """MediaPipe graphs in video mode, owned by one live stream"""
+    pose: object
+    segmentation: object
+
+
 class EnhancedVirtualTryOnProcessor:
-    def __init__(self):
-        if MEDIAPIPE_AVAILABLE:
+    def __init__(self, use_models: bool = True):
+        """With ``use_models=False`` the colour/heuristic fallbacks are used even where
+        MediaPipe and rembg are installed (the "lite" engine)."""
+        # MediaPipe graphs are not safe to call from several threads at once
+        self._pose_locks = {}
+        self._poses = {}
+        self._poses_lock = threading.Lock()
+        self._segmentation_lock = threading.Lock()
+        self.use_rembg = REMBG_AVAILABLE and use_models
+        
+        # Colour fallbacks classify through a lookup table, optionally at reduced resolution
+        self.fallback_max_side = fallback_max_side()
+        if not (MEDIAPIPE_AVAILABLE and use_models and self.use_rembg):
+            get_color_lut()
+        
+        if MEDIAPIPE_AVAILABLE and use_models:
             self.mp_pose = mp.solutions.pose
             self.mp_selfie_segmentation = mp.solutions.selfie_segmentation
-            self.pose = self.mp_pose.Pose(
-                static_image_mode=True,
-                model_complexity=2,
-                enable_segmentation=True,
-                min_detection_confidence=0.5
-            )
+            self.pose, _ = self._get_pose(2)
             self.segmentation = self.mp_selfie_segmentation.SelfieSegmentation(model_selection=1)
         else:
             self.pose = None
             self.segmentation = None
         
-    def preprocess_images(self, person_image_bytes: bytes, cloth_image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
-        """Preprocess images for virtual try-on"""
-        # Convert bytes to numpy arrays
-        person_np = np.frombuffer(person_image_bytes, np.uint8)
-        person_img = cv2.imdecode(person_np, cv2.IMREAD_COLOR)
+        # MediaPipe has no batched entry point, so batching segmentation only saves
+        # per-call hand-offs; it stays off unless TRYON_SEGMENTATION_BATCH_SIZE > 1
+        self._segmentation_batcher = register_batcher(
+            MicroBatcher(self._segment_batch, name="segmentation", **batch_settings("SEGMENTATION", 1))
+        )
+        
+        # Node-wide tier behind the caches below when TRYON_SHARED_CACHE is set
+        shared = get_shared_cache()
         
-        cloth_np = np.frombuffer(cloth_image_bytes, np.uint8)
-        cloth_img = cv2.imdecode(cloth_np, cv2.IMREAD_COLOR)
+        # Original-image luminance, keyed by person upload, reused across garments
+        self.luminance_cache = LRUCache(int(os.getenv("TRYON_LUMINANCE_CACHE_SIZE", "32")), "luminance", shared)
+        self.lighting_tiles = int(os.getenv("TRYON_LIGHTING_TILES", "4"))
         
-        # Ensure images are in RGB format
-        person_rgb = cv2.cvtColor(person_img, cv2.COLOR_BGR2RGB)
-        cloth_rgb = cv2.cvtColor(cloth_img, cv2.COLOR_BGR2RGB)
+        # Person masks/landmarks and extracted garments, keyed by upload and working size,
+        # so a shopper trying several garments (or a popular garment) skips that analysis
+        self.person_cache = LRUCache(int(os.getenv("TRYON_PERSON_CACHE_SIZE", "32")), "person_analysis", shared)
+        self.garment_cache = LRUCache(int(os.getenv("TRYON_GARMENT_CACHE_SIZE", "16")), "garment", shared)
         
-        return person_rgb, cloth_rgb
+        # Mip pyramids of extracted garments and garments resized to their target sizes.
+        # Approximate resizes may also round the size, so nearby regions share one entry;
+        # rounding moves pattern edges by a few pixels, so it is opt-in
+        self.pyramid_cache = LRUCache(int(os.getenv("TRYON_PYRAMID_CACHE_SIZE", "16")), "garment_pyramid", shared)
+        self.resize_cache = LRUCache(int(os.getenv("TRYON_RESIZE_CACHE_SIZE", "64")), "resized_garment", shared)
+        self.resize_bucket_px = int(os.getenv("TRYON_RESIZE_BUCKET_PX", "1"))
+        
+        # Longest side of the quick preview composited for progressive delivery
+        self.preview_max_side = int(os.getenv("TRYON_PREVIEW_MAX_SIDE", "384"))
+        
+        self.pipeline = self.build_pipeline()
+    
+    def cache_stats(self) -> dict:
+        """Per-cache counters, plus the node-wide shared tier if one is configured"""
+        caches = [self.luminance_cache, self.person_cache, self.garment_cache,
+                  self.pyramid_cache, self.resize_cache]
+        stats = {cache.name: cache.stats() for cache in caches}
+        shared = get_shared_cache()
+        if shared is not None:
+            stats["shared"] = shared.stats()
+        return stats
+    
+    def _get_pose(self, model_complexity: int):
+        """Get the MediaPipe Pose model for a complexity level, creating it on first use"""
+        with self._poses_lock:
+            if model_complexity not in self._poses:
+                self._poses[model_complexity] = self.mp_pose.Pose(
+                    static_image_mode=True,
+                    model_complexity=model_complexity,
+                    enable_segmentation=True,
+                    min_detection_confidence=0.5
+                )
+                self._pose_locks[model_complexity] = threading.Lock()
+            return self._poses[model_complexity], self._pose_locks[model_complexity]
+        
+    def create_tracking_models(self, model_complexity: int = 0) -> Optional[TrackingModels]:
+        """Pose and segmentation graphs for one live stream, or None without MediaPipe.
+        
+        Unlike the shared ``static_image_mode`` graphs these track landmarks from the
+        previous frame and only re-run detection when tracking is lost, so they hold
+        per-stream state and must not be shared between connections.
+        """
+        if self.pose is None:
+            return None
+        pose = self.mp_pose.Pose(
+            static_image_mode=False,
+            model_complexity=model_complexity,
+            smooth_landmarks=True,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+        # The landscape model is the lighter of the two and suits webcam frames
+        segmentation = self.mp_selfie_segmentation.SelfieSegmentation(model_selection=0)
+        return TrackingModels(pose, segmentation)
+    
+    def track_person(self, frame: np.ndarray,
+                     tracking: Optional[TrackingModels]) -> Tuple[np.ndarray, Optional[dict]]:
+        """Person mask and body points of one video frame; body points are None when tracking is lost"""
+        if tracking is None:
+            return self._fallback_person_segmentation(frame), self._fallback_body_detection(frame)
+        
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        mask = self._binary_person_mask(tracking.segmentation.process(rgb_frame).segmentation_mask)
+        results = tracking.pose.process(rgb_frame)
+        if results.pose_landmarks:
+            return mask, self._pose_body_points(results.pose_landmarks, frame.shape)
+        return mask, None
+    
+    def decode_image(self, image_bytes: bytes, max_side: Optional[int] = None,
+                     scratch: Optional[ScratchScope] = None) -> np.ndarray:
+        """Decode encoded image bytes into an RGB numpy array, optionally capping its longest side.
+        
+        With a ``scratch`` scope the downscaled image lives in a pooled buffer.
+        """
+        image_np = np.frombuffer(image_bytes, np.uint8)
+        image = cv2.imdecode(image_np, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image")
+        
+        h, w = image.shape[:2]
+        if max_side and max(h, w) > max_side:
+            scale = max_side / max(h, w)
+            new_w, new_h = max(1, int(w * scale)), max(1, int(h * scale))
+            image = cv2.resize(image, (new_w, new_h), dst=scratch_array(scratch, (new_h, new_w, 3)),
+                               interpolation=cv2.INTER_AREA)
+        
+        # Swap channels in place rather than allocating a second full-size image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    
+    def preprocess_images(self, person_image_bytes: bytes, cloth_image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """Preprocess images for virtual try-on"""
+        return self.decode_image(person_image_bytes), self.decode_image(cloth_image_bytes)
+    
+    def _segment_batch(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Run MediaPipe selfie segmentation over a batch of images"""
+        with self._segmentation_lock:
+            return [self.segmentation.process(image).segmentation_mask for image in images]
     
     def get_person_segmentation(self, person_image: np.ndarray) -> np.ndarray:
         """Get precise person segmentation using MediaPipe or fallback method"""
@@ -62,55 +205,64 @@ class EnhancedVirtualTryOnProcessor:
             rgb_image = cv2.cvtColor(person_image, cv2.COLOR_BGR2RGB)
             
             # Get segmentation mask
-            results = self.segmentation.process(rgb_image)
-            mask = results.segmentation_mask
+            mask = self._segmentation_batcher(rgb_image)
             
-            # Convert to binary mask
-            binary_mask = (mask > 0.1).astype(np.uint8) * 255
-            
-            # Apply morphological operations to clean up the mask
-            kernel = np.ones((5, 5), np.uint8)
-            binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel)
-            binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, kernel)
-            
-            return binary_mask
+            return self._binary_person_mask(mask)
         else:
             # Fallback: Use simple color-based segmentation
             return self._fallback_person_segmentation(person_image)
     
-    def get_body_landmarks(self, person_image: np.ndarray) -> Optional[dict]:
+    def _binary_person_mask(self, mask: np.ndarray) -> np.ndarray:
+        """Threshold a MediaPipe segmentation mask and clean it up"""
+        # Convert to binary mask
+        binary_mask = (mask > 0.1).astype(np.uint8) * 255
+        
+        # Apply morphological operations to clean up the mask
+        kernel = np.ones((5, 5), np.uint8)
+        binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel)
+        binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, kernel)
+        
+        return binary_mask
+    
+    def get_body_landmarks(self, person_image: np.ndarray, model_complexity: int = 2) -> Optional[dict]:
         """Get body landmarks using MediaPipe Pose or fallback method"""
         if MEDIAPIPE_AVAILABLE and self.pose:
             # Use MediaPipe for pose detection
             rgb_image = cv2.cvtColor(person_image, cv2.COLOR_BGR2RGB)
             
             # Get pose landmarks
-            results = self.pose.process(rgb_image)
+            pose, pose_lock = self._get_pose(model_complexity)
+            with pose_lock:
+                results = pose.process(rgb_image)
             
             if results.pose_landmarks:
-                landmarks = results.pose_landmarks.landmark
-                h, w, _ = person_image.shape
-                
-                # Extract key body points
-                body_points = {
-                    'left_shoulder': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_SHOULDER].x * w),
-                                     int(landmarks[self.mp_pose.PoseLandmark.LEFT_SHOULDER].y * h)),
-                    'right_shoulder': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_SHOULDER].x * w),
-                                       int(landmarks[self.mp_pose.PoseLandmark.RIGHT_SHOULDER].y * h)),
-                    'left_hip': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_HIP].x * w),
-                                 int(landmarks[self.mp_pose.PoseLandmark.LEFT_HIP].y * h)),
-                    'right_hip': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP].x * w),
-                                  int(landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP].y * h)),
-                    'left_elbow': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_ELBOW].x * w),
-                                   int(landmarks[self.mp_pose.PoseLandmark.LEFT_ELBOW].y * h)),
-                    'right_elbow': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_ELBOW].x * w),
-                                    int(landmarks[self.mp_pose.PoseLandmark.RIGHT_ELBOW].y * h)),
-                }
-                return body_points
+                return self._pose_body_points(results.pose_landmarks, person_image.shape)
         
         # Fallback: Use simple heuristics for body detection
         return self._fallback_body_detection(person_image)
     
+    def _pose_body_points(self, pose_landmarks, shape: Tuple[int, ...]) -> dict:
+        """Key body points, in pixels, from MediaPipe Pose landmarks"""
+        landmarks = pose_landmarks.landmark
+        h, w = shape[:2]
+        
+        # Extract key body points
+        body_points = {
+            'left_shoulder': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_SHOULDER].x * w),
+                             int(landmarks[self.mp_pose.PoseLandmark.LEFT_SHOULDER].y * h)),
+            'right_shoulder': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_SHOULDER].x * w),
+                               int(landmarks[self.mp_pose.PoseLandmark.RIGHT_SHOULDER].y * h)),
+            'left_hip': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_HIP].x * w),
+                         int(landmarks[self.mp_pose.PoseLandmark.LEFT_HIP].y * h)),
+            'right_hip': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP].x * w),
+                          int(landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP].y * h)),
+            'left_elbow': (int(landmarks[self.mp_pose.PoseLandmark.LEFT_ELBOW].x * w),
+                           int(landmarks[self.mp_pose.PoseLandmark.LEFT_ELBOW].y * h)),
+            'right_elbow': (int(landmarks[self.mp_pose.PoseLandmark.RIGHT_ELBOW].x * w),
+                            int(landmarks[self.mp_pose.PoseLandmark.RIGHT_ELBOW].y * h)),
+        }
+        return body_points
+    
     def enhance_texture_preservation(self, clothing: np.ndarray) -> np.ndarray:
         """Enhance texture and pattern preservation in clothing"""
         # Convert to PIL for better texture processing
@@ -156,16 +308,54 @@ class EnhancedVirtualTryOnProcessor:
         
         return enhanced_clothing
     
-    def extract_clothing(self, cloth_image: np.ndarray) -> np.ndarray:
+    def segment_person_cached(self, person_image: np.ndarray, person_key: str,
+                              quality: QualityProfile) -> np.ndarray:
+        """Person mask, reused for every garment tried on the same upload"""
+        def compute():
+            mask = self.get_person_segmentation(person_image)
+            mask.flags.writeable = False
+            return mask
+        
+        return self.person_cache.get_or_create(("mask", person_key, quality.max_side), compute)
+    
+    def detect_landmarks_cached(self, person_image: np.ndarray, person_key: str,
+                                quality: QualityProfile) -> Optional[dict]:
+        """Body landmarks per upload and pose model; a missed detection is cached as well"""
+        key = ("landmarks", person_key, quality.max_side, quality.model_complexity)
+        (body_points,) = self.person_cache.get_or_create(
+            key, lambda: (self.get_body_landmarks(person_image, quality.model_complexity),))
+        return body_points
+    
+    def extract_clothing_cached(self, cloth_image: np.ndarray, cloth_key: str,
+                                quality: QualityProfile) -> np.ndarray:
+        """Background-removed, enhanced garment, reused across shoppers trying it on"""
+        def compute():
+            clothing = self.extract_clothing(cloth_image, quality.enhance_texture, quality.detect_patterns)
+            clothing.flags.writeable = False
+            return clothing
+        
+        return self.garment_cache.get_or_create(self.garment_cache_key(cloth_key, quality), compute)
+    
+    def garment_cache_key(self, cloth_key: str, quality: QualityProfile) -> tuple:
+        """Identifies an extracted garment: the upload plus the settings that shaped it"""
+        return (cloth_key, quality.max_side, quality.enhance_texture, quality.detect_patterns)
+    
+    def cached_analyses(self, person_key: str, cloth_key: str, quality: QualityProfile) -> Tuple[bool, bool]:
+        """Whether the person analysis and the garment extraction for a request are already cached"""
+        person_cached = (("mask", person_key, quality.max_side) in self.person_cache and
+                         ("landmarks", person_key, quality.max_side, quality.model_complexity) in self.person_cache)
+        garment_cached = self.garment_cache_key(cloth_key, quality) in self.garment_cache
+        return person_cached, garment_cached
+    
+    def extract_clothing(self, cloth_image: np.ndarray, enhance_texture: bool = True,
+                         detect_patterns: bool = True) -> np.ndarray:
         """Extract clothing from the garment image with enhanced background removal and texture preservation"""
         # Remove background from clothing image
-        cloth_no_bg = self.remove_background(cloth_image)
+        cloth_patterned = self.remove_background(cloth_image)
         
-        # Enhance texture preservation
-        cloth_enhanced = self.enhance_texture_preservation(cloth_no_bg)
-        
-        # Detect and preserve patterns
-        cloth_patterned = self.detect_and_preserve_patterns(cloth_enhanced)
+        # Enhance texture and preserve patterns in one pass over the RGBA buffer
+        if enhance_texture or detect_patterns:
+            cloth_patterned = enhance_garment_inplace(cloth_patterned, enhance_texture, detect_patterns)
         
         # Convert to RGBA if not already
         if cloth_patterned.shape[2] == 3:
@@ -177,79 +367,52 @@ class EnhancedVirtualTryOnProcessor:
     
     def remove_background(self, image: np.ndarray) -> np.ndarray:
         """Remove background from image using rembg with texture preservation"""
-        if REMBG_AVAILABLE:
-            # Use rembg for background removal
-            pil_image = Image.fromarray(image)
-            result = remove(pil_image)
-            return np.array(result)
+        if self.use_rembg:
+            # Use the shared, micro-batched rembg session for background removal
+            return get_background_removal_batcher()(image)
         else:
             # Fallback: Use simple color-based background removal
             return self._fallback_background_removal(image)
     
     def _fallback_background_removal(self, image: np.ndarray) -> np.ndarray:
-        """Fallback background removal using color-based segmentation"""
-        # Convert to HSV for better color segmentation
-        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-        
-        # Create a mask for white/light backgrounds
-        lower_white = np.array([0, 0, 200])
-        upper_white = np.array([180, 30, 255])
-        white_mask = cv2.inRange(hsv, lower_white, upper_white)
-        
-        # Create a mask for black/dark backgrounds
-        lower_black = np.array([0, 0, 0])
-        upper_black = np.array([180, 255, 50])
-        black_mask = cv2.inRange(hsv, lower_black, upper_black)
-        
-        # Combine masks
-        background_mask = cv2.bitwise_or(white_mask, black_mask)
-        
-        # Invert to get foreground mask
-        foreground_mask = cv2.bitwise_not(background_mask)
-        
-        # Apply morphological operations to clean up the mask
-        kernel = np.ones((5, 5), np.uint8)
-        foreground_mask = cv2.morphologyEx(foreground_mask, cv2.MORPH_CLOSE, kernel)
-        foreground_mask = cv2.morphologyEx(foreground_mask, cv2.MORPH_OPEN, kernel)
+        """Fallback background removal: drop white/light and black/dark backdrop colours"""
+        def foreground(frame):
+            # One table gather replaces the HSV conversion and inRange passes
+            foreground_mask = get_color_lut().mask(frame, BACKGROUND, invert=True)
+            
+            # Apply morphological operations to clean up the mask
+            kernel = np.ones((5, 5), np.uint8)
+            foreground_mask = cv2.morphologyEx(foreground_mask, cv2.MORPH_CLOSE, kernel)
+            return cv2.morphologyEx(foreground_mask, cv2.MORPH_OPEN, kernel)
         
         # Create RGBA image with alpha channel
         rgba = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
-        rgba[:, :, 3] = foreground_mask
+        rgba[:, :, 3] = classify_downscaled(image, self.fallback_max_side, foreground)
         
         return rgba
     
     def _fallback_person_segmentation(self, person_image: np.ndarray) -> np.ndarray:
-        """Fallback person segmentation using color-based detection"""
-        # Convert to HSV for better color segmentation
-        hsv = cv2.cvtColor(person_image, cv2.COLOR_BGR2HSV)
-        
-        # Create a mask for skin tones (common human skin colors)
-        lower_skin = np.array([0, 20, 70])
-        upper_skin = np.array([20, 255, 255])
-        skin_mask = cv2.inRange(hsv, lower_skin, upper_skin)
-        
-        # Create a mask for clothing colors (avoid white/black backgrounds)
-        lower_clothing = np.array([0, 0, 30])
-        upper_clothing = np.array([180, 255, 220])
-        clothing_mask = cv2.inRange(hsv, lower_clothing, upper_clothing)
-        
-        # Combine masks
-        person_mask = cv2.bitwise_or(skin_mask, clothing_mask)
-        
-        # Apply morphological operations to clean up the mask
-        kernel = np.ones((5, 5), np.uint8)
-        person_mask = cv2.morphologyEx(person_mask, cv2.MORPH_CLOSE, kernel)
-        person_mask = cv2.morphologyEx(person_mask, cv2.MORPH_OPEN, kernel)
-        
-        # Find contours and keep the largest one (assumed to be the person)
-        contours, _ = cv2.findContours(person_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        if contours:
-            largest_contour = max(contours, key=cv2.contourArea)
-            # Create a new mask with only the largest contour
-            person_mask = np.zeros_like(person_mask)
-            cv2.fillPoly(person_mask, [largest_contour], 255)
+        """Fallback person segmentation: skin and clothing colours, largest region kept"""
+        def segment(frame):
+            # Skin tones or clothing colours (not white/black backgrounds), in one table gather
+            person_mask = get_color_lut().mask(frame, PERSON)
+            
+            # Apply morphological operations to clean up the mask
+            kernel = np.ones((5, 5), np.uint8)
+            person_mask = cv2.morphologyEx(person_mask, cv2.MORPH_CLOSE, kernel)
+            person_mask = cv2.morphologyEx(person_mask, cv2.MORPH_OPEN, kernel)
+            
+            # Find contours and keep the largest one (assumed to be the person)
+            contours, _ = cv2.findContours(person_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if contours:
+                largest_contour = max(contours, key=cv2.contourArea)
+                # Create a new mask with only the largest contour
+                person_mask = np.zeros_like(person_mask)
+                cv2.fillPoly(person_mask, [largest_contour], 255)
+            
+            return person_mask
         
-        return person_mask
+        return classify_downscaled(person_image, self.fallback_max_side, segment)
     
     def _fallback_body_detection(self, person_image: np.ndarray) -> Optional[dict]:
         """Fallback body detection using simple heuristics"""
@@ -315,96 +478,215 @@ class EnhancedVirtualTryOnProcessor:
         
         return left_x, top_y, right_x - left_x, bottom_y - top_y
     
-    def resize_clothing_to_region(self, clothing: np.ndarray, region: Tuple[int, int, int, int]) -> np.ndarray:
+    def resize_clothing_to_region(self, clothing: np.ndarray, region: Tuple[int, int, int, int],
+                                  interpolation: int = cv2.INTER_LANCZOS4) -> np.ndarray:
         """Resize clothing to fit the calculated region with texture preservation"""
         x, y, w, h = region
         
         # Use high-quality interpolation for better texture preservation
-        resized_clothing = cv2.resize(clothing, (w, h), interpolation=cv2.INTER_LANCZOS4)
+        resized_clothing = cv2.resize(clothing, (w, h), interpolation=interpolation)
         
         return resized_clothing
     
+    def resize_garment_cached(self, clothing: np.ndarray, garment_key: tuple, width: int, height: int,
+                              interpolation: int = cv2.INTER_LANCZOS4, from_pyramid: bool = True) -> np.ndarray:
+        """Garment resized and cached per garment and size, starting from the nearest level
+        of its mip pyramid unless ``from_pyramid`` is off"""
+        def compute():
+            if from_pyramid:
+                pyramid = self.pyramid_cache.get_or_create(garment_key, lambda: build_pyramid(clothing))
+                resized = resize_from_pyramid(pyramid, width, height, interpolation)
+            else:
+                resized = cv2.resize(clothing, (width, height), interpolation=interpolation)
+            resized.flags.writeable = False
+            return resized
+        
+        return self.resize_cache.get_or_create((garment_key, width, height, interpolation, from_pyramid), compute)
+    
+    def mask_bounding_box(self, person_mask: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        """Bounding box of the largest person contour, or None if the mask is empty"""
+        contours, _ = cv2.findContours(person_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return None
+        return cv2.boundingRect(max(contours, key=cv2.contourArea))
+    
+    def fallback_garment_top(self, y: int, h: int, garment_type: str) -> int:
+        """Top edge of a garment placed on a mask bounding box"""
+        if garment_type.lower() in ['shirt', 'tshirt', 'top', 'blouse']:
+            return y + int(h * 0.1)
+        if garment_type.lower() in ['pants', 'trousers', 'jeans']:
+            return y + int(h * 0.4)
+        return y
+    
     def apply_texture_aware_blending(self, person_image: np.ndarray, clothing: np.ndarray, 
                                    person_mask: np.ndarray, body_points: Optional[dict], 
-                                   garment_type: str = "") -> np.ndarray:
+                                   garment_type: str = "", detail_boost: bool = True,
+                                   interpolation: int = cv2.INTER_LANCZOS4) -> np.ndarray:
         """Apply texture-aware blending to preserve clothing details"""
-        result = person_image.copy()
-        
-        # Convert to RGBA if needed
-        if result.shape[2] == 3:
-            alpha = np.ones((result.shape[0], result.shape[1]), dtype=np.uint8) * 255
-            result = np.dstack((result, alpha))
+        return self.blend_clothing(person_image, clothing, person_mask, body_points, garment_type,
+                                   detail_boost, interpolation)[0]
+    
+    def blend_clothing(self, person_image: np.ndarray, clothing: np.ndarray, 
+                       person_mask: np.ndarray, body_points: Optional[dict], 
+                       garment_type: str = "", detail_boost: bool = True,
+                       interpolation: int = cv2.INTER_LANCZOS4,
+                       out: Optional[np.ndarray] = None,
+                       scratch: Optional[ScratchScope] = None,
+                       region: Optional[Tuple[int, int, int, int]] = None
+                       ) -> Tuple[np.ndarray, Optional[CompositeRegion]]:
+        """Texture-aware blending that also reports the region it changed.
+        
+        The person image is copied once into ``out`` (allocated if not given) and the
+        garment is blended into a view of its target rectangle, so no other full-frame
+        buffers are created. Region-sized temporaries are borrowed from ``scratch``
+        when given, so the returned alpha is only valid while that scope is open.
+        A given ``region`` is used as the garment's placement instead of working it out.
+        """
+        if out is None:
+            out = np.empty(person_image.shape[:2] + (3,), dtype=np.uint8)
+        np.copyto(out, person_image[:, :, :3])
         
         # Calculate clothing region
-        if body_points:
+        if region is not None:
+            x, y = region[:2]
+        elif body_points:
             region = self.calculate_clothing_region(body_points, garment_type)
             x, y, w, h = region
         else:
             # Fallback to mask-based positioning
-            contours, _ = cv2.findContours(person_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if not contours:
-                return person_image
+            bbox = self.mask_bounding_box(person_mask)
+            if bbox is None:
+                return out, None
             
-            largest_contour = max(contours, key=cv2.contourArea)
-            x, y, w, h = cv2.boundingRect(largest_contour)
+            x, y, w, h = bbox
             # Adjust for clothing positioning
-            if garment_type.lower() in ['shirt', 'tshirt', 'top', 'blouse']:
-                y = y + int(h * 0.1)
-                h = int(h * 0.6)
-            elif garment_type.lower() in ['pants', 'trousers', 'jeans']:
-                y = y + int(h * 0.4)
-                h = int(h * 0.6)
-        
-        # Ensure clothing fits within image bounds
+            y = self.fallback_garment_top(y, h, garment_type)
+        
+        # Squeeze clothing that overflows the bottom or right edge of the frame
+        frame_h, frame_w = out.shape[:2]
         clothing_h, clothing_w = clothing.shape[:2]
         
-        if y + clothing_h > result.shape[0]:
-            clothing_h = result.shape[0] - y
-            clothing = cv2.resize(clothing, (clothing_w, clothing_h), interpolation=cv2.INTER_LANCZOS4)
-        
-        if x + clothing_w > result.shape[1]:
-            clothing_w = result.shape[1] - x
-            clothing = cv2.resize(clothing, (clothing_w, clothing_h), interpolation=cv2.INTER_LANCZOS4)
-        
-        # Ensure positive coordinates
-        if x < 0:
-            clothing_w += x
-            x = 0
-        if y < 0:
-            clothing_h += y
-            y = 0
-        
-        # Apply texture-aware blending
-        if clothing.shape[2] == 4 and clothing_h > 0 and clothing_w > 0:  # Has alpha channel
-            alpha = clothing[:clothing_h, :clothing_w, 3] / 255.0
-            alpha = np.expand_dims(alpha, axis=2)
-            
-            # Extract RGB channels
-            clothing_rgb = clothing[:clothing_h, :clothing_w, :3]
-            
-            # Create a mask for the clothing region that respects the person mask
-            region_mask = person_mask[y:y+clothing_h, x:x+clothing_w] / 255.0
-            region_mask = np.expand_dims(region_mask, axis=2)
-            
-            # Combine alpha with region mask
-            final_alpha = alpha * region_mask
-            
-            # Apply texture-preserving blending
-            for c in range(3):
-                # Use weighted blending to preserve texture details
-                original_region = result[y:y+clothing_h, x:x+clothing_w, c]
-                clothing_region = clothing_rgb[:, :, c]
-                
-                # Preserve high-frequency details from clothing
-                clothing_detail = clothing_region - cv2.GaussianBlur(clothing_region, (5, 5), 0)
-                
-                # Blend with texture preservation
-                blended = (1 - final_alpha[:, :, 0]) * original_region + \
-                         final_alpha[:, :, 0] * (clothing_region + 0.3 * clothing_detail)
-                
-                result[y:y+clothing_h, x:x+clothing_w, c] = np.clip(blended, 0, 255)
+        if y + clothing_h > frame_h and frame_h - y > 0:
+            clothing_h = frame_h - y
+            clothing = cv2.resize(clothing, (clothing_w, clothing_h), interpolation=interpolation)
+        
+        if x + clothing_w > frame_w and frame_w - x > 0:
+            clothing_w = frame_w - x
+            clothing = cv2.resize(clothing, (clothing_w, clothing_h), interpolation=interpolation)
+        
+        # Clip the part hanging off the top or left edge
+        src_x, src_y = max(0, -x), max(0, -y)
+        x, y = max(0, x), max(0, y)
+        clothing_w = min(clothing_w - src_x, frame_w - x)
+        clothing_h = min(clothing_h - src_y, frame_h - y)
+        
+        if clothing.shape[2] != 4 or clothing_h <= 0 or clothing_w <= 0:
+            return out, None
+        
+        # Apply texture-aware blending on views of the target rectangle
+        garment = clothing[src_y:src_y+clothing_h, src_x:src_x+clothing_w]
+        target = out[y:y+clothing_h, x:x+clothing_w]
+        
+        # Combine the garment alpha with the person mask so clothing stays on the body
+        final_alpha = scratch_array(scratch, (clothing_h, clothing_w), np.float32)
+        np.multiply(garment[:, :, 3], person_mask[y:y+clothing_h, x:x+clothing_w],
+                    out=final_alpha, dtype=np.float32)
+        final_alpha *= 1.0 / (255.0 * 255.0)
+        
+        clothing_rgb = garment[:, :, :3]
+        blended = scratch_array(scratch, (clothing_h, clothing_w, 3), np.float32)
+        if detail_boost:
+            # Preserve high-frequency details from clothing (uint8 difference, as before)
+            clothing_detail = cv2.GaussianBlur(clothing_rgb, (5, 5), 0,
+                                               dst=scratch_array(scratch, (clothing_h, clothing_w, 3)))
+            np.subtract(clothing_rgb, clothing_detail, out=clothing_detail)
+            np.multiply(clothing_detail, np.float32(0.3), out=blended, dtype=np.float32)
+            blended += clothing_rgb
+            blended -= target
+        else:
+            np.subtract(clothing_rgb, target, out=blended, dtype=np.float32)
+        
+        # target + alpha * (clothing - target), written back into the output view
+        blended *= final_alpha[:, :, None]
+        blended += target
+        np.clip(blended, 0, 255, out=blended)
+        target[...] = blended
         
-        return result
+        return out, CompositeRegion(x, y, clothing_w, clothing_h, final_alpha)
+    
+    def get_luminance_stats(self, person_image: np.ndarray, person_key: Optional[str] = None) -> LuminanceStats:
+        """Luminance of the original person image, cached per upload and working size"""
+        def compute():
+            l_plane = cv2.cvtColor(person_image, cv2.COLOR_RGB2LAB)[:, :, 0].copy()
+            tile = max(16, -(-min(l_plane.shape) // max(1, self.lighting_tiles)))
+            pixel_sum = float(sum(cv2.sumElems(person_image)[:3]))
+            return LuminanceStats(l_plane, tile, float(l_plane.mean()), pixel_sum)
+        
+        if person_key is None:
+            return compute()
+        return self.luminance_cache.get_or_create((person_key, person_image.shape), compute)
+    
+    def correct_lighting_in_region(self, result_image: np.ndarray, region: CompositeRegion,
+                                   luminance: LuminanceStats, strength: float = 0.7,
+                                   scratch: Optional[ScratchScope] = None) -> np.ndarray:
+        """Match the composited garment's lighting to the original, inside its region only.
+        
+        Works like ``enhance_lighting_consistency`` but with a per-tile mean instead of one
+        global mean: each tile's brightness change is pulled back towards the original and
+        the correction is applied in proportion to the garment's blend weight.
+        """
+        x, y, w, h, alpha = region
+        tile = luminance.tile
+        frame_h, frame_w = luminance.l_plane.shape
+        
+        # Only the composited rectangle goes through LAB
+        lab_roi = cv2.cvtColor(result_image[y:y+h, x:x+w], cv2.COLOR_RGB2LAB,
+                               dst=scratch_array(scratch, (h, w, 3)))
+        l_result = scratch_array(scratch, (h, w), np.float32)
+        np.copyto(l_result, lab_roi[:, :, 0])
+        l_change = np.subtract(l_result, luminance.l_plane[y:y+h, x:x+w],
+                               out=scratch_array(scratch, (h, w), np.float32))
+        
+        # Sum the brightness change over every tile the region touches
+        ty0, tx0 = y // tile, x // tile
+        ty1, tx1 = -(-(y + h) // tile), -(-(x + w) // tile)
+        oy, ox = y - ty0 * tile, x - tx0 * tile
+        padded = scratch_array(scratch, ((ty1 - ty0) * tile, (tx1 - tx0) * tile), np.float32)
+        padded.fill(0)
+        padded[oy:oy+h, ox:ox+w] = l_change
+        tile_change = padded.reshape(ty1 - ty0, tile, tx1 - tx0, tile).sum(axis=(1, 3))
+        tile_rows = np.minimum(tile, frame_h - np.arange(ty0, ty1) * tile)
+        tile_cols = np.minimum(tile, frame_w - np.arange(tx0, tx1) * tile)
+        correction = -strength * tile_change / np.outer(tile_rows, tile_cols)
+        
+        # Interpolate between tile centres and weight by how much garment each pixel holds
+        field = cv2.resize(correction.astype(np.float32), (padded.shape[1], padded.shape[0]),
+                           interpolation=cv2.INTER_LINEAR)[oy:oy+h, ox:ox+w]
+        field *= alpha
+        l_result += field
+        lab_roi[:, :, 0] = np.clip(l_result, 0, 255, out=l_result)
+        corrected = cv2.cvtColor(lab_roi, cv2.COLOR_LAB2RGB, dst=scratch_array(scratch, (h, w, 3)))
+        np.copyto(result_image[y:y+h, x:x+w], corrected, where=(alpha > 0)[:, :, None])
+        
+        return result_image
+    
+    def apply_lighting(self, composite: np.ndarray, region: Optional[CompositeRegion],
+                       luminance: LuminanceStats, scratch: Optional[ScratchScope] = None) -> np.ndarray:
+        """Lighting stage: correct the composited region in place"""
+        if region is None:
+            # Nothing was composited, so the lighting already matches
+            return composite
+        return self.correct_lighting_in_region(composite, region, luminance, scratch=scratch)
+    
+    def result_mean(self, result: np.ndarray, person_image: np.ndarray, region: Optional[CompositeRegion],
+                    luminance: LuminanceStats) -> float:
+        """Mean pixel value of the result, updated from the composited region only"""
+        total = luminance.pixel_sum
+        if region is not None:
+            x, y, w, h, _ = region
+            total += sum(cv2.sumElems(result[y:y+h, x:x+w])[:3])
+            total -= sum(cv2.sumElems(person_image[y:y+h, x:x+w])[:3])
+        return total / result.size
     
     def enhance_lighting_consistency(self, result_image: np.ndarray, original_image: np.ndarray) -> np.ndarray:
         """Enhance lighting consistency while preserving texture details"""
@@ -427,71 +709,255 @@ class EnhancedVirtualTryOnProcessor:
         
         return enhanced_result
     
+    def garment_region(self, body_points: Optional[dict], person_mask: np.ndarray,
+                       garment_type: str = "") -> Optional[Tuple[int, int, int, int]]:
+        """Rectangle the garment goes on: from body landmarks, or else from the person mask"""
+        if body_points:
+            return self.calculate_clothing_region(body_points, garment_type)
+        bbox = self.mask_bounding_box(person_mask)
+        if bbox is None:
+            return None
+        x, y, w, h = bbox
+        return x, self.fallback_garment_top(y, h, garment_type), w, h
+    
+    def fitted_size(self, region: Tuple[int, int, int, int], frame_shape: Tuple[int, ...],
+                    bucket_px: int = 1) -> Tuple[int, int]:
+        """Garment size for a region: quantized to ``bucket_px`` and squeezed into the frame
+        at the spot ``blend_clothing`` will place it, so the garment is only resampled once"""
+        x, y, w, h = region
+        w, h = size_bucket(w, h, bucket_px)
+        
+        frame_h, frame_w = frame_shape[:2]
+        if y + h > frame_h and frame_h - y > 0:
+            h = frame_h - y
+        if x + w > frame_w and frame_w - x > 0:
+            w = frame_w - x
+        return w, h
+    
+    def fit_clothing(self, clothing: np.ndarray, body_points: Optional[dict], person_mask: np.ndarray,
+                     garment_type: str = "", interpolation: int = cv2.INTER_LANCZOS4,
+                     garment_key: Optional[tuple] = None,
+                     region: Optional[Tuple[int, int, int, int]] = None,
+                     approximate: bool = False) -> np.ndarray:
+        """Resize the extracted clothing to the body region it will be placed on.
+        
+        With a ``garment_key`` the result is cached. ``approximate`` quantizes the size to
+        ``TRYON_RESIZE_BUCKET_PX``, resizes from the garment's mip pyramid and squeezes it
+        into the frame in the same step; otherwise the full-resolution garment is resized
+        to the exact region and ``blend_clothing`` squeezes any overflow as before.
+        ``region`` overrides the placement worked out from the body.
+        """
+        if region is None:
+            region = self.garment_region(body_points, person_mask, garment_type)
+        if region is None:
+            print("No contours found, using original clothing size")
+            return clothing
+        print(f"{'Calculated' if body_points else 'Fallback'} region: {region}")
+        
+        if approximate:
+            w, h = self.fitted_size(region, person_mask.shape, self.resize_bucket_px)
+        else:
+            w, h = region[2:]
+        
+        if garment_key is None:
+            return self.resize_clothing_to_region(clothing, (region[0], region[1], w, h), interpolation)
+        return self.resize_garment_cached(clothing, garment_key, w, h, interpolation, from_pyramid=approximate)
+    
+    def frame_output(self, person_img: np.ndarray, person_mask: np.ndarray, body_points: Optional[dict],
+                     garment_type: str, output: Optional[OutputSpec], scratch: Optional[ScratchScope] = None
+                     ) -> Tuple[np.ndarray, np.ndarray, Optional[dict], Optional[FramePlan],
+                                Optional[Tuple[int, int, int, int]]]:
+        """Crop and scale the analysed person to the requested output before anything is composited.
+        
+        Segmentation and landmarks stay at the working size; the image, mask and body
+        points are moved into the output frame, so compositing, lighting and encoding
+        only touch the pixels the client will display. The garment's placement is worked
+        out at the working size and mapped across too, since its margins are in pixels.
+        """
+        person_box = self.mask_bounding_box(person_mask) if output is not None and output.crop_to_person else None
+        plan = plan_frame(person_img.shape, output, person_box)
+        if plan is None:
+            return person_img, person_mask, body_points, None, None
+        
+        region = self.garment_region(body_points, person_mask, garment_type)
+        if region is not None:
+            sx, sy = plan.out_w / plan.w, plan.out_h / plan.h
+            x, y, w, h = region
+            region = (int(round((x - plan.x) * sx)), int(round((y - plan.y) * sy)),
+                      max(1, int(round(w * sx))), max(1, int(round(h * sy))))
+        
+        resized = (plan.out_w, plan.out_h) != (plan.w, plan.h)
+        frame = reframe(person_img, plan, dst=scratch_array(scratch, (plan.out_h, plan.out_w, 3)) if resized else None)
+        mask = reframe(person_mask, plan, cv2.INTER_NEAREST)
+        print(f"Output frame: {plan.w}x{plan.h} at ({plan.x}, {plan.y}) rendered at {plan.out_w}x{plan.out_h}")
+        return frame, mask, reframe_points(body_points, plan), plan, region
+    
+    def frame_luminance(self, frame_img: np.ndarray, frame_plan: Optional[FramePlan], person_key: str,
+                        person_luminance: Optional[LuminanceStats]) -> LuminanceStats:
+        """Luminance of the output frame: the person image's own unless it was reframed"""
+        if frame_plan is None and person_luminance is not None:
+            return person_luminance
+        return self.get_luminance_stats(frame_img, person_key if frame_plan is None else (person_key, frame_plan))
+    
+    def render_preview(self, person_img: np.ndarray, clothing: np.ndarray, person_mask: np.ndarray,
+                       body_points: Optional[dict], garment_type: str, quality: QualityProfile,
+                       on_preview: Optional[Callable[[np.ndarray], None]]) -> Optional[np.ndarray]:
+        """Composite the garment at most ``preview_max_side`` wide or tall, with the request's mask and landmarks
+        and hand the result to ``on_preview``, ahead of the full-resolution composite.
+        
+        Nothing is rendered without a callback, or when the working image is already no
+        larger than the preview (the full result then costs about the same).
+        """
+        frame_h, frame_w = person_img.shape[:2]
+        factor = -(-max(frame_h, frame_w) // max(1, self.preview_max_side))
+        if on_preview is None or factor <= 1:
+            return None
+        
+        # Whole-number factors take OpenCV's fast area-averaging path (about 2.5x faster);
+        # the few edge pixels that do not fill a block are dropped
+        size = (max(1, frame_w // factor), max(1, frame_h // factor))
+        crop = (slice(0, size[1] * factor), slice(0, size[0] * factor))
+        small = cv2.resize(person_img[crop], size, interpolation=cv2.INTER_AREA)
+        mask = cv2.resize(person_mask[crop], size, interpolation=cv2.INTER_NEAREST)
+        points = None
+        if body_points:
+            points = {name: (x // factor, y // factor) for name, (x, y) in body_points.items()}
+        
+        garment = clothing
+        region = self.garment_region(points, mask, garment_type)
+        if region is not None:
+            garment = cv2.resize(clothing, self.fitted_size(region, small.shape), interpolation=cv2.INTER_AREA)
+        composite, composite_region = self.blend_clothing(small, garment, mask, points, garment_type,
+                                                          quality.detail_boost, cv2.INTER_LINEAR)
+        preview = self.apply_lighting(composite, composite_region, self.get_luminance_stats(small))
+        on_preview(preview)
+        return preview
+    
+    def build_pipeline(self) -> StageGraph:
+        """Describe the try-on as a graph of stages.
+        
+        The person branch (segmentation, landmarks) and the garment branch (background
+        removal, texture enhancement) only meet at ``fit_clothing``, so they run in parallel.
+        Stage settings come from the request's ``QualityProfile``; ``scratch`` is the
+        request's ``ScratchScope`` for pooled temporaries.
+        """
+        return StageGraph([
+            Stage("decode_person",
+                  lambda person_bytes, quality, scratch: self.decode_image(person_bytes, quality.max_side, scratch),
+                  ["person_bytes", "quality", "scratch"], ["person_img"]),
+            Stage("decode_cloth",
+                  lambda cloth_bytes, quality, scratch: self.decode_image(cloth_bytes, quality.max_side, scratch),
+                  ["cloth_bytes", "quality", "scratch"], ["cloth_img"]),
+            Stage("hash_person", image_digest, ["person_bytes"], ["person_key"]),
+            Stage("hash_cloth", image_digest, ["cloth_bytes"], ["cloth_key"]),
+            # Overlaps segmentation when the full frame is rendered; a reframed output gets its own below
+            Stage("person_luminance",
+                  lambda person_img, person_key, output:
+                      self.get_luminance_stats(person_img, person_key) if output is None else None,
+                  ["person_img", "person_key", "output"], ["person_luminance"]),
+            Stage("segment_person", self.segment_person_cached,
+                  ["person_img", "person_key", "quality"], ["person_mask"]),
+            Stage("detect_landmarks", self.detect_landmarks_cached,
+                  ["person_img", "person_key", "quality"], ["body_points"]),
+            Stage("extract_clothing", self.extract_clothing_cached,
+                  ["cloth_img", "cloth_key", "quality"], ["clothing"]),
+            Stage("frame_output", self.frame_output,
+                  ["person_img", "person_mask", "body_points", "garment_type", "output", "scratch"],
+                  ["frame_img", "frame_mask", "frame_points", "frame_plan", "frame_region"]),
+            Stage("frame_luminance", self.frame_luminance,
+                  ["frame_img", "frame_plan", "person_key", "person_luminance"], ["luminance"]),
+            Stage("fit_clothing",
+                  lambda clothing, frame_points, frame_mask, frame_region, garment_type, quality, cloth_key:
+                      self.fit_clothing(
+                          clothing, frame_points, frame_mask, garment_type, quality.interpolation,
+                          self.garment_cache_key(cloth_key, quality), frame_region, quality.approximate_resize),
+                  ["clothing", "frame_points", "frame_mask", "frame_region", "garment_type", "quality", "cloth_key"],
+                  ["resized_clothing"]),
+            # Listed after fit_clothing so it runs on the request thread while the garment resizes
+            Stage("preview", self.render_preview,
+                  ["frame_img", "clothing", "frame_mask", "frame_points", "garment_type", "quality", "on_preview"],
+                  ["preview"]),
+            Stage("composite",
+                  lambda frame_img, resized_clothing, frame_mask, frame_points, frame_region, garment_type, quality,
+                         scratch:
+                      self.blend_clothing(
+                          frame_img, resized_clothing, frame_mask, frame_points, garment_type,
+                          quality.detail_boost, quality.interpolation, scratch=scratch, region=frame_region),
+                  ["frame_img", "resized_clothing", "frame_mask", "frame_points", "frame_region", "garment_type",
+                   "quality", "scratch"],
+                  ["composite", "composite_region"]),
+            Stage("lighting", self.apply_lighting,
+                  ["composite", "composite_region", "luminance", "scratch"], ["result"]),
+        ], initial_inputs=["person_bytes", "cloth_bytes", "garment_type", "quality", "scratch", "on_preview",
+                           "output"])
+    
     def process_virtual_tryon(self, person_image_bytes: bytes, cloth_image_bytes: bytes, 
-                            garment_type: str = "", instructions: str = "") -> Tuple[np.ndarray, str]:
-        """Main method to process virtual try-on with enhanced texture preservation"""
+                            garment_type: str = "", instructions: str = "",
+                            timings: Optional[Dict[str, float]] = None,
+                            quality: Optional[QualityProfile] = None,
+                            on_preview: Optional[Callable[[np.ndarray], None]] = None,
+                            output: Optional[OutputSpec] = None) -> Tuple[np.ndarray, str]:
+        """Main method to process virtual try-on with enhanced texture preservation.
+        
+        ``on_preview`` is called from a pipeline thread with a small preview composite
+        as soon as the analysis is done, before the full-resolution result. With an
+        ``output`` spec the result is composited at that size, cropped to the person
+        if asked, rather than at the working size.
+        """
         try:
+            if quality is None:
+                quality = get_quality_profile()
+            
             print("=== Enhanced Virtual Try-On Processing ===")
             print(f"MediaPipe available: {MEDIAPIPE_AVAILABLE}")
             print(f"REMBG available: {REMBG_AVAILABLE}")
+            print(f"Quality profile: {quality.name}")
             
-            # Preprocess images
-            person_img, cloth_img = self.preprocess_images(person_image_bytes, cloth_image_bytes)
-            print(f"Person image shape: {person_img.shape}")
-            print(f"Cloth image shape: {cloth_img.shape}")
-            
-            # Get person segmentation
-            person_mask = self.get_person_segmentation(person_img)
-            print(f"Person mask shape: {person_mask.shape}")
-            print(f"Person mask unique values: {np.unique(person_mask)}")
-            
-            # Get body landmarks
-            body_points = self.get_body_landmarks(person_img)
-            print(f"Body points detected: {body_points is not None}")
-            if body_points:
-                print(f"Body points: {body_points}")
-            
-            # Extract clothing from garment image with texture preservation
-            clothing = self.extract_clothing(cloth_img)
-            print(f"Extracted clothing shape: {clothing.shape}")
-            
-            # Calculate clothing region
-            if body_points:
-                region = self.calculate_clothing_region(body_points, garment_type)
-                print(f"Calculated region: {region}")
-                resized_clothing = self.resize_clothing_to_region(clothing, region)
-            else:
-                # Fallback to simple resizing
-                print("Using fallback resizing method")
-                contours, _ = cv2.findContours(person_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                if contours:
-                    largest_contour = max(contours, key=cv2.contourArea)
-                    x, y, w, h = cv2.boundingRect(largest_contour)
-                    print(f"Fallback region: x={x}, y={y}, w={w}, h={h}")
-                    resized_clothing = cv2.resize(clothing, (w, h), interpolation=cv2.INTER_LANCZOS4)
-                else:
-                    print("No contours found, using original clothing size")
-                    resized_clothing = clothing
-            
-            print(f"Resized clothing shape: {resized_clothing.shape}")
-            
-            # Apply texture-aware blending
-            result = self.apply_texture_aware_blending(person_img, resized_clothing, person_mask, body_points, garment_type)
-            
-            # Enhance lighting consistency while preserving texture
-            result = self.enhance_lighting_consistency(result, person_img)
-            
-            # Validate result
-            print(f"Final result shape: {result.shape}")
-            print(f"Result data type: {result.dtype}")
-            print(f"Result value range: {result.min()} to {result.max()}")
-            
-            # Basic validation - ensure result is not completely black or white
-            if result.mean() < 10 or result.mean() > 245:
-                print("WARNING: Result image appears to be mostly black or white!")
-                # Return original person image as fallback
-                result = person_img.copy()
-                description = "Warning: Processing failed, returning original image"
+            # Run the stage graph; person analysis and garment extraction overlap
+            stage_timings = {} if timings is None else timings
+            # Temporaries borrowed from the scratch pool go back when the scope closes;
+            # the composited result is allocated normally so it can outlive the request
+            with get_buffer_pool().scope() as scratch:
+                values = self.pipeline.run(
+                    {
+                        "person_bytes": person_image_bytes,
+                        "cloth_bytes": cloth_image_bytes,
+                        "garment_type": garment_type,
+                        "quality": quality,
+                        "scratch": scratch,
+                        "on_preview": on_preview,
+                        "output": output,
+                    },
+                    executor=get_pipeline_executor(),
+                    timings=stage_timings,
+                )
+                person_img = values["person_img"]
+                frame_img = values["frame_img"]
+                body_points = values["body_points"]
+                result = values["result"]
+                
+                print(f"Person image shape: {person_img.shape}")
+                print(f"Cloth image shape: {values['cloth_img'].shape}")
+                print(f"Person mask shape: {values['person_mask'].shape}")
+                print(f"Body points detected: {body_points is not None}")
+                print(f"Extracted clothing shape: {values['clothing'].shape}")
+                print(f"Resized clothing shape: {values['resized_clothing'].shape}")
+                print("Stage timings (ms): " + ", ".join(f"{name}={ms:.1f}" for name, ms in stage_timings.items()))
+                print(f"Scratch buffers: {scratch.stats()}")
+                
+                # Validate result
+                mean_value = self.result_mean(result, frame_img, values["composite_region"],
+                                              values["luminance"])
+                print(f"Final result shape: {result.shape}")
+                print(f"Result data type: {result.dtype}")
+                print(f"Result mean value: {mean_value:.1f}")
+                
+                # Basic validation - ensure result is not completely black or white
+                if mean_value < 10 or mean_value > 245:
+                    print("WARNING: Result image appears to be mostly black or white!")
+                    # Return original person image as fallback
+                    result = frame_img.copy()
+                    description = "Warning: Processing failed, returning original image"
             
             # Generate description
             description = self.generate_description(garment_type, instructions, body_points is not None)
@@ -517,18 +983,11 @@ class EnhancedVirtualTryOnProcessor:
         
         return base_description
     
-    def numpy_to_base64(self, image: np.ndarray) -> str:
-        """Convert numpy array to base64 string"""
-        # Convert to PIL Image
-        pil_image = Image.fromarray(image)
-        
-        # Convert to bytes
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='PNG')
-        img_bytes = buffer.getvalue()
-        
-        # Convert to base64
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        
-        return f"data:image/png;base64,{img_base64}"
+    def encode_image(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> bytes:
+        """Encode a numpy array as PNG, JPEG or WEBP bytes"""
+        return encode_image(image, image_format, quality)
+    
+    def numpy_to_base64(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> str:
+        """Convert numpy array to a base64 data URL"""
+        return image_to_data_url(image, image_format, quality)
 
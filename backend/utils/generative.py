@@ -0,0 +1,313 @@
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# httpx ships with google-genai; the REST API is called directly so pooling, timeouts
+# and retries can be tuned here and pointed at mock_gemini_server.py
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+from utils.cache import LRUCache, image_digest
+from utils.output_size import OutputSpec, fit_to_output
+from utils.quality import QualityProfile, get_quality_profile
+from utils.thread_budget import get_request_executor
+
+DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com"
+DEFAULT_MODEL = "gemini-2.5-flash-image"
+
+# Worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class GenerativeError(Exception):
+    """The generative backend failed or returned no image"""
+
+
+class GeminiSettings(NamedTuple):
+    api_key: Optional[str]
+    base_url: str
+    model: str
+    max_concurrency: int
+    timeout_seconds: float
+    retries: int
+    backoff_seconds: float
+    budget_seconds: float
+    cache_size: int
+
+
+def gemini_settings_from_env() -> GeminiSettings:
+    """Settings from GEMINI_API_KEY and the TRYON_GEMINI_* variables"""
+    return GeminiSettings(
+        api_key=os.getenv("GEMINI_API_KEY"),
+        base_url=os.getenv("TRYON_GEMINI_BASE_URL", DEFAULT_BASE_URL).rstrip("/"),
+        model=os.getenv("TRYON_GEMINI_MODEL", DEFAULT_MODEL),
+        max_concurrency=max(1, int(os.getenv("TRYON_GEMINI_MAX_CONCURRENCY", "4"))),
+        timeout_seconds=float(os.getenv("TRYON_GEMINI_TIMEOUT_SECONDS", "30")),
+        retries=max(0, int(os.getenv("TRYON_GEMINI_RETRIES", "3"))),
+        backoff_seconds=float(os.getenv("TRYON_GEMINI_BACKOFF_SECONDS", "0.5")),
+        budget_seconds=float(os.getenv("TRYON_GEMINI_BUDGET_SECONDS", "20")),
+        cache_size=int(os.getenv("TRYON_GEMINI_CACHE_SIZE", "32")),
+    )
+
+
+def image_mime_type(image_bytes: bytes) -> str:
+    if image_bytes.startswith(b"\x89PNG"):
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def tryon_prompt(garment_type: str, instructions: str) -> str:
+    garment = garment_type or "garment"
+    prompt = (f"Dress the person in the first image in the {garment} shown in the second image. "
+              "Keep the person's face, pose, body shape, background and lighting unchanged, "
+              "and preserve the garment's colours, texture and patterns.")
+    if instructions:
+        prompt += f" Additional instructions: {instructions}"
+    return prompt
+
+
+class GeminiClient:
+    """Async Gemini ``generateContent`` client shared by every request.
+
+    One pooled HTTP client keeps connections alive between calls, a semaphore caps
+    concurrent calls, each attempt has a timeout, and rate-limit/server errors are
+    retried with exponential backoff and full jitter (honouring ``Retry-After``).
+    Identical prompt+image requests share one in-flight call, and recent results are
+    kept, so a retried or duplicated request does not cost a second generation.
+
+    All methods must run on one event loop; ``GenerativeTryOnEngine`` owns it.
+    """
+
+    def __init__(self, settings: GeminiSettings):
+        if not HTTPX_AVAILABLE:
+            raise RuntimeError("httpx is required for the generative engine")
+        self.settings = settings
+        self._client = None
+        self._semaphore = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.results = LRUCache(settings.cache_size, "generative")
+        self.latencies_ms = deque(maxlen=256)
+        self.counts = {"calls": 0, "attempts": 0, "retries": 0, "errors": 0,
+                       "deduplicated": 0, "cached": 0}
+
+    def _http(self) -> "httpx.AsyncClient":
+        if self._client is None:
+            limit = self.settings.max_concurrency
+            self._client = httpx.AsyncClient(
+                base_url=self.settings.base_url,
+                timeout=httpx.Timeout(self.settings.timeout_seconds, connect=10.0),
+                limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+            )
+            self._semaphore = asyncio.Semaphore(limit)
+        return self._client
+
+    async def generate(self, prompt: str, images: List[bytes]) -> Tuple[bytes, str]:
+        """Generated image bytes and any text for a prompt and input images"""
+        key = hashlib.blake2b(
+            "|".join([self.settings.model, prompt] + [image_digest(image) for image in images]).encode(),
+            digest_size=16,
+        ).hexdigest()
+        cached = self.results.get(key)
+        if cached is not None:
+            self.counts["cached"] += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, prompt, images))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.counts["deduplicated"] += 1
+        # Shielded, so a caller giving up on its budget leaves the call running for the others
+        return await asyncio.shield(task)
+
+    async def _generate(self, key: str, prompt: str, images: List[bytes]) -> Tuple[bytes, str]:
+        body = {
+            "contents": [{
+                "role": "user",
+                "parts": [{"text": prompt}] + [
+                    {"inline_data": {"mime_type": image_mime_type(image),
+                                     "data": base64.b64encode(image).decode("ascii")}}
+                    for image in images
+                ],
+            }],
+            "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]},
+        }
+        headers = {"x-goog-api-key": self.settings.api_key} if self.settings.api_key else {}
+        path = f"/v1beta/models/{self.settings.model}:generateContent"
+        client = self._http()
+
+        self.counts["calls"] += 1
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            self.counts["attempts"] += 1
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    response = await client.post(path, json=body, headers=headers)
+                if response.status_code == 200:
+                    try:
+                        payload = response.json()
+                    except ValueError:
+                        raise GenerativeError("Gemini returned a response that is not JSON")
+                    result = self._parse(payload)
+                    self.latencies_ms.append((time.perf_counter() - start) * 1000)
+                    self.results.put(key, result)
+                    return result
+                if response.status_code not in RETRY_STATUSES:
+                    raise GenerativeError(f"Gemini returned HTTP {response.status_code}: {response.text[:200]}")
+                error = GenerativeError(f"Gemini returned HTTP {response.status_code}")
+                retry_after = response.headers.get("retry-after")
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = GenerativeError(f"Gemini request failed: {e!r}")
+            except GenerativeError:
+                self.counts["errors"] += 1
+                raise
+
+            if attempt >= self.settings.retries:
+                self.counts["errors"] += 1
+                raise error
+            attempt += 1
+            self.counts["retries"] += 1
+            # Full jitter: spread retries out so clients do not come back in lockstep
+            delay = random.uniform(0, self.settings.backoff_seconds * 2 ** attempt)
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _parse(payload: dict) -> Tuple[bytes, str]:
+        """Image bytes and text of a generateContent response; GenerativeError when it is malformed"""
+        image, texts = None, []
+        try:
+            for candidate in payload.get("candidates") or []:
+                for part in (candidate.get("content") or {}).get("parts") or []:
+                    inline = part.get("inlineData") or part.get("inline_data")
+                    if inline and image is None:
+                        image = base64.b64decode(inline["data"], validate=True)
+                    elif part.get("text"):
+                        texts.append(str(part["text"]))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise GenerativeError(f"Gemini returned a malformed response: {e!r}") from e
+        if image is None:
+            raise GenerativeError("Gemini returned no image")
+        return image, " ".join(texts)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies_ms)
+        return {
+            **self.counts,
+            "inflight": len(self._inflight),
+            "latency_p50_ms": round(statistics.median(latencies), 1) if latencies else None,
+            "latency_p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 1) if latencies else None,
+        }
+
+
+class GenerativeTryOnEngine:
+    """Try-on through Gemini image generation, with the local CV pipeline as fallback.
+
+    The HTTP client lives on the engine's own event loop thread, so connections are
+    reused by API requests, the bulk CLI and benchmarks alike. A request that has no
+    result within ``TRYON_GEMINI_BUDGET_SECONDS`` (or whose call fails) is served by
+    the fallback processor instead; the generation keeps running and lands in the
+    result cache for the next identical request.
+    """
+
+    def __init__(self, fallback, settings: Optional[GeminiSettings] = None):
+        self.fallback = fallback
+        self.settings = settings or gemini_settings_from_env()
+        self.client = GeminiClient(self.settings)
+        self.fallbacks = {"budget": 0, "error": 0}
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True).start()
+        print(f"✨ Generative engine: {self.settings.model} at {self.settings.base_url} "
+              f"(concurrency {self.settings.max_concurrency}, budget {self.settings.budget_seconds:g}s)")
+
+    async def _process(self, person_image_bytes: bytes, cloth_image_bytes: bytes, garment_type: str,
+                       instructions: str, timings: Dict[str, float], quality: QualityProfile,
+                       output: Optional[OutputSpec]) -> Tuple[np.ndarray, str]:
+        start = time.perf_counter()
+        prompt = tryon_prompt(garment_type, instructions)
+        try:
+            image_bytes, text = await asyncio.wait_for(
+                self.client.generate(prompt, [person_image_bytes, cloth_image_bytes]),
+                self.settings.budget_seconds,
+            )
+            timings["generate"] = (time.perf_counter() - start) * 1000
+            # The model returns a whole frame, so it can only be sized afterwards
+            result = fit_to_output(self.fallback.decode_image(image_bytes, quality.max_side), output)
+            description = text or (f"Generative virtual try-on completed: the {garment_type or 'garment'} "
+                                   "was rendered onto your photo by the image model.")
+            return result, description
+        except (asyncio.TimeoutError, GenerativeError, ValueError) as e:
+            reason = "budget" if isinstance(e, asyncio.TimeoutError) else "error"
+            self.fallbacks[reason] += 1
+            print(f"⚠️ Generative try-on fell back to the CV pipeline ({reason}: {str(e) or 'over budget'})")
+            timings["generate"] = (time.perf_counter() - start) * 1000
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            get_request_executor(),
+            partial(self.fallback.process_virtual_tryon, person_image_bytes, cloth_image_bytes,
+                    garment_type, instructions, timings=timings, quality=quality, output=output),
+        )
+
+    def _submit(self, person_image_bytes, cloth_image_bytes, garment_type, instructions, timings, quality,
+                output):
+        return asyncio.run_coroutine_threadsafe(
+            self._process(person_image_bytes, cloth_image_bytes, garment_type, instructions,
+                          {} if timings is None else timings, quality or get_quality_profile(), output),
+            self._loop,
+        )
+
+    async def process_virtual_tryon_async(self, person_image_bytes: bytes, cloth_image_bytes: bytes,
+                                          garment_type: str = "", instructions: str = "",
+                                          timings: Optional[Dict[str, float]] = None,
+                                          quality: Optional[QualityProfile] = None,
+                                          output: Optional[OutputSpec] = None) -> Tuple[np.ndarray, str]:
+        """Await a try-on from another event loop (the API's) without tying up a worker thread"""
+        return await asyncio.wrap_future(self._submit(
+            person_image_bytes, cloth_image_bytes, garment_type, instructions, timings, quality, output))
+
+    def process_virtual_tryon(self, person_image_bytes: bytes, cloth_image_bytes: bytes,
+                              garment_type: str = "", instructions: str = "",
+                              timings: Optional[Dict[str, float]] = None,
+                              quality: Optional[QualityProfile] = None,
+                              output: Optional[OutputSpec] = None) -> Tuple[np.ndarray, str]:
+        """Blocking form, for the bulk CLI and benchmarks"""
+        return self._submit(person_image_bytes, cloth_image_bytes, garment_type, instructions,
+                            timings, quality, output).result()
+
+    def cached_analyses(self, person_key: str, cloth_key: str, quality: QualityProfile) -> Tuple[bool, bool]:
+        return self.fallback.cached_analyses(person_key, cloth_key, quality)
+
+    def cache_stats(self) -> dict:
+        stats = self.fallback.cache_stats()
+        stats["generative"] = {**self.client.stats(), "fallbacks": dict(self.fallbacks)}
+        return stats
+
+    def encode_image(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> bytes:
+        return self.fallback.encode_image(image, image_format, quality)
+
+    def numpy_to_base64(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> str:
+        return self.fallback.numpy_to_base64(image, image_format, quality)
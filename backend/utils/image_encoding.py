@@ -0,0 +1,27 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from utils.base64_helpers import array_buffer_to_base64
+
+
+def encode_image(image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> bytes:
+    """Encode an RGB(A) array as PNG, JPEG or WEBP bytes"""
+    image_format = image_format.upper()
+    pil_image = Image.fromarray(image)
+    if image_format == "JPEG" and pil_image.mode == "RGBA":
+        pil_image = pil_image.convert("RGB")
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        pil_image.save(buffer, format="PNG")
+    else:
+        pil_image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def image_to_data_url(image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> str:
+    """Encode an RGB(A) array as a base64 data URL"""
+    encoded = encode_image(image, image_format, quality)
+    return f"data:image/{image_format.lower()};base64,{array_buffer_to_base64(encoded)}"
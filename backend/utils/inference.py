@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from utils.thread_budget import onnx_session_options
+
+# Try to import rembg, but provide fallback if not available
+try:
+    from rembg import new_session, remove
+    REMBG_AVAILABLE = True
+except ImportError:
+    REMBG_AVAILABLE = False
+
+# rembg sessions whose predict() is a single u2net forward pass that accepts a batch axis
+U2NET_MODELS = {"u2net", "u2netp", "u2net_human_seg"}
+U2NET_MEAN = np.array([0.485, 0.456, 0.406])
+U2NET_STD = np.array([0.229, 0.224, 0.225])
+U2NET_SIZE = (320, 320)
+
+
+class MicroBatcher:
+    """Gathers items submitted within a short window into one batched call.
+
+    ``batch_fn`` receives a list of items and must return a list of results in the
+    same order. A batch is dispatched as soon as it holds ``max_batch_size`` items or
+    ``max_wait_ms`` after its first item arrived, whichever comes first. With a
+    maximum batch size of 1 items are processed inline on the caller's thread.
+    """
+
+    def __init__(self, batch_fn: Callable[[list], list], max_batch_size: int = 4,
+                 max_wait_ms: float = 5.0, name: str = "batch"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+        self.name = name
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._batches = 0
+        self._items = 0
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name=f"microbatch-{self.name}", daemon=True)
+            self._thread.start()
+
+    def submit(self, item) -> Future:
+        """Queue an item and return a future for its result"""
+        future = Future()
+        if self.max_batch_size == 1:
+            self._run_batch([(item, future)])
+            return future
+
+        with self._condition:
+            self._ensure_worker()
+            self._queue.append((item, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def __call__(self, item):
+        """Submit an item and block until its result is ready"""
+        return self.submit(item).result()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+
+                # Wait for more items until the batch is full or the window closes
+                deadline = self._queue[0][2] + self.max_wait_ms / 1000
+                while len(self._queue) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = []
+                while self._queue and len(batch) < self.max_batch_size:
+                    item, future, _ = self._queue.popleft()
+                    batch.append((item, future))
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"Batch function '{self.name}' returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self._batches += 1
+        self._items += len(items)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        """Batch counters for metrics endpoints"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "batches": self._batches,
+            "items": self._items,
+            "mean_batch_size": round(self._items / self._batches, 2) if self._batches else 0.0,
+            "queued": len(self._queue),
+        }
+
+
+class RembgBatchModel:
+    """Background removal over a single shared rembg session, batched when the model allows it"""
+
+    def __init__(self, model_name: str = "u2net", session=None):
+        self.model_name = model_name
+        self.session = session or self._new_session(model_name)
+        self._lock = threading.Lock()
+        inner = getattr(self.session, "inner_session", None)
+        self._input_name = inner.get_inputs()[0].name if inner is not None else None
+        batch_dim = inner.get_inputs()[0].shape[0] if inner is not None else 1
+        # A symbolic (string) or missing leading dimension means the graph accepts any batch size
+        self.supports_batch = model_name in U2NET_MODELS and not isinstance(batch_dim, int)
+        self.supports_direct = model_name in U2NET_MODELS and inner is not None
+
+    @staticmethod
+    def _new_session(model_name: str):
+        """Create the rembg session with onnxruntime limited to the thread budget"""
+        try:
+            return new_session(model_name, sess_opts=onnx_session_options())
+        except TypeError:
+            # Older rembg releases only honour OMP_NUM_THREADS, which the budget also sets
+            return new_session(model_name)
+
+    def _normalize(self, image: np.ndarray) -> np.ndarray:
+        """rembg's u2net preprocessing, step for step: PIL Lanczos resize, scale by max,
+        standardize in float64, CHW float32"""
+        resized = np.asarray(Image.fromarray(image[:, :, :3]).resize(U2NET_SIZE, Image.LANCZOS))
+        resized = resized / max(np.max(resized), 1e-6)
+        resized = (resized - U2NET_MEAN) / U2NET_STD
+        return resized.transpose((2, 0, 1)).astype(np.float32)
+
+    def _postprocess(self, pred: np.ndarray, size) -> np.ndarray:
+        """Min-max normalize one u2net prediction (in float32, as rembg does) and scale it
+        back to the image size with PIL's Lanczos filter"""
+        low, high = np.min(pred), np.max(pred)
+        pred = (pred - low) / np.maximum(high - low, np.float32(1e-6))
+        mask = Image.fromarray((pred * 255).astype(np.uint8), mode="L")
+        return np.asarray(mask.resize(size, Image.LANCZOS))
+
+    def _cutout(self, image: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """Same result as rembg's naive cutout (PIL composite over transparent black):
+        colour scaled by the mask with PIL's integer rounding, mask as alpha"""
+        rgba = np.empty((image.shape[0], image.shape[1], 4), dtype=np.uint8)
+        scaled = image[:, :, :3].astype(np.uint32) * mask[:, :, None] + 128
+        rgba[:, :, :3] = (scaled + (scaled >> 8)) >> 8
+        rgba[:, :, 3] = mask
+        return rgba
+
+    def remove_batch(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Remove the background from several RGB images with as few model calls as possible"""
+        if not self.supports_direct:
+            with self._lock:
+                return [np.array(remove(Image.fromarray(image), session=self.session)) for image in images]
+
+        inputs = np.stack([self._normalize(image) for image in images])
+        with self._lock:
+            if self.supports_batch:
+                preds = self.session.inner_session.run(None, {self._input_name: inputs})[0][:, 0]
+            else:
+                preds = np.concatenate([
+                    self.session.inner_session.run(None, {self._input_name: inputs[i:i + 1]})[0][:, 0]
+                    for i in range(len(images))
+                ])
+
+        return [
+            self._cutout(image, self._postprocess(pred, (image.shape[1], image.shape[0])))
+            for image, pred in zip(images, preds)
+        ]
+
+
+def batch_settings(prefix: str, default_size: int) -> dict:
+    """Read max batch size and wait window for a model from TRYON_<PREFIX>_BATCH_* variables"""
+    return {
+        "max_batch_size": int(os.getenv(f"TRYON_{prefix}_BATCH_SIZE", os.getenv("TRYON_BATCH_MAX_SIZE", str(default_size)))),
+        "max_wait_ms": float(os.getenv(f"TRYON_{prefix}_BATCH_WAIT_MS", os.getenv("TRYON_BATCH_WAIT_MS", "5"))),
+    }
+
+
+# Every batcher created so far, by model name, for metrics
+_batchers = {}
+_background_removal = None
+_background_removal_lock = threading.Lock()
+
+
+def register_batcher(batcher: MicroBatcher) -> MicroBatcher:
+    """Make a batcher's counters visible in ``inference_stats``"""
+    _batchers[batcher.name] = batcher
+    return batcher
+
+
+def get_background_removal_batcher() -> MicroBatcher:
+    """Shared micro-batcher in front of the rembg model, created on first use"""
+    global _background_removal
+    if _background_removal is None:
+        with _background_removal_lock:
+            if _background_removal is None:
+                model = RembgBatchModel(os.getenv("TRYON_REMBG_MODEL", "u2net"))
+                print(f"✅ rembg model '{model.model_name}' loaded (batched inference: {model.supports_batch})")
+                _background_removal = register_batcher(
+                    MicroBatcher(model.remove_batch, name="rembg", **batch_settings("REMBG", 4))
+                )
+    return _background_removal
+
+
+def inference_stats() -> dict:
+    """Batching counters for every model that has been used so far"""
+    return {name: batcher.stats() for name, batcher in _batchers.items()}
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Optional, Tuple
+
+import numpy as np
+
+from utils.buffer_pool import get_buffer_pool
+from utils.cache import LRUCache, image_digest
+from utils.mipmap import build_pyramid, resize_from_pyramid
+from utils.quality import QualityProfile
+
+
+class LandmarkSmoother:
+    """Exponential moving average of body points across video frames.
+
+    Points are kept relative to the frame size, so a change of working resolution does
+    not make the garment jump. When tracking is lost the last points are held for a
+    few frames before the stream falls back to mask-based placement.
+    """
+
+    def __init__(self, alpha: float = 0.5, hold_frames: int = 5):
+        self.alpha = alpha
+        self.hold_frames = hold_frames
+        self._points = None
+        self._missed = 0
+
+    def update(self, body_points: Optional[dict], width: int, height: int) -> Optional[dict]:
+        if body_points is None:
+            self._missed += 1
+            if self._missed > self.hold_frames:
+                self._points = None
+            return self._to_pixels(width, height)
+
+        self._missed = 0
+        relative = {name: (x / width, y / height) for name, (x, y) in body_points.items()}
+        if self._points is None:
+            self._points = relative
+        else:
+            smoothed = {}
+            for name, (x, y) in relative.items():
+                px, py = self._points.get(name, (x, y))
+                smoothed[name] = (px + self.alpha * (x - px), py + self.alpha * (y - py))
+            self._points = smoothed
+        return self._to_pixels(width, height)
+
+    def _to_pixels(self, width: int, height: int) -> Optional[dict]:
+        if self._points is None:
+            return None
+        return {name: (int(round(x * width)), int(round(y * height))) for name, (x, y) in self._points.items()}
+
+
+class LatestFrame:
+    """One-slot mailbox between a stream's receiver and its processing loop.
+
+    A frame that arrives before the previous one was taken replaces it and counts as
+    dropped, so a slow consumer always works on the newest frame instead of a backlog.
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._event = asyncio.Event()
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame: bytes):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self.received += 1
+        self._event.set()
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+    async def get(self) -> Optional[bytes]:
+        """The newest frame, waiting for one if needed; None once the stream has closed"""
+        while self._frame is None:
+            if self.closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+class LiveTryOnSession:
+    """Per-connection state for the live try-on stream.
+
+    The garment is extracted once when the stream starts and its mip pyramid kept, so
+    each frame only tracks the person, resizes the garment (from a small per-stream
+    cache of quantized sizes) and composites. The working resolution adapts so the
+    per-frame latency fits the target frame interval.
+    """
+
+    def __init__(self, processor, garment_bytes: bytes, garment_type: str, quality: QualityProfile,
+                 target_fps: float = 15.0, max_side: int = 640, min_side: int = 240):
+        self.processor = processor
+        self.garment_type = garment_type
+        self.quality = quality._replace(max_side=max_side)
+        self.target_fps = max(1.0, target_fps)
+        self.max_side = max_side
+        self.min_side = min(min_side, max_side)
+        self.side = max_side
+
+        cloth_img = processor.decode_image(garment_bytes, max_side)
+        self.clothing = processor.extract_clothing_cached(cloth_img, image_digest(garment_bytes), self.quality)
+        self.pyramid = build_pyramid(self.clothing)
+        # Local to the stream: per-frame sizes are too many and too short-lived for the shared caches
+        self.resize_cache = LRUCache(16, "live_resize")
+
+        self.tracking = processor.create_tracking_models(min(quality.model_complexity, 1))
+        self.smoother = LandmarkSmoother(float(os.getenv("TRYON_LIVE_SMOOTHING", "0.5")))
+        # The tracked region shifts by a pixel or two every frame; rounding it keeps the resize cache warm
+        self.bucket_px = int(os.getenv("TRYON_LIVE_RESIZE_BUCKET_PX", "8"))
+
+        self.frames = 0
+        self.latency_ema = None
+        self.done_at = deque(maxlen=30)
+        # Frames to wait after a resolution change before judging the new one
+        self._settle = 0
+
+    def resized_garment(self, width: int, height: int) -> np.ndarray:
+        def compute():
+            return resize_from_pyramid(self.pyramid, width, height, self.quality.interpolation)
+
+        return self.resize_cache.get_or_create((width, height), compute)
+
+    def render(self, frame_bytes: bytes) -> bytes:
+        """Composite the garment onto one frame and encode it as JPEG"""
+        processor = self.processor
+        with get_buffer_pool().scope() as scratch:
+            frame = processor.decode_image(frame_bytes, self.side, scratch)
+            frame_h, frame_w = frame.shape[:2]
+
+            person_mask, body_points = processor.track_person(frame, self.tracking)
+            body_points = self.smoother.update(body_points, frame_w, frame_h)
+
+            clothing = self.clothing
+            region = processor.garment_region(body_points, person_mask, self.garment_type)
+            if region is not None:
+                clothing = self.resized_garment(*processor.fitted_size(region, frame.shape, self.bucket_px))
+
+            composite, composite_region = processor.blend_clothing(
+                frame, clothing, person_mask, body_points, self.garment_type,
+                self.quality.detail_boost, self.quality.interpolation, scratch=scratch)
+            result = processor.apply_lighting(composite, composite_region,
+                                              processor.get_luminance_stats(frame), scratch)
+            return processor.encode_image(result, "JPEG", self.quality.output_quality)
+
+    def process_frame(self, frame_bytes: bytes) -> Tuple[bytes, dict]:
+        """Render a frame, adapt the working resolution to its latency and report per-frame stats"""
+        start = time.perf_counter()
+        encoded = self.render(frame_bytes)
+        latency_ms = (time.perf_counter() - start) * 1000
+        side = self.side
+
+        self.frames += 1
+        self.latency_ema = latency_ms if self.latency_ema is None else \
+            0.8 * self.latency_ema + 0.2 * latency_ms
+        self.adapt_resolution()
+        self.done_at.append(time.perf_counter())
+
+        return encoded, {
+            "frame": self.frames,
+            "latency_ms": round(latency_ms, 1),
+            "fps": self.achieved_fps(),
+            "side": side,
+        }
+
+    def adapt_resolution(self):
+        """Shrink the working resolution while frames take longer than the frame interval,
+        grow it back when there is ample headroom"""
+        if self._settle > 0:
+            self._settle -= 1
+            return
+        budget_ms = 1000.0 / self.target_fps
+        side = self.side
+        if self.latency_ema > budget_ms and side > self.min_side:
+            side = max(self.min_side, int(side * 0.85) // 16 * 16)
+        elif self.latency_ema < 0.6 * budget_ms and side < self.max_side:
+            side = min(self.max_side, int(side * 1.1) // 16 * 16 + 16)
+        if side != self.side:
+            self.side = side
+            self.latency_ema = None
+            self._settle = 3
+
+    def achieved_fps(self) -> float:
+        """Frames delivered per second over the last few frames"""
+        if len(self.done_at) < 2:
+            return 0.0
+        elapsed = self.done_at[-1] - self.done_at[0]
+        return round((len(self.done_at) - 1) / elapsed, 1) if elapsed > 0 else 0.0
+
+    def close(self):
+        if self.tracking is not None:
+            self.tracking.pose.close()
+            self.tracking.segmentation.close()
+            self.tracking = None
+
+
+def live_settings_from_env() -> dict:
+    """Stream defaults from TRYON_LIVE_TARGET_FPS, TRYON_LIVE_MAX_SIDE and TRYON_LIVE_MIN_SIDE"""
+    return {
+        "target_fps": float(os.getenv("TRYON_LIVE_TARGET_FPS", "15")),
+        "max_side": int(os.getenv("TRYON_LIVE_MAX_SIDE", "640")),
+        "min_side": int(os.getenv("TRYON_LIVE_MIN_SIDE", "240")),
+    }
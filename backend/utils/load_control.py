@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, NamedTuple, Optional
+
+from utils.quality import QualityProfile
+
+# Degradation levels, cheapest last. Each level includes the ones before it.
+DEGRADATION_LEVELS = [
+    "none",
+    "landmark_complexity",  # one step lighter MediaPipe Pose model
+    "working_resolution",   # process images at a capped longest side
+    "skip_texture",         # skip sharpness/contrast and pattern enhancement
+]
+
+
+class DegradationDecision(NamedTuple):
+    """Degradation level picked for one request and the load that led to it"""
+    level: int
+    reason: str
+    queue_depth: int
+    estimated_ms: float
+
+    @property
+    def level_name(self) -> str:
+        return DEGRADATION_LEVELS[self.level]
+
+
+def degrade_profile(profile: QualityProfile, level: int, max_side: int = 1024) -> QualityProfile:
+    """Return a cheaper copy of ``profile`` for the given degradation level"""
+    if level >= 1:
+        profile = profile._replace(model_complexity=max(0, profile.model_complexity - 1))
+    if level >= 2:
+        capped = max_side if profile.max_side is None else min(profile.max_side, max_side)
+        profile = profile._replace(max_side=capped)
+    if level >= 3:
+        profile = profile._replace(enhance_texture=False, detect_patterns=False)
+    return profile
+
+
+class DegradationController:
+    """Steps new try-on requests down to cheaper settings when the latency SLO is at risk.
+
+    The predicted latency of a new request is the recent p95 latency plus the time
+    needed to drain the requests already queued ahead of it. Above ``high_watermark``
+    of the SLO the level steps down by one; it only steps back up after the
+    prediction has stayed under ``low_watermark`` for ``dwell_seconds``, and never
+    changes more than once per ``dwell_seconds``, which gives the hysteresis.
+
+    Per-stage timings are kept for ``snapshot`` only. Pipeline stages overlap, so their
+    sum is not a request's latency; the prediction uses measured request latencies.
+    """
+
+    def __init__(self, slo_ms: float, workers: int = 1, window: int = 20,
+                 high_watermark: float = 0.9, low_watermark: float = 0.6,
+                 dwell_seconds: float = 5.0, max_side: int = 1024):
+        self.slo_ms = slo_ms
+        self.workers = max(1, workers)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.dwell_seconds = dwell_seconds
+        self.max_side = max_side
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        # Reported under recent_stage_ms; not an input to _estimate_ms
+        self._stage_latencies: Dict[str, deque] = {}
+        self._level = 0
+        self._queue_depth = 0
+        self._last_change = 0.0
+        self._calm_since: Optional[float] = None
+        self._requests_by_level = [0] * len(DEGRADATION_LEVELS)
+        self._step_downs = 0
+        self._step_ups = 0
+        self._last_decision: Optional[DegradationDecision] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slo_ms > 0
+
+    def _estimate_ms(self) -> float:
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        mean = sum(ordered) / len(ordered)
+        # Requests already in flight ahead of this one, shared across the workers
+        drain_ms = max(0, self._queue_depth - self.workers) * mean / self.workers
+        return p95 + drain_ms
+
+    def begin(self) -> DegradationDecision:
+        """Register a new request and decide which degradation level it runs at"""
+        with self._lock:
+            self._queue_depth += 1
+            estimated_ms = self._estimate_ms()
+            now = time.monotonic()
+            reason = "steady"
+
+            if self.enabled:
+                risk = estimated_ms / self.slo_ms
+                can_change = now - self._last_change >= self.dwell_seconds
+                if risk > self.high_watermark:
+                    self._calm_since = None
+                    if can_change and self._level < len(DEGRADATION_LEVELS) - 1:
+                        self._level += 1
+                        self._last_change = now
+                        self._step_downs += 1
+                        reason = "step_down"
+                elif risk < self.low_watermark:
+                    if self._calm_since is None:
+                        self._calm_since = now
+                    calm_for = now - self._calm_since
+                    if self._level > 0 and can_change and calm_for >= self.dwell_seconds:
+                        self._level -= 1
+                        self._last_change = now
+                        self._calm_since = now
+                        self._step_ups += 1
+                        reason = "step_up"
+                else:
+                    self._calm_since = None
+
+            decision = DegradationDecision(self._level, reason, self._queue_depth, estimated_ms)
+            self._requests_by_level[self._level] += 1
+            self._last_decision = decision
+
+        if reason != "steady":
+            print(f"⚖️  Degradation {reason}: level={decision.level_name}, "
+                  f"queue_depth={decision.queue_depth}, estimated={estimated_ms:.0f}ms, slo={self.slo_ms:.0f}ms")
+        return decision
+
+    def finish(self, total_ms: Optional[float] = None, stage_timings: Optional[Dict[str, float]] = None):
+        """Register that a request left the system, recording its latency if it completed.
+
+        ``total_ms`` feeds the prediction; ``stage_timings`` are only reported.
+        """
+        with self._lock:
+            self._queue_depth = max(0, self._queue_depth - 1)
+            if total_ms is not None:
+                self._latencies.append(total_ms)
+            for stage, elapsed_ms in (stage_timings or {}).items():
+                self._stage_latencies.setdefault(stage, deque(maxlen=self._latencies.maxlen)).append(elapsed_ms)
+
+    def apply(self, profile: QualityProfile, decision: DegradationDecision) -> QualityProfile:
+        """Apply a decision to the requested quality profile"""
+        return degrade_profile(profile, decision.level, self.max_side)
+
+    def headers(self, decision: DegradationDecision) -> Dict[str, str]:
+        """Response headers describing the decision taken for a request"""
+        return {
+            "X-TryOn-Degradation-Level": str(decision.level),
+            "X-TryOn-Degradation": decision.level_name,
+            "X-TryOn-Queue-Depth": str(decision.queue_depth),
+            "X-TryOn-Estimated-Ms": f"{decision.estimated_ms:.0f}",
+        }
+
+    def snapshot(self) -> dict:
+        """Current controller state and counters for metrics endpoints"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "slo_ms": self.slo_ms,
+                "level": self._level,
+                "level_name": DEGRADATION_LEVELS[self._level],
+                "queue_depth": self._queue_depth,
+                "estimated_ms": round(self._estimate_ms(), 1),
+                "step_downs": self._step_downs,
+                "step_ups": self._step_ups,
+                "requests_by_level": dict(zip(DEGRADATION_LEVELS, self._requests_by_level)),
+                "recent_stage_ms": {
+                    stage: round(sum(values) / len(values), 1)
+                    for stage, values in self._stage_latencies.items() if values
+                },
+                "last_decision": self._last_decision._asdict() if self._last_decision else None,
+            }
+
+
+def controller_from_env(workers: Optional[int] = None) -> DegradationController:
+    """Build the controller from TRYON_* environment variables (SLO of 0 disables it)"""
+    return DegradationController(
+        slo_ms=float(os.getenv("TRYON_LATENCY_SLO_MS", "3000")),
+        workers=workers or int(os.getenv("TRYON_REQUEST_WORKERS", str(os.cpu_count() or 1))),
+        window=int(os.getenv("TRYON_DEGRADE_WINDOW", "20")),
+        high_watermark=float(os.getenv("TRYON_DEGRADE_HIGH_WATERMARK", "0.9")),
+        low_watermark=float(os.getenv("TRYON_DEGRADE_LOW_WATERMARK", "0.6")),
+        dwell_seconds=float(os.getenv("TRYON_DEGRADE_DWELL_SECONDS", "5")),
+        max_side=int(os.getenv("TRYON_DEGRADE_MAX_SIDE", "1024")),
+    )
@@ -0,0 +1,44 @@
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+# Stop halving once either side would drop below this
+MIN_LEVEL_SIDE = 16
+
+
+def build_pyramid(image: np.ndarray, min_side: int = MIN_LEVEL_SIDE) -> List[np.ndarray]:
+    """Mip pyramid of an image: the image itself, then successive 2x box-filtered halvings"""
+    levels = [image]
+    while min(levels[-1].shape[:2]) // 2 >= min_side:
+        h, w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (w // 2, h // 2), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+def pick_level(pyramid: List[np.ndarray], width: int, height: int) -> np.ndarray:
+    """Smallest pyramid level that is still at least ``width`` x ``height``"""
+    best = pyramid[0]
+    for level in pyramid[1:]:
+        h, w = level.shape[:2]
+        if w < width or h < height:
+            break
+        best = level
+    return best
+
+
+def resize_from_pyramid(pyramid: List[np.ndarray], width: int, height: int,
+                        interpolation: int = cv2.INTER_LANCZOS4) -> np.ndarray:
+    """Resize starting from the nearest level above the target instead of full resolution"""
+    source = pick_level(pyramid, width, height)
+    if source.shape[1] == width and source.shape[0] == height:
+        return source.copy()
+    return cv2.resize(source, (width, height), interpolation=interpolation)
+
+
+def size_bucket(width: int, height: int, step: int) -> Tuple[int, int]:
+    """Round a target size to the nearest multiple of ``step`` pixels (never below one step)"""
+    if step <= 1:
+        return width, height
+    return (max(step, int(round(width / step)) * step),
+            max(step, int(round(height / step)) * step))
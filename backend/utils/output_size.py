@@ -0,0 +1,119 @@
+import cv2
+import numpy as np
+from typing import NamedTuple, Optional, Tuple
+
+# "contain" fits the result inside the box; "cover" fills it, trimming what overflows
+FIT_MODES = ("contain", "cover")
+# Largest width or height a client may ask for
+MAX_OUTPUT_SIDE = 8192
+
+
+class OutputSpec(NamedTuple):
+    """Size the client displays the result at, and whether to frame it on the person"""
+    width: Optional[int] = None
+    height: Optional[int] = None
+    fit: str = "contain"
+    # Crop to the person's bounding box from the segmentation mask before sizing
+    crop_to_person: bool = False
+    # Margin kept around the person, as a fraction of their bounding box
+    padding: float = 0.1
+
+
+class FramePlan(NamedTuple):
+    """Source rectangle of the working image and the size it is rendered at"""
+    x: int
+    y: int
+    w: int
+    h: int
+    out_w: int
+    out_h: int
+
+
+def parse_output_spec(width: int = 0, height: int = 0, fit: str = "contain",
+                      crop_to_person: bool = False) -> Optional[OutputSpec]:
+    """Output spec from request fields (0 meaning unset); None when the full frame is wanted"""
+    fit = (fit or "contain").strip().lower()
+    if fit not in FIT_MODES:
+        raise ValueError(f"Unknown fit '{fit}'. Expected one of: {', '.join(FIT_MODES)}")
+    for name, value in (("width", width), ("height", height)):
+        if value < 0 or value > MAX_OUTPUT_SIDE:
+            raise ValueError(f"Output {name} must be between 1 and {MAX_OUTPUT_SIDE}, or 0 to leave it unset")
+    if not (width or height or crop_to_person):
+        return None
+    return OutputSpec(width or None, height or None, fit, crop_to_person)
+
+
+def _clamp_box(cx: float, cy: float, w: int, h: int, frame_w: int, frame_h: int) -> Tuple[int, int]:
+    """Top-left corner of a w x h box centred on (cx, cy), moved inside the frame"""
+    x = min(max(0, int(round(cx - w / 2))), frame_w - w)
+    y = min(max(0, int(round(cy - h / 2))), frame_h - h)
+    return x, y
+
+
+def plan_frame(frame_shape: Tuple[int, ...], spec: Optional[OutputSpec],
+               person_box: Optional[Tuple[int, int, int, int]] = None) -> Optional[FramePlan]:
+    """Where to crop the working image and what size to render it at.
+
+    Results are never upscaled past the working image. Returns None when the spec
+    leaves the frame as it is, so callers can skip the copy.
+    """
+    if spec is None:
+        return None
+    frame_h, frame_w = frame_shape[:2]
+    x, y, w, h = 0, 0, frame_w, frame_h
+
+    if spec.crop_to_person and person_box is not None:
+        px, py, pw, ph = person_box
+        pad_x, pad_y = int(pw * spec.padding), int(ph * spec.padding)
+        x, y = max(0, px - pad_x), max(0, py - pad_y)
+        w, h = min(frame_w, px + pw + pad_x) - x, min(frame_h, py + ph + pad_y) - y
+
+    if spec.fit == "cover" and spec.width and spec.height:
+        # Match the box's aspect ratio: grow the short side into the frame, then trim the long one
+        aspect = spec.width / spec.height
+        cx, cy = x + w / 2, y + h / 2
+        if w / h > aspect:
+            h = min(frame_h, max(h, int(round(w / aspect))))
+            w = min(w, max(1, int(round(h * aspect))))
+        else:
+            w = min(frame_w, max(w, int(round(h * aspect))))
+            h = min(h, max(1, int(round(w / aspect))))
+        x, y = _clamp_box(cx, cy, w, h, frame_w, frame_h)
+
+    scales = [side / size for side, size in ((spec.width, w), (spec.height, h)) if side]
+    scale = min(scales) if scales else 1.0
+    if spec.fit == "cover" and len(scales) == 2:
+        scale = max(scales)
+    out_w, out_h = w, h
+    if scale < 1.0:
+        out_w, out_h = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        if spec.fit == "cover" and spec.width and spec.height:
+            out_w, out_h = min(out_w, spec.width), min(out_h, spec.height)
+
+    if (x, y, w, h, out_w, out_h) == (0, 0, frame_w, frame_h, frame_w, frame_h):
+        return None
+    return FramePlan(x, y, w, h, out_w, out_h)
+
+
+def reframe(image: np.ndarray, plan: FramePlan, interpolation: int = cv2.INTER_AREA,
+            dst: Optional[np.ndarray] = None) -> np.ndarray:
+    """Crop ``image`` to the plan's rectangle and resize it to the output size"""
+    crop = image[plan.y:plan.y + plan.h, plan.x:plan.x + plan.w]
+    if (plan.out_w, plan.out_h) == (plan.w, plan.h):
+        return np.ascontiguousarray(crop)
+    return cv2.resize(crop, (plan.out_w, plan.out_h), dst=dst, interpolation=interpolation)
+
+
+def reframe_points(points: Optional[dict], plan: FramePlan) -> Optional[dict]:
+    """Body points moved into the reframed image's pixel coordinates"""
+    if not points:
+        return points
+    sx, sy = plan.out_w / plan.w, plan.out_h / plan.h
+    return {name: (int((px - plan.x) * sx), int((py - plan.y) * sy)) for name, (px, py) in points.items()}
+
+
+def fit_to_output(image: np.ndarray, spec: Optional[OutputSpec]) -> np.ndarray:
+    """Size an already rendered result for engines that cannot composite at the target size.
+    Person crops need the segmentation mask, so only the size and fit apply here."""
+    plan = plan_frame(image.shape, spec)
+    return image if plan is None else reframe(image, plan)
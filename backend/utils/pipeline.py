@@ -0,0 +1,143 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from utils.profiling import attach, current_profile
+from utils.thread_budget import get_thread_budget
+
+
+class Stage:
+    """A named pipeline step with declared inputs and outputs"""
+
+    def __init__(self, name: str, func: Callable, inputs: Sequence[str], outputs: Sequence[str]):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+
+    def __call__(self, values: Dict[str, object]) -> Dict[str, object]:
+        """Call the stage with its inputs in declared order and map the return value onto its outputs"""
+        result = self.func(*[values[key] for key in self.inputs])
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        if not isinstance(result, tuple) or len(result) != len(self.outputs):
+            raise ValueError(f"Stage '{self.name}' must return {len(self.outputs)} values")
+        return dict(zip(self.outputs, result))
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={list(self.inputs)}, outputs={list(self.outputs)})"
+
+
+class StageGraph:
+    """A small DAG of stages, executed so that independent branches overlap"""
+
+    def __init__(self, stages: List[Stage], initial_inputs: Sequence[str] = ()):
+        self.stages = list(stages)
+        self.initial_inputs = tuple(initial_inputs)
+        self._validate()
+
+    def _validate(self):
+        """Check that every input has exactly one producer and that the graph has no cycles"""
+        producers = {name: None for name in self.initial_inputs}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"Value '{output}' is produced more than once")
+                producers[output] = stage.name
+
+        for stage in self.stages:
+            missing = [key for key in stage.inputs if key not in producers]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' has no producer for inputs {missing}")
+
+        # Topological walk: if it cannot consume every stage there is a cycle
+        available = set(self.initial_inputs)
+        remaining = list(self.stages)
+        while remaining:
+            ready = [stage for stage in remaining if all(key in available for key in stage.inputs)]
+            if not ready:
+                raise ValueError(f"Cycle detected between stages {[stage.name for stage in remaining]}")
+            for stage in ready:
+                available.update(stage.outputs)
+                remaining.remove(stage)
+
+    def run(self, initial: Dict[str, object], executor: Optional[ThreadPoolExecutor] = None,
+            timings: Optional[Dict[str, float]] = None) -> Dict[str, object]:
+        """Run every stage once its inputs are available.
+
+        Ready stages are handed to the executor, except one which runs on the calling
+        thread, so a linear chain never pays a thread hand-off. Per-stage wall time in
+        milliseconds is written into ``timings`` when given.
+        """
+        missing = [key for key in self.initial_inputs if key not in initial]
+        if missing:
+            raise ValueError(f"Missing initial inputs {missing}")
+
+        values = dict(initial)
+        pending = list(self.stages)
+        running = {}
+        # Stages handed to pool threads keep counting towards the request's profile
+        profile = current_profile()
+
+        def timed(stage: Stage) -> Tuple[Stage, Dict[str, object], float]:
+            start = time.perf_counter()
+            with attach(profile):
+                outputs = stage(values)
+            return stage, outputs, (time.perf_counter() - start) * 1000
+
+        def record(stage: Stage, outputs: Dict[str, object], elapsed_ms: float):
+            values.update(outputs)
+            if timings is not None:
+                timings[stage.name] = elapsed_ms
+
+        try:
+            while pending or running:
+                ready = [stage for stage in pending if all(key in values for key in stage.inputs)]
+                for stage in ready:
+                    pending.remove(stage)
+
+                inline = ready.pop() if ready else None
+                for stage in ready:
+                    if executor is None:
+                        record(*timed(stage))
+                    else:
+                        running[executor.submit(timed, stage)] = stage
+
+                if inline is not None:
+                    record(*timed(inline))
+
+                # Harvest whatever has finished; block only when nothing else can start
+                if running:
+                    can_progress = any(all(key in values for key in stage.inputs) for stage in pending)
+                    done, _ = wait(list(running), timeout=0 if can_progress else None,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                        record(*future.result())
+                elif pending and not any(all(key in values for key in stage.inputs) for stage in pending):
+                    raise RuntimeError(f"Pipeline stalled with stages {[stage.name for stage in pending]}")
+        finally:
+            # On failure, drop stages that have not started and wait out those that have:
+            # they may still be writing into the request's scratch buffers, which go back
+            # to the shared pool as soon as the caller unwinds
+            for future in running:
+                future.cancel()
+            wait(list(running))
+
+        return values
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_pipeline_executor() -> ThreadPoolExecutor:
+    """Shared thread pool used to overlap independent pipeline branches"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = get_thread_budget().pipeline_workers
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tryon-stage")
+    return _executor
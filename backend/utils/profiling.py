@@ -0,0 +1,313 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+SAMPLE = "sample"
+TRACE = "trace"
+MODES = (SAMPLE, TRACE)
+
+
+class ProfilingSettings(NamedTuple):
+    admin_token: Optional[str]
+    sample_rate: float
+    min_ms: float
+    interval_ms: float
+    capacity: int
+
+
+def profiling_settings_from_env() -> ProfilingSettings:
+    """Settings from TRYON_ADMIN_TOKEN and the TRYON_PROFILE_* variables"""
+    return ProfilingSettings(
+        admin_token=os.getenv("TRYON_ADMIN_TOKEN") or None,
+        sample_rate=float(os.getenv("TRYON_PROFILE_SAMPLE_RATE", "0")),
+        min_ms=float(os.getenv("TRYON_PROFILE_MIN_MS", "0")),
+        interval_ms=max(0.5, float(os.getenv("TRYON_PROFILE_INTERVAL_MS", "5"))),
+        capacity=max(1, int(os.getenv("TRYON_PROFILE_CAPACITY", "32"))),
+    )
+
+
+def frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def builtin_name(func) -> str:
+    module = getattr(func, "__module__", None)
+    name = getattr(func, "__qualname__", None) or repr(func)
+    return f"{module}.{name}" if module else name
+
+
+class RequestProfile:
+    """Where one request's time went, as wall milliseconds per collapsed call stack.
+
+    In sample mode a background thread records the stacks of the request's threads
+    every few milliseconds; in trace mode every call and return is timed, which is
+    exact but slows Python-heavy code down several times.
+    """
+
+    def __init__(self, mode: str, info: Optional[dict] = None, forced: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.info = dict(info or {})
+        self.forced = forced
+        self.created = time.time()
+        self.duration_ms = None
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, stacks: Dict[Tuple[str, ...], float], samples: int = 0):
+        with self._lock:
+            self.stacks.update(stacks)
+            self.samples += samples
+
+    def summary(self) -> dict:
+        hottest = self.stacks.most_common(1)
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "created": round(self.created, 3),
+            "duration_ms": None if self.duration_ms is None else round(self.duration_ms, 1),
+            "profiled_ms": round(sum(self.stacks.values()), 1),
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "hottest": hottest[0][0][-1] if hottest else None,
+            **self.info,
+        }
+
+
+class _Attachment:
+    """Marks the current thread as working for a profile while the ``with`` block runs.
+
+    Frames outside the block (the worker pool's own plumbing) are left out of the
+    recorded stacks. Entering is a no-op when the thread is already attached, so
+    nested stages on the request's own thread are not counted twice.
+    """
+
+    def __init__(self, profile: Optional[RequestProfile]):
+        self.profile = profile
+        self.active = False
+
+    def __enter__(self):
+        if self.profile is None or threading.get_ident() in _attached:
+            return self
+        self.active = True
+        caller = sys._getframe(1)
+        depth = 0
+        while caller is not None:
+            depth += 1
+            caller = caller.f_back
+        self.depth = depth
+
+        if self.profile.mode == TRACE:
+            self._stack = []
+            self._stacks = Counter()
+            sys.setprofile(self._trace)
+        with _attached_lock:
+            _attached[threading.get_ident()] = self
+            _attached_changed.notify_all()
+        _ensure_sampler()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return False
+        if self.profile.mode == TRACE:
+            sys.setprofile(None)
+            self.profile.add(self._stacks)
+        with _attached_lock:
+            _attached.pop(threading.get_ident(), None)
+        return False
+
+    def _trace(self, frame, event, arg):
+        # Entries are (path, start, time spent in children); self time is charged to the path
+        if event == "call" or event == "c_call":
+            name = frame_name(frame.f_code) if event == "call" else builtin_name(arg)
+            parent = self._stack[-1][0] if self._stack else ()
+            self._stack.append([parent + (name,), time.perf_counter(), 0.0])
+        elif self._stack and event in ("return", "c_return", "c_exception"):
+            path, start, children = self._stack.pop()
+            elapsed = (time.perf_counter() - start) * 1000
+            self._stacks[path] += elapsed - children
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+
+def attach(profile: Optional[RequestProfile]) -> _Attachment:
+    return _Attachment(profile)
+
+
+def current_profile() -> Optional[RequestProfile]:
+    """The profile the current thread is working for, if any"""
+    attachment = _attached.get(threading.get_ident())
+    return attachment.profile if attachment is not None else None
+
+
+def run_profiled(profile: Optional[RequestProfile], func, *args, **kwargs):
+    """Call ``func`` with the current thread attached to ``profile``"""
+    with attach(profile):
+        return func(*args, **kwargs)
+
+
+# Threads currently working for a profile, by thread id
+_attached: Dict[int, _Attachment] = {}
+_attached_lock = threading.Lock()
+_attached_changed = threading.Condition(_attached_lock)
+_sampler = None
+
+
+def _sample_forever(interval_ms: float):
+    last = time.perf_counter()
+    while True:
+        with _attached_lock:
+            while not _attached:
+                _attached_changed.wait()
+                last = time.perf_counter()
+        time.sleep(interval_ms / 1000)
+
+        now = time.perf_counter()
+        elapsed_ms, last = (now - last) * 1000, now
+        frames = sys._current_frames()
+        with _attached_lock:
+            sampled = [(tid, a) for tid, a in _attached.items() if a.profile.mode == SAMPLE]
+        for tid, attachment in sampled:
+            frame = frames.get(tid)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            # Root first, without the frames outside the attached block
+            stack = tuple(reversed(stack))[attachment.depth:]
+            if stack:
+                attachment.profile.add({stack: elapsed_ms}, 1)
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None:
+        with _attached_lock:
+            if _sampler is None:
+                _sampler = threading.Thread(target=_sample_forever, args=(get_profile_store().settings.interval_ms,),
+                                            name="tryon-profiler", daemon=True)
+                _sampler.start()
+
+
+class ProfileStore:
+    """Bounded ring buffer of finished request profiles, plus the rules for starting one.
+
+    A request is profiled when it carries the admin token and asks for a mode, or at
+    random at ``sample_rate``; random profiles faster than ``min_ms`` are dropped so the
+    buffer keeps the slow requests worth looking at.
+    """
+
+    def __init__(self, settings: ProfilingSettings):
+        self.settings = settings
+        self.profiles = deque(maxlen=settings.capacity)
+        self.counts = {"started": 0, "stored": 0, "discarded_fast": 0}
+        self._lock = threading.Lock()
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return bool(self.settings.admin_token and token
+                    and hmac.compare_digest(token.encode(), self.settings.admin_token.encode()))
+
+    def begin(self, requested_mode: Optional[str], admin_token: Optional[str],
+              info: Optional[dict] = None) -> Optional[RequestProfile]:
+        """A new profile if this request should be profiled, else None"""
+        mode = (requested_mode or "").strip().lower()
+        if mode and self.authorized(admin_token):
+            forced = True
+            mode = mode if mode in MODES else SAMPLE
+        elif self.settings.sample_rate > 0 and random.random() < self.settings.sample_rate:
+            forced, mode = False, SAMPLE
+        else:
+            return None
+        with self._lock:
+            self.counts["started"] += 1
+        return RequestProfile(mode, info, forced)
+
+    def finish(self, profile: RequestProfile, duration_ms: float) -> bool:
+        """Keep a finished profile (the oldest drops out when full); False if it was discarded"""
+        profile.duration_ms = duration_ms
+        with self._lock:
+            if not profile.forced and duration_ms < self.settings.min_ms:
+                self.counts["discarded_fast"] += 1
+                return False
+            self.profiles.append(profile)
+            self.counts["stored"] += 1
+            return True
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        with self._lock:
+            return next((profile for profile in self.profiles if profile.id == profile_id), None)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            profiles = list(self.profiles)
+        return [profile.summary() for profile in reversed(profiles)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": bool(self.settings.admin_token),
+                "sample_rate": self.settings.sample_rate,
+                "min_ms": self.settings.min_ms,
+                "held": len(self.profiles),
+                "capacity": self.profiles.maxlen,
+                **self.counts,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_profile_store() -> ProfileStore:
+    """Process-wide profile store, configured from the environment on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ProfileStore(profiling_settings_from_env())
+    return _store
+
+
+def collapsed_stacks(profile: RequestProfile) -> str:
+    """Brendan Gregg's collapsed format (``a;b;c <weight>``), weights in microseconds,
+    for flamegraph.pl, inferno or speedscope"""
+    lines = [f"{';'.join(stack)} {int(round(ms * 1000))}" for stack, ms in profile.stacks.most_common()]
+    return "\n".join(line for line in lines if not line.endswith(" 0")) + "\n"
+
+
+def speedscope(profile: RequestProfile) -> dict:
+    """The profile as a speedscope file (https://www.speedscope.app)"""
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, ms in profile.stacks.items():
+        ids = []
+        for name in stack:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({"name": name})
+            ids.append(index[name])
+        samples.append(ids)
+        weights.append(round(ms, 4))
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"try-on {profile.id}",
+        "exporter": "virtual-tryon",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": f"{profile.mode} profile {profile.id}",
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": round(sum(weights), 4),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
@@ -0,0 +1,71 @@
+import cv2
+from typing import NamedTuple, Optional
+
+
+class QualityProfile(NamedTuple):
+    """Named set of pipeline stage settings trading output quality for latency"""
+    name: str
+    # MediaPipe Pose model complexity (0 = lite, 1 = full, 2 = heavy)
+    model_complexity: int
+    # cv2 interpolation flag used when resizing the garment
+    interpolation: int
+    # PIL-style sharpness and contrast passes on the extracted garment
+    enhance_texture: bool
+    # Canny-based pattern boost on the extracted garment
+    detect_patterns: bool
+    # Gaussian high-frequency boost while blending
+    detail_boost: bool
+    # Encoded output format: "PNG", "JPEG" or "WEBP"
+    output_format: str
+    # Encoder quality for lossy formats
+    output_quality: int
+    # Longest side images are processed at (None keeps the upload size)
+    max_side: Optional[int] = None
+    # Resize the garment from its mip pyramid (rounded to TRYON_RESIZE_BUCKET_PX) and squeeze it
+    # into the frame in the same step: cheaper, but not pixel-identical to a full-resolution resize
+    approximate_resize: bool = False
+
+
+QUALITY_PROFILES = {
+    "fast": QualityProfile(
+        name="fast",
+        model_complexity=0,
+        interpolation=cv2.INTER_LINEAR,
+        enhance_texture=False,
+        detect_patterns=False,
+        detail_boost=False,
+        output_format="JPEG",
+        output_quality=80,
+        approximate_resize=True,
+    ),
+    "balanced": QualityProfile(
+        name="balanced",
+        model_complexity=1,
+        interpolation=cv2.INTER_CUBIC,
+        enhance_texture=True,
+        detect_patterns=False,
+        detail_boost=True,
+        output_format="JPEG",
+        output_quality=90,
+    ),
+    "best": QualityProfile(
+        name="best",
+        model_complexity=2,
+        interpolation=cv2.INTER_LANCZOS4,
+        enhance_texture=True,
+        detect_patterns=True,
+        detail_boost=True,
+        output_format="PNG",
+        output_quality=100,
+    ),
+}
+
+DEFAULT_QUALITY = "best"
+
+
+def get_quality_profile(name: Optional[str] = None) -> QualityProfile:
+    """Look up a quality profile by name, defaulting to the highest quality tier"""
+    key = (name or DEFAULT_QUALITY).strip().lower()
+    if key not in QUALITY_PROFILES:
+        raise ValueError(f"Unknown quality '{name}'. Expected one of: {', '.join(QUALITY_PROFILES)}")
+    return QUALITY_PROFILES[key]
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional
+
+# Share of a request's work that is skipped when an analysis is already cached
+# (segmentation + landmarks on the person, background removal + enhancement on the garment)
+PERSON_ANALYSIS_SHARE = 0.5
+GARMENT_ANALYSIS_SHARE = 0.6
+
+STANDARD_CLASS = "standard"
+PREMIUM_CLASS = "premium"
+
+
+def job_cost(person_pixels: float, cloth_pixels: float,
+             person_cached: bool = False, garment_cached: bool = False) -> float:
+    """Estimated work for one try-on in megapixels, discounted for cached analyses"""
+    person = person_pixels * (1.0 - PERSON_ANALYSIS_SHARE if person_cached else 1.0)
+    garment = cloth_pixels * (1.0 - GARMENT_ANALYSIS_SHARE if garment_cached else 1.0)
+    return (person + garment) / 1e6
+
+
+class JobTicket(NamedTuple):
+    """A running job's slot, class and how long it queued"""
+    job_class: str
+    cost: float
+    wait_ms: float
+
+
+class ShortestJobFirstScheduler:
+    """Hands out request slots to the cheapest waiting job first.
+
+    A waiting job's priority is its cost divided by its class weight, minus
+    ``aging_rate`` for every second it has waited, so a large job is passed by
+    small ones for at most ``cost / aging_rate`` seconds. Because every waiting
+    job ages at the same rate, that order never changes once a job is queued and
+    a heap keyed on ``cost / weight + aging_rate * arrival`` gives it directly.
+    Must be used from the event loop that serves the requests.
+    """
+
+    def __init__(self, slots: int, aging_rate: float = 1.0,
+                 class_weights: Optional[Dict[str, float]] = None, window: int = 200):
+        self.slots = max(1, slots)
+        self.aging_rate = aging_rate
+        self.class_weights = class_weights or {STANDARD_CLASS: 1.0, PREMIUM_CLASS: 4.0}
+        self.running = 0
+        self._heap: List = []
+        self._sequence = itertools.count()
+        self._waits: Dict[str, deque] = {name: deque(maxlen=window) for name in self.class_weights}
+        self._completed: Dict[str, int] = {name: 0 for name in self.class_weights}
+
+    def _priority(self, cost: float, job_class: str, arrival: float) -> float:
+        return cost / self.class_weights.get(job_class, 1.0) + self.aging_rate * arrival
+
+    async def acquire(self, cost: float, job_class: str = STANDARD_CLASS) -> JobTicket:
+        """Wait for a free slot; cheaper and premium jobs are let through first"""
+        if job_class not in self.class_weights:
+            job_class = STANDARD_CLASS
+        if self.running < self.slots and not self._heap:
+            self.running += 1
+            self._record_wait(job_class, 0.0)
+            return JobTicket(job_class, cost, 0.0)
+
+        arrival = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (self._priority(cost, job_class, arrival), next(self._sequence), future)
+        heapq.heappush(self._heap, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Started at the same moment; hand the slot on
+                self.release(JobTicket(job_class, cost, 0.0))
+            elif entry in self._heap:
+                # Client went away while queued (release() skips and drops it if it got there first)
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+            raise
+
+        wait_ms = (time.monotonic() - arrival) * 1000
+        self._record_wait(job_class, wait_ms)
+        return JobTicket(job_class, cost, wait_ms)
+
+    def release(self, ticket: JobTicket):
+        """Free a slot and start the highest-priority waiting job"""
+        self.running -= 1
+        while self._heap and self.running < self.slots:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                # Cancelled while queued; its slot goes to the next waiter
+                continue
+            self.running += 1
+            future.set_result(None)
+
+    def _record_wait(self, job_class: str, wait_ms: float):
+        self._waits[job_class].append(wait_ms)
+        self._completed[job_class] += 1
+
+    def headers(self, ticket: JobTicket) -> dict:
+        """Response headers describing how the job was scheduled"""
+        return {
+            "X-TryOn-Priority": ticket.job_class,
+            "X-TryOn-Queue-Wait-Ms": f"{ticket.wait_ms:.0f}",
+        }
+
+    def snapshot(self) -> dict:
+        """Slot usage and per-class queue wait percentiles for /health and /api/metrics"""
+        classes = {}
+        for name, waits in self._waits.items():
+            ordered = sorted(waits)
+            classes[name] = {
+                "started": self._completed[name],
+                "wait_ms_mean": round(sum(ordered) / len(ordered), 1) if ordered else 0.0,
+                "wait_ms_p50": round(ordered[len(ordered) // 2], 1) if ordered else 0.0,
+                "wait_ms_p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1) if ordered else 0.0,
+            }
+        return {
+            "slots": self.slots,
+            "running": self.running,
+            "waiting": len(self._heap),
+            "aging_mp_per_second": self.aging_rate,
+            "classes": classes,
+        }
+
+
+def scheduler_from_env(slots: int) -> ShortestJobFirstScheduler:
+    """Build the scheduler from TRYON_SCHED_AGING_MP_PER_SECOND and TRYON_PREMIUM_WEIGHT"""
+    return ShortestJobFirstScheduler(
+        slots,
+        aging_rate=float(os.getenv("TRYON_SCHED_AGING_MP_PER_SECOND", "1.0")),
+        class_weights={
+            STANDARD_CLASS: 1.0,
+            PREMIUM_CLASS: float(os.getenv("TRYON_PREMIUM_WEIGHT", "4.0")),
+        },
+    )
+
+
+def premium_keys_from_env() -> set:
+    """API keys of paying clients, from the comma-separated TRYON_PREMIUM_KEYS"""
+    return {key.strip() for key in os.getenv("TRYON_PREMIUM_KEYS", "").split(",") if key.strip()}
@@ -0,0 +1,360 @@
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+
+from utils.asset_format import load_asset, save_asset
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    meta TEXT,
+    nbytes INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS counters (
+    namespace TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def entry_key(namespace: str, key: Hashable) -> str:
+    """Stable string key for a cache entry; cache keys are tuples of str/int/bool/None"""
+    return hashlib.blake2b(f"{namespace}:{key!r}".encode(), digest_size=16).hexdigest()
+
+
+def _is_image(value) -> bool:
+    return isinstance(value, np.ndarray) and value.dtype == np.uint8 and value.ndim in (2, 3)
+
+
+def _is_pyramid(value) -> bool:
+    return isinstance(value, list) and len(value) > 0 and all(_is_image(level) for level in value)
+
+
+# NamedTuple types the shared tier may store, by name (see register_record_type)
+_RECORD_TYPES = {}
+
+
+def register_record_type(cls):
+    """Let a NamedTuple type be stored in the shared tier; its fields must be uint8 images or JSON data"""
+    _RECORD_TYPES[cls.__name__] = cls
+    return cls
+
+
+def _is_record(value) -> bool:
+    return _RECORD_TYPES.get(type(value).__name__) is type(value) and any(_is_image(field) for field in value)
+
+
+def _to_json(value):
+    """JSON-ready form of plain data; tuples are tagged so they load back as tuples"""
+    if isinstance(value, tuple):
+        return {"__tuple__": [_to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        if not all(isinstance(name, str) for name in value):
+            raise TypeError("Only str dictionary keys can be stored in the shared cache")
+        return {name: _to_json(item) for name, item in value.items()}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    raise TypeError(f"{type(value).__name__} values cannot be stored in the shared cache")
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    if isinstance(value, dict):
+        if set(value) == {"__tuple__"}:
+            return tuple(_from_json(item) for item in value["__tuple__"])
+        return {name: _from_json(item) for name, item in value.items()}
+    return value
+
+
+def _private_directory(directory: str):
+    """Create the cache directory for this user only, refusing one another user could write to.
+
+    Entries are loaded back into the process, so nobody else may be able to plant them.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"Shared cache path {directory} is not a directory")
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        raise PermissionError(f"Shared cache directory {directory} belongs to another user")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(directory, 0o700)
+
+
+class LocalCacheBackend:
+    """In-process stand-in for the shared tier, with the same interface and a byte budget.
+
+    Used for tests and single-worker runs; nothing is shared between processes.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, namespace: str, key: Hashable):
+        with self._lock:
+            name = entry_key(namespace, key)
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+            return self._entries[name][0]
+
+    def contains(self, namespace: str, key: Hashable) -> bool:
+        with self._lock:
+            return entry_key(namespace, key) in self._entries
+
+    def put(self, namespace: str, key: Hashable, value):
+        """Store a value and return it as the tier will serve it (here, the same object)"""
+        nbytes = _value_nbytes(value)
+        with self._lock:
+            name = entry_key(namespace, key)
+            if name in self._entries:
+                self._bytes -= self._entries.pop(name)[1]
+            self._entries[name] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+        return value
+
+    def record(self, namespace: str, hits: int, misses: int):
+        with self._lock:
+            totals = self._counters.setdefault(namespace, [0, 0])
+            totals[0] += hits
+            totals[1] += misses
+
+    def stats(self) -> dict:
+        with self._lock:
+            return _stats_dict("local", len(self._entries), self._bytes, self.max_bytes,
+                               self.evictions, self._counters)
+
+
+class ShmCacheBackend:
+    """Node-wide cache tier shared by every worker process on the machine.
+
+    Entries are files in a private shared-memory directory (``/dev/shm`` by default):
+    uint8 arrays and pyramids as memory-mapped ``.trya`` assets, so every worker reading
+    an entry maps the same pages. Registered records keep their images in a ``.trya``
+    asset and their other fields as JSON in the index; other values must be plain JSON
+    data. Nothing is unpickled. A SQLite index in the same directory holds sizes,
+    last-access times and hit counters, giving all workers one LRU eviction policy and
+    one hit rate.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        _private_directory(directory)
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=10,
+                                   check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.executescript(SCHEMA)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+            if "meta" not in columns:
+                # Index from a version that pickled entries: drop it along with its files
+                for (path,) in self._db.execute("SELECT path FROM entries").fetchall():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._db.execute("DROP TABLE entries")
+                self._db.executescript(SCHEMA)
+        self.evictions = 0
+
+    def _load(self, kind: str, path: str, meta: Optional[str]):
+        if kind == "array":
+            return load_asset(path).image
+        if kind == "pyramid":
+            return load_asset(path).levels
+        if kind == "record":
+            record = json.loads(meta)
+            asset = load_asset(path)
+            images = [asset.image] + list(asset.levels)
+            fields = [images[field["__image__"]] if isinstance(field, dict) and "__image__" in field
+                      else _from_json(field) for field in record["fields"]]
+            return _RECORD_TYPES[record["type"]](*fields)
+        return _from_json(json.loads(meta))
+
+    def get(self, namespace: str, key: Hashable):
+        name = entry_key(namespace, key)
+        with self._lock:
+            row = self._db.execute("SELECT kind, path, meta FROM entries WHERE key = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), name))
+        try:
+            return self._load(*row)
+        except (OSError, ValueError, KeyError, TypeError):
+            # Evicted by another worker between the lookup and the load
+            return None
+
+    def contains(self, namespace: str, key: Hashable) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE key = ?",
+                                    (entry_key(namespace, key),)).fetchone() is not None
+
+    def put(self, namespace: str, key: Hashable, value):
+        """Store a value and return it as the tier will serve it.
+
+        Images are written raw (masks too) so every load is a memory-mapped view rather
+        than a decoded copy; callers keep that view instead of the heap value.
+        """
+        name = entry_key(namespace, key)
+        meta = None
+        if _is_image(value):
+            kind, path = "array", os.path.join(self.directory, name + ".trya")
+            save_asset(path, value, "raw")
+        elif _is_pyramid(value):
+            kind, path = "pyramid", os.path.join(self.directory, name + ".trya")
+            save_asset(path, value[0], "raw", value[1:])
+        elif _is_record(value):
+            kind, path = "record", os.path.join(self.directory, name + ".trya")
+            images = [field for field in value if _is_image(field)]
+            fields, index = [], 0
+            for field in value:
+                if _is_image(field):
+                    fields.append({"__image__": index})
+                    index += 1
+                else:
+                    fields.append(_to_json(field))
+            meta = json.dumps({"type": type(value).__name__, "fields": fields})
+            save_asset(path, images[0], "raw", images[1:])
+        else:
+            kind, path = "json", ""
+            meta = json.dumps(_to_json(value))
+
+        nbytes = (os.path.getsize(path) if path else 0) + len(meta or "")
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, namespace, kind, path, meta, nbytes, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, namespace, kind, path, meta, nbytes, time.time()),
+            )
+            self._evict()
+        try:
+            return self._load(kind, path, meta)
+        except (OSError, ValueError, KeyError, TypeError):
+            # Evicted by another worker straight away
+            return value
+
+    def _evict(self):
+        """Delete least recently used entries, across all workers, until under budget"""
+        total = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for name, path, nbytes in self._db.execute(
+                "SELECT key, path, nbytes FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (name,))
+            # Workers that still map the file keep their pages until they drop them
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= nbytes
+            self.evictions += 1
+
+    def record(self, namespace: str, hits: int, misses: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO counters (namespace, hits, misses) VALUES (?, ?, ?) "
+                "ON CONFLICT(namespace) DO UPDATE SET hits = hits + excluded.hits, "
+                "misses = misses + excluded.misses",
+                (namespace, hits, misses),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM entries").fetchone()
+            counters = {namespace: [hits, misses] for namespace, hits, misses in
+                        self._db.execute("SELECT namespace, hits, misses FROM counters")}
+        stats = _stats_dict("shm", entries, total, self.max_bytes, self.evictions, counters)
+        stats["directory"] = self.directory
+        return stats
+
+
+def _value_nbytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_value_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(len(str(name)) + _value_nbytes(item) for name, item in value.items())
+    return len(repr(value))
+
+
+def _stats_dict(backend: str, entries: int, nbytes: int, max_bytes: int, evictions: int,
+                counters: dict) -> dict:
+    hits = sum(totals[0] for totals in counters.values())
+    lookups = hits + sum(totals[1] for totals in counters.values())
+    return {
+        "backend": backend,
+        "entries": entries,
+        "size_mb": round(nbytes / 2 ** 20, 1),
+        "max_mb": round(max_bytes / 2 ** 20, 1),
+        # Evictions made by this worker; the index is shared, the count is not
+        "evictions": evictions,
+        "hits": hits,
+        "misses": lookups - hits,
+        "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        "namespaces": {
+            namespace: round(totals[0] / (totals[0] + totals[1]), 3) if totals[0] + totals[1] else 0.0
+            for namespace, totals in sorted(counters.items())
+        },
+    }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+_shared_cache_ready = False
+
+
+def get_shared_cache():
+    """The shared cache tier selected by TRYON_SHARED_CACHE ("shm", "local" or unset for none)"""
+    global _shared_cache, _shared_cache_ready
+    if not _shared_cache_ready:
+        with _shared_cache_lock:
+            if not _shared_cache_ready:
+                backend = os.getenv("TRYON_SHARED_CACHE", "").lower()
+                max_bytes = int(float(os.getenv("TRYON_SHARED_CACHE_MB", "512")) * 2 ** 20)
+                if backend == "shm":
+                    default_dir = "/dev/shm/tryon-cache" if os.path.isdir("/dev/shm") else \
+                        os.path.join(tempfile.gettempdir(), "tryon-cache")
+                    directory = os.getenv("TRYON_SHARED_CACHE_DIR", default_dir)
+                    try:
+                        _shared_cache = ShmCacheBackend(directory, max_bytes)
+                        print(f"🗄️ Shared cache: {directory} ({max_bytes // 2 ** 20} MB)")
+                    except OSError as e:
+                        print(f"⚠️ Shared cache disabled: {e}")
+                elif backend == "local":
+                    _shared_cache = LocalCacheBackend(max_bytes)
+                _shared_cache_ready = True
+    return _shared_cache
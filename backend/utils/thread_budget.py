@@ -0,0 +1,118 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import cv2
+
+# Each request runs at most two branches at once (person analysis and garment extraction)
+BRANCHES_PER_REQUEST = 2
+
+
+class ThreadBudget(NamedTuple):
+    """How the CPU core budget is split between request workers and library thread pools"""
+    cpu_budget: int
+    # Requests processed concurrently
+    request_workers: int
+    # Stage-graph threads that run the second branch of each request
+    pipeline_workers: int
+    # Intra-op threads given to OpenCV and onnxruntime
+    intra_op_threads: int
+    # Threads rendering live-stream frames, kept apart from the request workers
+    live_workers: int = 1
+
+
+def budget_from_env() -> ThreadBudget:
+    """Divide TRYON_CPU_BUDGET cores between request workers and intra-op threads.
+
+    By default half the cores serve requests; every request can keep two branches
+    busy, so each library gets ``cpu_budget // (request_workers * 2)`` threads.
+    """
+    cpu_budget = max(1, int(os.getenv("TRYON_CPU_BUDGET", str(os.cpu_count() or 1))))
+    request_workers = max(1, int(os.getenv("TRYON_REQUEST_WORKERS", str(max(1, cpu_budget // 2)))))
+    pipeline_workers = max(1, int(os.getenv("TRYON_PIPELINE_WORKERS", str(request_workers))))
+    default_intra = max(1, cpu_budget // (request_workers * BRANCHES_PER_REQUEST))
+    intra_op_threads = max(1, int(os.getenv("TRYON_INTRA_OP_THREADS", str(default_intra))))
+    live_workers = max(1, int(os.getenv("TRYON_LIVE_WORKERS", str(max(1, request_workers // 2)))))
+    return ThreadBudget(cpu_budget, request_workers, pipeline_workers, intra_op_threads, live_workers)
+
+
+_budget: Optional[ThreadBudget] = None
+_request_executor: Optional[ThreadPoolExecutor] = None
+_live_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def apply_thread_budget(budget: Optional[ThreadBudget] = None) -> ThreadBudget:
+    """Apply the budget to OpenCV and onnxruntime. Call before any model is loaded."""
+    global _budget
+    budget = budget or budget_from_env()
+
+    cv2.setNumThreads(budget.intra_op_threads)
+    # rembg reads OMP_NUM_THREADS when it builds its onnxruntime session options
+    os.environ["OMP_NUM_THREADS"] = str(budget.intra_op_threads)
+
+    _budget = budget
+    print(f"🧵 Thread budget: {thread_layout()}")
+    return budget
+
+
+def get_thread_budget() -> ThreadBudget:
+    """The applied budget, applying the environment defaults on first use"""
+    if _budget is None:
+        with _lock:
+            if _budget is None:
+                apply_thread_budget()
+    return _budget
+
+
+def onnx_session_options():
+    """onnxruntime session options limited to the intra-op thread budget"""
+    import onnxruntime as ort
+
+    budget = get_thread_budget()
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = budget.intra_op_threads
+    options.inter_op_num_threads = 1
+    return options
+
+
+def get_request_executor() -> ThreadPoolExecutor:
+    """Thread pool that runs whole try-on requests, sized to the request worker budget"""
+    global _request_executor
+    if _request_executor is None:
+        budget = get_thread_budget()
+        with _lock:
+            if _request_executor is None:
+                _request_executor = ThreadPoolExecutor(max_workers=budget.request_workers,
+                                                       thread_name_prefix="tryon-request")
+    return _request_executor
+
+
+def get_live_executor() -> ThreadPoolExecutor:
+    """Thread pool that renders live-stream frames, so streams cannot starve try-on requests"""
+    global _live_executor
+    if _live_executor is None:
+        budget = get_thread_budget()
+        with _lock:
+            if _live_executor is None:
+                _live_executor = ThreadPoolExecutor(max_workers=budget.live_workers,
+                                                    thread_name_prefix="tryon-live")
+    return _live_executor
+
+
+def thread_layout() -> dict:
+    """Effective thread layout for startup logs and /health"""
+    budget = _budget or budget_from_env()
+    return {
+        "cpu_count": os.cpu_count(),
+        "cpu_budget": budget.cpu_budget,
+        "request_workers": budget.request_workers,
+        "pipeline_workers": budget.pipeline_workers,
+        "live_workers": budget.live_workers,
+        "opencv_threads": cv2.getNumThreads(),
+        "onnxruntime_intra_op_threads": budget.intra_op_threads,
+        # The MediaPipe solutions API exposes no thread setting; each model is
+        # called under its own lock, so it never runs more than one graph per model
+        "mediapipe": "one call at a time per model",
+    }
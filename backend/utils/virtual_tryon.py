@@ -1,34 +1,79 @@
 import cv2
 import numpy as np
 from PIL import Image
-import io
-import base64
-import requests
-from rembg import remove
 import os
-from typing import Tuple, Optional
+import threading
+import time
+from typing import Dict, Tuple, Optional
+
+# rembg is optional here too; without it garments are cut out by a colour threshold
+try:
+    from rembg import remove
+    REMBG_AVAILABLE = True
+except ImportError:
+    REMBG_AVAILABLE = False
+
+from utils.color_lut import BACKGROUND, get_color_lut
+from utils.image_encoding import encode_image, image_to_data_url
+from utils.output_size import OutputSpec, plan_frame, reframe
+from utils.quality import QualityProfile
+
+
+class HOGSettings:
+    """Person detector settings, from TRYON_HOG_MAX_SIDE, TRYON_HOG_SCALE and TRYON_HOG_STRIDE.
+    
+    The default people detector has a 64x128 window, so detecting on a frame capped at
+    ``max_side`` pixels still finds anyone taller than about a quarter of the frame.
+    """
+    
+    def __init__(self):
+        self.max_side = int(os.getenv("TRYON_HOG_MAX_SIDE", "512"))
+        self.scale = float(os.getenv("TRYON_HOG_SCALE", "1.05"))
+        stride = int(os.getenv("TRYON_HOG_STRIDE", "8"))
+        self.stride = (stride, stride)
+
 
 class VirtualTryOnProcessor:
     def __init__(self):
         self.API_KEY = os.getenv("GEMINI_API_KEY")
-        
-    def preprocess_images(self, person_image_bytes: bytes, cloth_image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
-        """Preprocess images for virtual try-on"""
-        # Convert bytes to numpy arrays
-        person_np = np.frombuffer(person_image_bytes, np.uint8)
-        person_img = cv2.imdecode(person_np, cv2.IMREAD_COLOR)
-        
-        cloth_np = np.frombuffer(cloth_image_bytes, np.uint8)
-        cloth_img = cv2.imdecode(cloth_np, cv2.IMREAD_COLOR)
+        self.hog_settings = HOGSettings()
+        # HOG detectors are built once per thread and reused for every request
+        self._local = threading.local()
+    
+    def _get_hog(self):
+        hog = getattr(self._local, "hog", None)
+        if hog is None:
+            hog = cv2.HOGDescriptor()
+            hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+            self._local.hog = hog
+        return hog
+    
+    def decode_image(self, image_bytes: bytes, max_side: Optional[int] = None) -> np.ndarray:
+        """Decode image bytes to RGB, optionally capping the longest side"""
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image")
+        
+        h, w = image.shape[:2]
+        if max_side and max(h, w) > max_side:
+            scale = max_side / max(h, w)
+            image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                               interpolation=cv2.INTER_AREA)
         
         # Ensure images are in RGB format
-        person_rgb = cv2.cvtColor(person_img, cv2.COLOR_BGR2RGB)
-        cloth_rgb = cv2.cvtColor(cloth_img, cv2.COLOR_BGR2RGB)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
-        return person_rgb, cloth_rgb
+    def preprocess_images(self, person_image_bytes: bytes, cloth_image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """Preprocess images for virtual try-on"""
+        return self.decode_image(person_image_bytes), self.decode_image(cloth_image_bytes)
     
     def remove_background(self, image: np.ndarray) -> np.ndarray:
-        """Remove background from image using rembg"""
+        """Remove background from image using rembg, or a light/dark backdrop threshold without it"""
+        if not REMBG_AVAILABLE:
+            rgba = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
+            rgba[:, :, 3] = get_color_lut().mask(image, BACKGROUND, invert=True)
+            return rgba
+        
         # Convert numpy array to PIL Image
         pil_image = Image.fromarray(image)
         
@@ -38,17 +83,40 @@ class VirtualTryOnProcessor:
         # Convert back to numpy array
         return np.array(result)
     
+    def detect_people(self, gray: np.ndarray) -> np.ndarray:
+        """HOG person boxes (x, y, w, h) in full-resolution coordinates.
+        
+        Detection runs on a copy downscaled to ``TRYON_HOG_MAX_SIDE``, which cuts the
+        number of windows scanned roughly by the square of the downscale factor.
+        """
+        settings = self.hog_settings
+        h, w = gray.shape[:2]
+        factor = 1.0
+        if settings.max_side and max(h, w) > settings.max_side:
+            factor = settings.max_side / max(h, w)
+            gray = cv2.resize(gray, (max(1, int(w * factor)), max(1, int(h * factor))),
+                              interpolation=cv2.INTER_AREA)
+        
+        boxes, _ = self._get_hog().detectMultiScale(gray, winStride=settings.stride, padding=(4, 4),
+                                                    scale=settings.scale)
+        if len(boxes) == 0 or factor == 1.0:
+            return boxes
+        
+        # Map back to full size, clipped to the frame
+        boxes = np.round(np.asarray(boxes, dtype=np.float64) / factor).astype(np.int32)
+        boxes[:, 0] = np.clip(boxes[:, 0], 0, w - 1)
+        boxes[:, 1] = np.clip(boxes[:, 1], 0, h - 1)
+        boxes[:, 2] = np.minimum(boxes[:, 2], w - boxes[:, 0])
+        boxes[:, 3] = np.minimum(boxes[:, 3], h - boxes[:, 1])
+        return boxes
+    
     def detect_person_segmentation(self, person_image: np.ndarray) -> np.ndarray:
         """Detect person segmentation using OpenCV"""
         # Convert to grayscale for processing
         gray = cv2.cvtColor(person_image, cv2.COLOR_RGB2GRAY)
         
         # Use HOG (Histogram of Oriented Gradients) for person detection
-        hog = cv2.HOGDescriptor()
-        hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
-        
-        # Detect people
-        boxes, weights = hog.detectMultiScale(gray, winStride=(8, 8), padding=(4, 4), scale=1.05)
+        boxes = self.detect_people(gray)
         
         # Create mask for detected person
         mask = np.zeros(gray.shape, dtype=np.uint8)
@@ -185,26 +253,53 @@ class VirtualTryOnProcessor:
         return enhanced_result
     
     def process_virtual_tryon(self, person_image_bytes: bytes, cloth_image_bytes: bytes, 
-                            garment_type: str = "", instructions: str = "") -> Tuple[np.ndarray, str]:
-        """Main method to process virtual try-on"""
+                            garment_type: str = "", instructions: str = "",
+                            timings: Optional[Dict[str, float]] = None,
+                            quality: Optional[QualityProfile] = None,
+                            output: Optional[OutputSpec] = None) -> Tuple[np.ndarray, str]:
+        """Main method to process virtual try-on.
+        
+        Takes the same arguments as the enhanced processor so either can serve the API;
+        of the quality profile only ``max_side`` applies here. An ``output`` spec crops
+        and scales the person before the garment is composited.
+        """
+        stage_timings = {} if timings is None else timings
+        max_side = quality.max_side if quality is not None else None
+        
+        def timed(name, fn, *args):
+            start = time.perf_counter()
+            value = fn(*args)
+            stage_timings[name] = (time.perf_counter() - start) * 1000
+            return value
+        
         try:
             # Preprocess images
-            person_img, cloth_img = self.preprocess_images(person_image_bytes, cloth_image_bytes)
+            person_img = timed("decode_person", self.decode_image, person_image_bytes, max_side)
+            cloth_img = timed("decode_cloth", self.decode_image, cloth_image_bytes, max_side)
             
             # Detect person segmentation
-            person_mask = self.detect_person_segmentation(person_img)
+            person_mask = timed("segment_person", self.detect_person_segmentation, person_img)
+            
+            # Composite at the requested output size, framed on the detected person if asked
+            if output is not None:
+                person_box = cv2.boundingRect(person_mask) if output.crop_to_person and person_mask.any() else None
+                plan = plan_frame(person_img.shape, output, person_box)
+                if plan is not None:
+                    person_img = reframe(person_img, plan)
+                    person_mask = reframe(person_mask, plan, cv2.INTER_NEAREST)
             
             # Extract clothing from garment image
-            clothing = self.extract_clothing(cloth_img)
+            clothing = timed("extract_clothing", self.extract_clothing, cloth_img)
             
             # Resize clothing to fit person
-            resized_clothing = self.resize_clothing_to_person(clothing, person_mask)
+            resized_clothing = timed("fit_clothing", self.resize_clothing_to_person, clothing, person_mask)
             
             # Blend clothing onto person
-            result = self.blend_clothing_onto_person(person_img, resized_clothing, person_mask, garment_type)
+            result = timed("composite", self.blend_clothing_onto_person, person_img, resized_clothing,
+                           person_mask, garment_type)
             
             # Enhance lighting consistency
-            result = self.enhance_lighting_consistency(result, person_img)
+            result = timed("lighting", self.enhance_lighting_consistency, result, person_img)
             
             # Generate description
             description = self.generate_description(garment_type, instructions)
@@ -214,6 +309,13 @@ class VirtualTryOnProcessor:
         except Exception as e:
             raise Exception(f"Error in virtual try-on processing: {str(e)}")
     
+    def cached_analyses(self, person_key: str, cloth_key: str, quality: QualityProfile) -> Tuple[bool, bool]:
+        """Nothing is cached by this processor"""
+        return False, False
+    
+    def cache_stats(self) -> dict:
+        return {}
+    
     def generate_description(self, garment_type: str, instructions: str) -> str:
         """Generate a description of the try-on result"""
         base_description = f"Virtual try-on completed successfully! The {garment_type} has been applied to your image while preserving the original background and lighting."
@@ -225,18 +327,10 @@ class VirtualTryOnProcessor:
         
         return base_description
     
-    def numpy_to_base64(self, image: np.ndarray) -> str:
-        """Convert numpy array to base64 string"""
-        # Convert to PIL Image
-        pil_image = Image.fromarray(image)
-        
-        # Convert to bytes
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='PNG')
-        img_bytes = buffer.getvalue()
-        
-        # Convert to base64
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        
-        return f"data:image/png;base64,{img_base64}"
-
+    def encode_image(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> bytes:
+        """Encode a numpy array as PNG, JPEG or WEBP bytes"""
+        return encode_image(image, image_format, quality)
+    
+    def numpy_to_base64(self, image: np.ndarray, image_format: str = "PNG", quality: int = 95) -> str:
+        """Convert numpy array to a base64 data URL"""
+        return image_to_data_url(image, image_format, quality)
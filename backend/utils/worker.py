@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+from utils.broker import DONE, FAILED, BrokerSettings, Job
+from utils.output_size import OutputSpec
+from utils.quality import QualityProfile
+
+_worker_numbers = itertools.count(1)
+# Longest pause between retries after a broker error
+MAX_ERROR_BACKOFF_SECONDS = 5.0
+
+
+def tryon_payload(person_bytes: bytes, cloth_bytes: bytes, garment_type: str, instructions: str,
+                  quality: QualityProfile, output: Optional[OutputSpec] = None) -> dict:
+    """Job payload for one try-on; the quality profile travels with it, degradation included"""
+    return {
+        "person": person_bytes,
+        "cloth": cloth_bytes,
+        "garment_type": garment_type,
+        "instructions": instructions,
+        "quality": quality._asdict(),
+        "output": output._asdict() if output is not None else None,
+    }
+
+
+async def submit_tryon(broker, payload: dict, settings: BrokerSettings) -> dict:
+    """Enqueue a try-on and wait for a worker's result.
+
+    Raises ``asyncio.TimeoutError`` after ``settings.result_timeout`` and ``RuntimeError``
+    when the job failed; the job is removed from the broker once collected.
+    """
+    loop = asyncio.get_running_loop()
+    job_id = await loop.run_in_executor(None, broker.enqueue, payload, settings.max_attempts)
+    deadline = loop.time() + settings.result_timeout
+    delay = 0.005
+    try:
+        while True:
+            # Broker calls block on SQLite, so they stay off the event loop
+            status = await loop.run_in_executor(None, broker.get, job_id)
+            if status is not None and status.state == DONE:
+                return status.result
+            if status is None or status.state == FAILED:
+                raise RuntimeError(status.error if status is not None else "Job disappeared from the broker")
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError(f"No worker finished job {job_id} in {settings.result_timeout:g}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 0.05)
+    finally:
+        await loop.run_in_executor(None, broker.delete, job_id)
+
+
+class TryOnWorker:
+    """Pulls try-on jobs from a broker and runs them on a local processor.
+
+    While a job runs, a heartbeat thread keeps its lease alive; if this worker dies the
+    lease lapses after the visibility timeout and another worker picks the job up.
+    Processing errors fail the job straight away, since the same inputs would fail again.
+    """
+
+    def __init__(self, broker, processor, settings: BrokerSettings, name: Optional[str] = None):
+        self.broker = broker
+        self.processor = processor
+        self.settings = settings
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}:{next(_worker_numbers)}"
+        self.counts = {"completed": 0, "failed": 0, "lost_leases": 0, "broker_errors": 0}
+
+    def run_job(self, job: Job) -> dict:
+        payload = job.payload
+        quality = QualityProfile(**payload["quality"])
+        output = OutputSpec(**payload["output"]) if payload.get("output") else None
+        timings = {}
+        result, description = self.processor.process_virtual_tryon(
+            payload["person"], payload["cloth"], payload["garment_type"], payload["instructions"],
+            timings=timings, quality=quality, output=output,
+        )
+        image_url = self.processor.numpy_to_base64(result, quality.output_format, quality.output_quality)
+        return {"image": image_url, "text": description, "timings": timings, "worker": self.name}
+
+    def _heartbeat(self, job: Job, stop: threading.Event):
+        while not stop.wait(self.settings.heartbeat_interval):
+            try:
+                alive = self.broker.heartbeat(job.id, job.lease, self.settings.visibility_timeout)
+            except Exception as e:
+                # e.g. "database is locked": the next beat tries again before the lease lapses
+                print(f"⚠️ Heartbeat for job {job.id} failed: {e}")
+                continue
+            if not alive:
+                self.counts["lost_leases"] += 1
+                print(f"⚠️ Lost the lease on job {job.id}; another worker may run it")
+                return
+
+    def process_one(self, wait: float = 1.0) -> bool:
+        """Lease and run one job; False if none arrived within ``wait`` seconds"""
+        job = self.broker.lease(self.name, self.settings.visibility_timeout, wait)
+        if job is None:
+            return False
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, stop), daemon=True)
+        heartbeat.start()
+        start = time.perf_counter()
+        try:
+            result = self.run_job(job)
+        except Exception as e:
+            self.broker.fail(job.id, job.lease, str(e))
+            self.counts["failed"] += 1
+            print(f"❌ Job {job.id} failed on attempt {job.attempts}: {e}")
+            return True
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if self.broker.complete(job.id, job.lease, result):
+            self.counts["completed"] += 1
+            print(f"✅ Job {job.id} done in {(time.perf_counter() - start) * 1000:.0f} ms (attempt {job.attempts})")
+        return True
+
+    def run(self, stop: threading.Event):
+        """Process jobs until ``stop`` is set; the job in hand is always finished first.
+
+        Broker errors (a locked database, say) are logged and retried with backoff,
+        so the worker thread never exits while ``stop`` is clear.
+        """
+        backoff = 0.0
+        while not stop.is_set():
+            try:
+                self.process_one()
+                backoff = 0.0
+            except Exception as e:
+                self.counts["broker_errors"] += 1
+                backoff = min(max(backoff * 2, 0.1), MAX_ERROR_BACKOFF_SECONDS)
+                print(f"⚠️ Worker {self.name} broker error, retrying in {backoff:.1f}s: {e}")
+                stop.wait(backoff)
+
+    def start(self, stop: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.run, args=(stop,), name="tryon-worker", daemon=True)
+        thread.start()
+        return thread